@@ -5,15 +5,41 @@ Util class for bitbucket_repo
 from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
+import asyncio
+import copy
+import hashlib
 import json
+import random
+import socket
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import ssl
+import threading
 import time
 try:
     from urllib import urlencode
 except ImportError:
     from urllib.parse import urlencode
-from ansible.module_utils._text import to_text
+try:
+    from urllib.parse import parse_qsl, urljoin, urlsplit, urlunsplit
+    from urllib.request import getproxies, proxy_bypass
+except ImportError:
+    from urlparse import parse_qsl, urljoin, urlsplit, urlunsplit
+    from urllib import getproxies, proxy_bypass
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib
+try:
+    from email.utils import parsedate_to_datetime
+except ImportError:
+    parsedate_to_datetime = None
+from ansible.module_utils._text import to_native, to_text
 from ansible.module_utils.basic import env_fallback
 from ansible.module_utils.urls import fetch_url, basic_auth_header
+from ansible_collections.i2btech.ops.plugins.module_utils.bitbucket_cache import BitbucketCache, BitbucketStateStore
+from ansible_collections.i2btech.ops.plugins.module_utils.bitbucket_metrics import BitbucketMetrics
 
 #
 # class: BitbucketHelper
@@ -29,6 +55,478 @@ error_messages = {
     'unknown_error': 'An unknown error happened `{info}',
 }
 
+def reconcile(desired, current, desired_key, current_key, differ):
+    """
+    Diff desired against current items in linear time, current may be a generator so the
+    index is built while pages arrive.
+    Yields (action, desired_item, current_item) tuples where action is 'create', 'update'
+    (only when differ(desired_item, current_item) is True) or 'delete'.
+    Items are matched by key, the first current item is used when several share a key.
+    """
+
+    current_index = {}
+    for item in current:
+        current_index.setdefault(current_key(item), []).append(item)
+
+    desired_keys = set()
+    for item in desired:
+        key = desired_key(item)
+        desired_keys.add(key)
+        matches = current_index.get(key)
+        if not matches:
+            yield 'create', item, None
+        elif differ(item, matches[0]):
+            yield 'update', item, matches[0]
+
+    for key, items in current_index.items():
+        if key not in desired_keys:
+            for item in items:
+                yield 'delete', None, item
+
+
+def restriction_key(restriction):
+    """
+    Return a tuple that uniquely identifies a branch restriction rule.
+    The combination of kind + branch_match_kind + (pattern or branch_type) must be unique per repo.
+    """
+    kind = restriction.get('kind', '')
+    branch_match_kind = restriction.get('branch_match_kind', '')
+    if branch_match_kind == 'glob':
+        return (kind, branch_match_kind, restriction.get('pattern', ''))
+    return (kind, branch_match_kind, restriction.get('branch_type', ''))
+
+
+def restriction_payload(restriction):
+    """
+    Build the API payload dict from an Ansible task restriction dict.
+    """
+    payload = {
+        'type': 'branchrestriction',
+        'kind': restriction['kind'],
+        'branch_match_kind': restriction['branch_match_kind'],
+    }
+    if restriction['branch_match_kind'] == 'glob':
+        payload['pattern'] = restriction.get('pattern', '')
+    else:
+        payload['branch_type'] = restriction.get('branch_type', '')
+
+    if restriction.get('value') is not None:
+        payload['value'] = restriction['value']
+
+    users = restriction.get('users') or []
+    payload['users'] = [{'type': 'account', 'uuid': uid} for uid in users]
+
+    groups = restriction.get('groups') or []
+    payload['groups'] = [{'type': 'group', 'slug': slug} for slug in groups]
+
+    return payload
+
+
+def restrictions_differ(desired, current):
+    """
+    Return True if the desired restriction differs from the current one
+    and therefore needs to be updated via PUT.
+    """
+    # Compare value
+    desired_value = desired.get('value')
+    current_value = current.get('value')
+    if desired_value != current_value:
+        return True
+
+    # Compare users by UUID
+    desired_users = sorted(desired.get('users') or [])
+    current_users = sorted(
+        u.get('uuid', u.get('account_id', ''))
+        for u in (current.get('users') or [])
+    )
+    if desired_users != current_users:
+        return True
+
+    # Compare groups by slug
+    desired_groups = sorted(desired.get('groups') or [])
+    current_groups = sorted(
+        g.get('slug', '')
+        for g in (current.get('groups') or [])
+    )
+    if desired_groups != current_groups:
+        return True
+
+    return False
+
+
+class BitbucketError(Exception):
+    """
+    Raised instead of failing the module by the helpers returned by BitbucketHelper.raising,
+    so one resource among many can fail without stopping the others, and by the coroutines
+    of the helper, which must not fail the module from the event loop.
+    """
+
+#
+# class: BitbucketRateLimiter
+#
+
+class BitbucketRateLimiter:
+    """
+    Token bucket shared by every request of a BitbucketHelper, it paces requests to `rate`
+    per second (with bursts of up to `burst` requests) so we slow down before Bitbucket
+    starts answering 429. A rate of 0 disables the pacing.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate or 0)
+        self.burst = float(burst or max(1.0, self.rate))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._not_before = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take a token and return how many seconds the caller must wait before sending.
+        """
+
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self._not_before - now)
+            if self.rate > 0:
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                self._tokens -= 1
+                if self._tokens < 0:
+                    wait = max(wait, -self._tokens / self.rate)
+            return wait
+
+    def acquire(self):
+        """
+        Block until a request can be sent.
+        """
+
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def defer(self, seconds):
+        """
+        Hold every caller for `seconds`, used when the API tells us to back off.
+        """
+
+        with self._lock:
+            self._not_before = max(self._not_before, time.monotonic() + seconds)
+
+    def slow_down(self):
+        """
+        Halve the request rate, used when Bitbucket reports we are close to the limit.
+        """
+
+        with self._lock:
+            if self.rate > 0:
+                self.rate = max(self.rate / 2, 0.1)
+
+#
+# class: BitbucketRetryPolicy
+#
+
+class BitbucketRetryPolicy:
+    """
+    Decide which responses are retried and how long to wait between attempts.
+    Connection failures and 429 are always retried, server errors only for idempotent
+    methods. The wait comes from Retry-After / X-RateLimit-Reset when present, otherwise
+    it is an exponential backoff with jitter.
+    """
+
+    RETRY_ALWAYS = (-1, 429)
+    RETRY_IDEMPOTENT = (500, 502, 503, 504)
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+    def __init__(self, attempts, sleep, max_sleep):
+        self.attempts = attempts
+        self.sleep = sleep
+        self.max_sleep = max_sleep
+
+    def should_retry(self, attempt, method, info):
+        """
+        Return True when the request must be sent again.
+        """
+
+        if attempt >= self.attempts:
+            return False
+        if info is None:
+            return True
+        if info['status'] in self.RETRY_ALWAYS:
+            return True
+        return info['status'] in self.RETRY_IDEMPOTENT and method.upper() in self.IDEMPOTENT_METHODS
+
+    @staticmethod
+    def server_delay(info):
+        """
+        Seconds the server asked us to wait, or None.
+        """
+
+        retry_after = info.get('retry-after')
+        if retry_after:
+            try:
+                return max(0.0, float(retry_after))
+            except ValueError:
+                if parsedate_to_datetime is not None:
+                    try:
+                        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+                    except (TypeError, ValueError):
+                        pass
+
+        if info.get('x-ratelimit-remaining') == '0' and info.get('x-ratelimit-reset'):
+            try:
+                reset = float(info['x-ratelimit-reset'])
+            except ValueError:
+                return None
+            # the header is either an epoch timestamp or a number of seconds
+            return max(0.0, reset - time.time()) if reset > 1000000000 else reset
+
+        return None
+
+    def delay(self, attempt, info):
+        """
+        Seconds to wait before sending attempt number `attempt + 1`.
+        """
+
+        server_delay = self.server_delay(info or {})
+        if server_delay is not None:
+            return min(server_delay, max(self.max_sleep, 1))
+
+        backoff = min(self.max_sleep, self.sleep * (2 ** (attempt - 1)))
+        return backoff / 2 + random.uniform(0, backoff / 2)
+
+#
+# class: BitbucketConnectionPool
+#
+
+class BitbucketConnectionPool:
+    """
+    Keep-alive HTTP(S) connections reused across every request made by a BitbucketHelper.
+    At most `maxsize` connections per host are open at the same time; idle ones are kept
+    for the next request instead of paying a new TCP + TLS handshake.
+    """
+
+    TIMEOUT = 10
+    MAX_REDIRECTS = 5
+
+    def __init__(self, maxsize=10, validate_certs=True, timeout=TIMEOUT):
+        self.maxsize = max(1, maxsize)
+        self.timeout = timeout
+        self._ssl_context = ssl.create_default_context()
+        if not validate_certs:
+            self._ssl_context.check_hostname = False
+            self._ssl_context.verify_mode = ssl.CERT_NONE
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._slots = {}
+
+    @staticmethod
+    def handles(url, use_proxy=True):
+        """
+        Return True when the url can be served by the pool, requests that need to go
+        through a proxy are left to fetch_url.
+        """
+
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            return False
+        if use_proxy and parts.scheme in getproxies() and not proxy_bypass(parts.hostname):
+            return False
+        return True
+
+    def _new_connection(self, scheme, netloc):
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout, context=self._ssl_context)
+        return httplib.HTTPConnection(netloc, timeout=self.timeout)
+
+    def _acquire(self, scheme, netloc):
+        key = (scheme, netloc)
+        with self._lock:
+            if key not in self._slots:
+                self._slots[key] = threading.BoundedSemaphore(self.maxsize)
+                self._idle[key] = []
+            slot = self._slots[key]
+        slot.acquire()
+        with self._lock:
+            if self._idle[key]:
+                return self._idle[key].pop(), True
+        return self._new_connection(scheme, netloc), False
+
+    def _release(self, scheme, netloc, conn, reusable):
+        key = (scheme, netloc)
+        if reusable:
+            with self._lock:
+                self._idle[key].append(conn)
+        else:
+            conn.close()
+        self._slots[key].release()
+
+    def _send(self, method, url, body, headers):
+        """
+        Send one request over a pooled connection and read the whole response.
+        A connection that was closed by the server while idle is replaced once.
+        """
+
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        conn, reused = self._acquire(parts.scheme, parts.netloc)
+        try:
+            while True:
+                try:
+                    conn.request(method, path, body=body, headers=headers)
+                    response = conn.getresponse()
+                    payload = response.read()
+                    break
+                except (httplib.RemoteDisconnected, httplib.BadStatusLine, ConnectionResetError, BrokenPipeError):
+                    conn.close()
+                    if not reused:
+                        raise
+                    conn, reused = self._new_connection(parts.scheme, parts.netloc), False
+        except Exception:
+            self._release(parts.scheme, parts.netloc, conn, False)
+            raise
+
+        self._release(parts.scheme, parts.netloc, conn, not response.will_close)
+        return response, payload
+
+    def fetch(self, url, method, data=None, headers=None):
+        """
+        Same contract as fetch_url: returns the response body (None on HTTP errors)
+        and an info dict with status, msg, url and lowercased response headers.
+        """
+
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        info = dict(url=url)
+        try:
+            for dummy in range(self.MAX_REDIRECTS + 1):
+                response, payload = self._send(method, url, data, headers or {})
+                if response.status in (301, 302, 303, 307, 308) and method in ('GET', 'HEAD') and response.getheader('location'):
+                    url = urljoin(url, response.getheader('location'))
+                    continue
+                break
+        except (socket.timeout, ssl.SSLError, OSError, httplib.HTTPException) as exc:
+            info.update(dict(msg="Connection failure: %s" % to_native(exc), status=-1))
+            return None, info
+
+        info.update(self.merge_headers(response.getheaders()))
+        info.update(dict(url=url, status=response.status))
+
+        if response.status >= 400:
+            info.update(dict(msg="HTTP Error %s: %s" % (response.status, response.reason), body=payload))
+            return None, info
+
+        info['msg'] = "OK (%s bytes)" % len(payload)
+        return payload, info
+
+    @staticmethod
+    def merge_headers(headers):
+        """
+        Lowercase header names and join duplicated ones, as fetch_url does.
+        """
+
+        response_headers = {}
+        for name, value in headers:
+            name = name.lower()
+            if name in response_headers:
+                response_headers[name] = ', '.join((response_headers[name], value))
+            else:
+                response_headers[name] = value
+        return response_headers
+
+    def close(self):
+        """
+        Close every idle connection.
+        """
+
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+                del conns[:]
+
+#
+# class: BitbucketAsyncTransport
+#
+
+class BitbucketAsyncTransport:
+    """
+    Run the requests of a BitbucketConnectionPool from coroutines. Every coroutine runs
+    on one event loop owned by the transport, in a background thread, and each request
+    is sent by the pool from one of `maxsize` worker threads, so at most `maxsize` are in
+    flight and the keep-alive connections of the pool are reused.
+    Coroutines are awaited from other coroutines of that loop, or run from regular code
+    (any thread) through run().
+    """
+
+    def __init__(self, pool, maxsize=10):
+        self.pool = pool
+        self.maxsize = max(1, maxsize)
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+        self._executor = None
+
+    def handles(self, url, use_proxy=True):
+        """
+        Same as BitbucketConnectionPool.handles.
+        """
+
+        return self.pool.handles(url, use_proxy)
+
+    def _start(self):
+        with self._lock:
+            if self._loop is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.maxsize)
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name='bitbucket-async')
+                self._thread.daemon = True
+                self._thread.start()
+            return self._loop
+
+    def run(self, coro):
+        """
+        Run a coroutine on the event loop of the transport and return its result.
+        The exceptions of the coroutine are raised again in the calling thread, and
+        BitbucketError if the event loop stops before the coroutine is done. There is no
+        overall timeout, every request is bounded by the timeout of the pool.
+        Must not be called from the event loop itself, await the coroutine there.
+        """
+
+        loop = self._start()
+        if threading.current_thread() is self._thread:
+            coro.close()
+            raise RuntimeError('BitbucketAsyncTransport.run() called from its own event loop')
+        future = asyncio.run_coroutine_threadsafe(coro, loop)
+        while True:
+            try:
+                return future.result(1)
+            except FutureTimeoutError:
+                if not self._thread.is_alive():
+                    raise BitbucketError('The event loop of the asyncio transport stopped')
+
+    async def fetch(self, url, method, data=None, headers=None):
+        """
+        Same contract as BitbucketConnectionPool.fetch, to be awaited on the transport loop.
+        """
+
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, self.pool.fetch, url, method, data, headers)
+
+    def close(self):
+        """
+        Stop the event loop and the worker threads, the connections belong to the pool.
+        """
+
+        if self._loop is None:
+            return
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._executor.shutdown(wait=False)
+
 class BitbucketHelper:
     """
     Class BitbucketHelper
@@ -36,6 +534,9 @@ class BitbucketHelper:
 
     BITBUCKET_API_URL = 'https://api.bitbucket.org/2.0'
     BITBUCKET_API_V1_URL = 'https://api.bitbucket.org/1.0'
+    BITBUCKET_WORKSPACE = 'i2b'
+    # stands for the uuid of an environment that would be created, in check mode
+    NEW_ENVIRONMENT_UUID = '{new}'
 
     BITBUCKET_API_ENDPOINTS = {
         'repos': '{url}/repositories/{workspace}/{repo_slug}',
@@ -47,10 +548,115 @@ class BitbucketHelper:
         'repos-branch-restrictions': '{url}/repositories/{workspace}/{repo_slug}/branch-restrictions',
     }
 
+    # largest pagelen accepted by each listing, the server default is 10
+    BITBUCKET_API_MAX_PAGELEN = {
+        'permissions': 100,
+        'variables': 100,
+        'environments': 100,
+        'branch-restrictions': 100,
+    }
+
+    # keys read by the modules in each response, sent as the partial response `fields`
+    # parameter, listings are keyed like BITBUCKET_API_MAX_PAGELEN
+    BITBUCKET_API_FIELDS = {
+        'repository': ['uuid', 'slug', 'name', 'full_name', 'is_private', 'project.key'],
+        'pipelines': ['enabled'],
+        'permissions': ['values.permission', 'values.user.nickname', 'values.group.slug'],
+        'variables': ['values.uuid', 'values.key', 'values.value', 'values.secured'],
+        'environments': ['values.uuid', 'values.name', 'values.environment_type.name'],
+        'branch-restrictions': [
+            'values.id', 'values.kind', 'values.branch_match_kind', 'values.pattern',
+            'values.branch_type', 'values.value', 'values.users.uuid', 'values.users.account_id',
+            'values.groups.slug',
+        ],
+    }
+    # always requested with the fields of a listing, iter_paginated needs them
+    BITBUCKET_API_PAGINATION_FIELDS = ['next', 'size', 'pagelen', 'page']
+
+    # group inventories read by this process, by workspace, shared by every helper
+    _group_inventories = {}
+    _group_inventories_lock = threading.Lock()
+
     def __init__(self, module):
         self.module = module
         if self.module.params['url'] is None:
             self.module.params['url'] = self.BITBUCKET_API_URL
+        self.v1_url = self.api_v1_url(self.module.params['url'])
+        self.pool = BitbucketConnectionPool(
+            maxsize=self.module.params['pool_size'],
+            validate_certs=self.module.params['validate_certs'])
+        self.retry_policy = BitbucketRetryPolicy(
+            attempts=self.module.params['retries'],
+            sleep=self.module.params['sleep'],
+            max_sleep=self.module.params['max_sleep'])
+        self.rate_limiter = BitbucketRateLimiter(self.module.params['rate_limit'])
+        self.transport = None
+        if self.module.params['transport'] == 'async':
+            self.transport = BitbucketAsyncTransport(self.pool, maxsize=self.module.params['pool_size'])
+        self.metrics = BitbucketMetrics()
+        self.pages_fetched = 0
+        self.repository = self.module.params.get('repository')
+        self.workspace = self.module.params.get('workspace') or self.BITBUCKET_WORKSPACE
+        self.raise_errors = False
+        self.repository_cache = None
+        self.response_cache = None
+        self.group_cache = None
+        if self.module.params['cache']:
+            ttl = self.module.params['cache_ttl']
+            self.repository_cache = BitbucketCache(self.module.params['cache_dir'], 'repositories', ttl)
+            self.response_cache = BitbucketCache(self.module.params['cache_dir'], 'responses', ttl)
+            self.group_cache = BitbucketCache(self.module.params['cache_dir'], 'groups', ttl)
+        self.state_store = None
+        self.secured_store = None
+        if self.module.params['state_dir']:
+            self.state_store = BitbucketStateStore(self.module.params['state_dir'], self.workspace)
+            self.secured_store = BitbucketStateStore(self.module.params['state_dir'], self.workspace + '.secured')
+
+    def raising(self):
+        """
+        Return a helper that raises BitbucketError instead of failing the module, so the
+        caller can handle many resources and report the failures at the end. It shares the
+        connection pool, rate limiter, caches and metrics of this one.
+        """
+
+        helper = copy.copy(self)
+        helper.pages_fetched = 0
+        helper.raise_errors = True
+        return helper
+
+    def for_repository(self, repository):
+        """
+        Return a helper working on another repository of the workspace, see raising,
+        so many repositories can be handled concurrently.
+        """
+
+        helper = self.raising()
+        helper.repository = repository
+        return helper
+
+    def fail_json(self, **kwargs):
+        """
+        Fail the module, or raise BitbucketError for helpers returned by raising and
+        for_repository.
+        """
+
+        if self.raise_errors:
+            raise BitbucketError(kwargs.get('msg'))
+        self.report_metrics(kwargs)
+        self.module.fail_json(**kwargs)
+
+    @classmethod
+    def api_v1_url(cls, url):
+        """
+        Return the URL of the API v1 (groups and group privileges) matching url, the API v2
+        URL: the version at the end of the path is replaced, e.g. https://api.bitbucket.org/2.0
+        becomes https://api.bitbucket.org/1.0. Other URLs keep BITBUCKET_API_V1_URL.
+        """
+
+        url = url.rstrip('/')
+        if url.endswith('/2.0'):
+            return url[:-len('2.0')] + '1.0'
+        return cls.BITBUCKET_API_V1_URL
 
     @staticmethod
     def bitbucket_argument_spec():
@@ -88,96 +694,730 @@ class BitbucketHelper:
                 type='bool',
                 default=True),
             sleep=dict(
-                type='int',
+                type='float',
                 default=5),
+            max_sleep=dict(
+                type='float',
+                default=60),
             retries=dict(
                 type='int',
                 default=3),
+            rate_limit=dict(
+                type='float',
+                default=0),
+            pool_size=dict(
+                type='int',
+                default=10),
+            parallelism=dict(
+                type='int',
+                default=5),
+            page_size=dict(
+                type='int',
+                required=False,
+                default=None),
+            cache=dict(
+                type='bool',
+                default=False),
+            cache_dir=dict(
+                type='path',
+                default='~/.cache/i2btech.ops/bitbucket'),
+            cache_ttl=dict(
+                type='int',
+                default=300),
+            state_dir=dict(
+                type='path',
+                required=False,
+                default=None),
+            transport=dict(
+                type='str',
+                choices=['sync', 'async'],
+                default='sync'),
+            metrics_file=dict(
+                type='path',
+                required=False,
+                default=None),
+            partial_response=dict(
+                type='bool',
+                default=True),
         )
 
-    def request(
-        self,
-        api_url,
-        module,
-        method,
-        data=None,
-        headers=None):
+    def request(
+        self,
+        api_url,
+        module,
+        method,
+        data=None,
+        headers=None):
+        """
+        Function to interact with Bitbucket API
+        """
+
+        data, headers, cache_key, cached = self._prepare_request(api_url, module, method, data, headers)
+
+        started = time.monotonic()
+        retries = 1
+        while True:
+            self.rate_limiter.acquire()
+            body, info = self._fetch(api_url, module, method, data, headers)
+            delay = self._retry_delay(retries, method, info)
+            if delay is None:
+                break
+            time.sleep(delay)
+            retries += 1
+
+        self._record(method, api_url, info, body, retries, started)
+        return self._complete_request(info, body, cache_key, cached, retries)
+
+    async def request_async(
+        self,
+        api_url,
+        module,
+        method,
+        data=None,
+        headers=None):
+        """
+        Same as request, to be awaited. The request goes through the asyncio transport when
+        the transport option is async, otherwise it is sent from a worker thread.
+        """
+
+        data, headers, cache_key, cached = self._prepare_request(api_url, module, method, data, headers)
+
+        started = time.monotonic()
+        retries = 1
+        while True:
+            wait = self.rate_limiter.reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            body, info = await self._fetch_async(api_url, module, method, data, headers)
+            delay = self._retry_delay(retries, method, info)
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+            retries += 1
+
+        self._record(method, api_url, info, body, retries, started)
+        return self._complete_request(info, body, cache_key, cached, retries)
+
+    def _record(self, method, api_url, info, body, retries, started):
+        self.metrics.record(
+            method,
+            api_url,
+            info['status'] if info is not None else None,
+            len(body) if body else 0,
+            retries,
+            time.monotonic() - started,
+        )
+
+    def report_metrics(self, result):
+        """
+        Add the summary of the requests sent to result['metrics'], and append every request
+        to the metrics_file option as JSON lines when it is set.
+        """
+
+        result['metrics'] = self.metrics.summary()
+        if self.module.params['metrics_file']:
+            self.metrics.write(
+                self.module.params['metrics_file'],
+                module=getattr(self.module, '_name', None),
+                workspace=self.workspace,
+                repository=self.repository,
+            )
+
+    def _prepare_request(self, api_url, module, method, data, headers):
+        """
+        Add authentication, encode the payload and the validators of the conditional GET.
+        Returns the data and headers to send, and the cache key and entry of the response.
+        """
+
+        headers = headers or {}
+
+        if module.params['username']:
+            headers.update({
+                'Authorization': basic_auth_header(module.params['username'], module.params['password'])
+            })
+
+        if isinstance(data, dict):
+            data = module.jsonify(data)
+            if 'Content-type' not in headers:
+                headers.update({
+                    'Content-type': 'application/json',
+                })
+
+        # conditional GET: send the validators of the last response we got for this URL,
+        # a 304 means the cached body is still current
+        cached = None
+        cache_key = None
+        if method == 'GET' and self.response_cache is not None:
+            cache_key = '{}\n{}'.format(module.params['username'], api_url)
+            cached = self.response_cache.get(cache_key)
+            if cached and cached.get('etag'):
+                headers.setdefault('If-None-Match', cached['etag'])
+            if cached and cached.get('last_modified'):
+                headers.setdefault('If-Modified-Since', cached['last_modified'])
+
+        return data, headers, cache_key, cached
+
+    def _retry_delay(self, attempt, method, info):
+        """
+        Seconds to wait before sending the request again, None when it must not be retried.
+        """
+
+        if info is not None and info.get('x-ratelimit-nearlimit', '').lower() == 'true':
+            self.rate_limiter.slow_down()
+        if not self.retry_policy.should_retry(attempt, method, info):
+            return None
+        delay = self.retry_policy.delay(attempt, info)
+        if info is not None and info['status'] == 429:
+            # every request waits, not only the one that got throttled
+            self.rate_limiter.defer(delay)
+            return 0
+        return delay
+
+    def _complete_request(self, info, body, cache_key, cached, retries):
+        """
+        Serve a 304 from the cache, store cacheable answers and decode the body.
+        """
+
+        if cache_key is not None and info is not None:
+            if info['status'] == 304 and cached:
+                body = cached['body']
+                info['status'] = 200
+                info['not_modified'] = True
+            elif info['status'] == 200 and body is not None and (info.get('etag') or info.get('last-modified')):
+                self.response_cache.set(cache_key, dict(
+                    etag=info.get('etag'),
+                    last_modified=info.get('last-modified'),
+                    body=to_text(body),
+                ))
+
+        content = {}
+
+        if body is not None:
+
+            body = to_text(body)
+            if body:
+                try:
+                    body_js = json.loads(body)
+                    if isinstance(body_js, dict):
+                        content = body_js
+                    else:
+                        content['json'] = body_js
+                except ValueError as exc:
+                    content['content'] = body
+
+        content['fetch_url_retries'] = retries
+
+        return info, content
+
+    def _fetch(self, api_url, module, method, data, headers):
+        """
+        Send a single request, through the connection pool when possible.
+        Returns the raw response body (None on error) and the info dict.
+        """
+
+        if self.pool.handles(api_url, module.params['use_proxy']):
+            return self.pool.fetch(api_url, method, data=data, headers=headers)
+
+        response, info = fetch_url(
+            module=module,
+            url=api_url,
+            method=method,
+            headers=headers,
+            data=data,
+            force=True,
+            use_proxy=module.params['use_proxy']
+        )
+        # 304 Not Modified is reported by urllib as an error too
+        if response is None or info['status'] >= 300:
+            return None, info
+        return response.read(), info
+
+    async def _fetch_async(self, api_url, module, method, data, headers):
+        """
+        Same as _fetch, to be awaited.
+        """
+
+        if self.transport is not None and self.transport.handles(api_url, module.params['use_proxy']):
+            return await self.transport.fetch(api_url, method, data=data, headers=headers)
+
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self._fetch, api_url, module, method, data, headers)
+
+    def run_async(self, coro):
+        """
+        Run a coroutine of this helper from regular code and return its result: on the
+        event loop of the asyncio transport when enabled, otherwise on a new event loop.
+        Coroutines raise BitbucketError instead of failing the module, the caller decides
+        whether to call fail_json.
+        """
+
+        if self.transport is not None:
+            return self.transport.run(coro)
+        return asyncio.run(coro)
+
+    def mutation(self, label, method, api_url, data=None, expected=(200,), headers=None):
+        """
+        Describe a single write against the API, it is sent later by run_mutation.
+        label: human readable description used in the module result, must not contain secrets.
+        expected: list of HTTP status that mean success.
+        """
+
+        return dict(
+            label=label,
+            method=method,
+            url=api_url,
+            data=data,
+            headers=headers,
+            expected=tuple(expected),
+        )
+
+    def run_mutation(self, mutation):
+        """
+        Send a mutation and return its outcome, never calls fail_json so it is safe to use
+        from worker threads.
+        """
+
+        try:
+            info, content = self.request(
+                mutation['url'],
+                module=self.module,
+                method=mutation['method'],
+                data=mutation['data'],
+                headers=dict(mutation['headers'] or {}),
+            )
+        except Exception as exc:
+            return self._mutation_outcome(mutation, error=exc)
+
+        return self._mutation_outcome(mutation, info, content)
+
+    async def run_mutation_async(self, mutation):
+        """
+        Same as run_mutation, to be awaited.
+        """
+
+        try:
+            info, content = await self.request_async(
+                mutation['url'],
+                module=self.module,
+                method=mutation['method'],
+                data=mutation['data'],
+                headers=dict(mutation['headers'] or {}),
+            )
+        except Exception as exc:
+            return self._mutation_outcome(mutation, error=exc)
+
+        return self._mutation_outcome(mutation, info, content)
+
+    def _mutation_outcome(self, mutation, info=None, content=None, error=None):
+        outcome = dict(
+            label=mutation['label'],
+            method=mutation['method'],
+            ok=False,
+            status=None,
+            content={},
+            msg='',
+        )
+        if error is not None:
+            outcome['msg'] = to_native(error)
+            return outcome
+
+        outcome['status'] = info['status']
+        outcome['content'] = content
+        outcome['ok'] = info['status'] in mutation['expected']
+        if not outcome['ok']:
+            outcome['msg'] = error_messages['unknown_error'].format(info=info)
+        else:
+            self.record_secured_digest(mutation, content)
+        return outcome
+
+    def record_secured_digest(self, mutation, content):
+        """
+        Remember the digest of the value sent by a successful secured variable mutation,
+        keyed by the uuid of the variable (taken from the answer for a creation).
+        """
+
+        if self.secured_store is None or 'variable_uuid' not in mutation:
+            return
+
+        if mutation['method'] == 'DELETE':
+            self.secured_store.delete(mutation['variable_uuid'])
+            return
+
+        uuid = mutation['variable_uuid'] or content.get('uuid')
+        if uuid and mutation.get('digest'):
+            self.secured_store.set(uuid, dict(digest=mutation['digest']))
+
+    def run_mutations(self, mutations, parallelism=None):
+        """
+        Send independent mutations on a bounded thread pool.
+        Returns one outcome per mutation, in the same order they were given.
+        """
+
+        mutations = list(mutations)
+
+        # the asyncio transport bounds the requests in flight itself, no threads needed
+        if self.transport is not None and len(mutations) > 1:
+            try:
+                return self.run_async(self.run_mutations_async(mutations))
+            except BitbucketError as exc:
+                # the outcome of each mutation is unknown, report all of them as failed
+                return [self._mutation_outcome(m, error=exc) for m in mutations]
+
+        workers = min(parallelism or self.module.params['parallelism'], len(mutations))
+        if workers <= 1:
+            return [self.run_mutation(m) for m in mutations]
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(self.run_mutation, mutations))
+
+    async def run_mutations_async(self, mutations):
+        """
+        Send independent mutations concurrently, to be awaited. With the asyncio transport
+        at most pool_size of them are in flight.
+        Returns one outcome per mutation, in the same order they were given.
+        """
+
+        return list(await asyncio.gather(*[self.run_mutation_async(m) for m in mutations]))
+
+    def execute_mutation(self, mutation):
+        """
+        Send a single mutation and fail the module if it is not successful.
+        """
+
+        outcome = self.run_mutation(mutation)
+        if not outcome['ok']:
+            self.fail_json(msg=outcome['msg'])
+        return outcome['content']
+
+    def apply_mutations(self, result, mutations):
+        """
+        Send the mutations computed by a module concurrently and record the outcome of each
+        one under result['mutations']. The module fails once every mutation has been sent
+        if any of them was not successful.
+        In check mode nothing is sent, the mutations are recorded under result['plan'].
+        """
+
+        if self.module.check_mode:
+            self.plan(result, mutations)
+            return []
+
+        outcomes = self.run_mutations(mutations)
+        self.record_outcomes(result, outcomes)
+        self.fail_on_outcomes(result, outcomes)
+
+        return outcomes
+
+    @staticmethod
+    def record_outcomes(result, outcomes):
+        """
+        Record the outcome of each mutation sent under result['mutations'].
+        """
+
+        result.setdefault('mutations', [])
+        for outcome in outcomes:
+            result['mutations'].append(dict(
+                label=outcome['label'],
+                status=outcome['status'],
+                ok=outcome['ok'],
+                msg=outcome['msg'],
+            ))
+            if outcome['ok']:
+                result['changed'] = True
+
+    def fail_on_outcomes(self, result, outcomes):
+        """
+        Fail the module if any of the mutations sent was not successful.
+        """
+
+        failed = [o for o in outcomes if not o['ok']]
+        if failed:
+            self.fail_json(
+                msg='{} of {} changes failed'.format(len(failed), len(outcomes)),
+                **result
+            )
+
+    @staticmethod
+    def plan(result, mutations):
+        """
+        Record the mutations that would be sent under result['plan'], used in check mode.
+        """
+
+        result.setdefault('plan', [])
+        for mutation in mutations:
+            result['plan'].append(dict(
+                label=mutation['label'],
+                method=mutation['method'],
+                url=mutation['url'],
+            ))
+            result['changed'] = True
+
+    @staticmethod
+    def with_query(api_url, **params):
+        """
+        Return api_url with the given query parameters set, replacing existing values.
+        """
+
+        parts = urlsplit(api_url)
+        query = [(k, v) for k, v in parse_qsl(parts.query) if k not in params]
+        query.extend((k, str(v)) for k, v in params.items())
+        return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), parts.fragment))
+
+    def with_fields(self, api_url, resource):
+        """
+        Return api_url asking only for the keys of BITBUCKET_API_FIELDS[resource], plus the
+        pagination keys for a listing, unless the partial_response option is disabled.
+        """
+
+        if not self.module.params['partial_response']:
+            return api_url
+
+        fields = list(self.BITBUCKET_API_FIELDS[resource])
+        if resource in self.BITBUCKET_API_MAX_PAGELEN:
+            fields.extend(self.BITBUCKET_API_PAGINATION_FIELDS)
+        return self.with_query(api_url, fields=','.join(fields))
+
+    def listing_url(self, api_url, listing):
+        """
+        Return the URL of the first page of a listing, with the page size and fields to request.
+        """
+
+        return self.with_fields(self.with_query(api_url, pagelen=self.pagelen(listing)), listing)
+
+    def page_url(self, api_url, page):
+        """
+        Return api_url pointing to the given page number of a listing.
+        """
+
+        return self.with_query(api_url, page=page)
+
+    def pagelen(self, listing):
+        """
+        Page size to request for a listing: the largest one accepted by the endpoint,
+        or the page_size option when it is smaller.
+        """
+
+        max_pagelen = self.BITBUCKET_API_MAX_PAGELEN[listing]
+        if self.module.params['page_size']:
+            return min(self.module.params['page_size'], max_pagelen)
+        return max_pagelen
+
+    def _get_page(self, api_url):
+        """
+        Fetch a single page of a listing, fail the module if it can't be read.
+        """
+
+        info, content = self._fetch_page(api_url)
+
+        if info['status'] != 200:
+            self.fail_json(
+                msg=error_messages['unknown_error'].format(info=info)
+            )
+
+        return content
+
+    def iter_paginated(self, api_url, listing):
+        """
+        Yield every item of a paginated listing as soon as its page arrives.
+        listing: key of BITBUCKET_API_MAX_PAGELEN, sets the page size and the fields requested.
+        When the first page reports `size` and `pagelen` the remaining pages are requested
+        concurrently by page number, keeping at most `parallelism` pages in flight,
+        otherwise the `next` links are followed one by one.
+        """
+
+        api_url = self.listing_url(api_url, listing)
+        content = self._get_page(api_url)
+        self.pages_fetched += 1
+        for value in content.get('values', []):
+            yield value
+
+        size = content.get('size')
+        pagelen = content.get('pagelen')
+        if size is not None and pagelen:
+            first_page = content.get('page', 1)
+            last_page = -(-size // pagelen)
+            if self.transport is not None:
+                urls = [self.page_url(api_url, page) for page in range(first_page + 1, last_page + 1)]
+                try:
+                    pages_content = self.run_async(self._get_pages_async(urls))
+                except BitbucketError as error:
+                    self.fail_json(msg=to_native(error))
+                for page_content in pages_content:
+                    for value in page_content.get('values', []):
+                        yield value
+                return
+
+            pages = iter(range(first_page + 1, last_page + 1))
+            workers = max(1, self.module.params['parallelism'])
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                pending = deque(
+                    executor.submit(self._fetch_page, self.page_url(api_url, page))
+                    for page in islice(pages, workers)
+                )
+                while pending:
+                    info, page_content = pending.popleft().result()
+                    if info['status'] != 200:
+                        self.fail_json(
+                            msg=error_messages['unknown_error'].format(info=info)
+                        )
+                    self.pages_fetched += 1
+                    page = next(pages, None)
+                    if page is not None:
+                        pending.append(executor.submit(self._fetch_page, self.page_url(api_url, page)))
+                    for value in page_content.get('values', []):
+                        yield value
+            return
+
+        while 'next' in content:
+            content = self._get_page(content['next'])
+            self.pages_fetched += 1
+            for value in content.get('values', []):
+                yield value
+
+    def get_paginated(self, api_url, listing):
+        """
+        Retrieve every item of a paginated listing as a list, see iter_paginated.
+        """
+
+        return list(self.iter_paginated(api_url, listing))
+
+    async def _get_page_async(self, api_url):
+        """
+        Same as _get_page, to be awaited, counts the page read.
+        Raises BitbucketError if the page can't be read.
+        """
+
+        info, content = await self.request_async(
+            api_url,
+            module=self.module,
+            method='GET',
+        )
+
+        if info['status'] != 200:
+            raise BitbucketError(error_messages['unknown_error'].format(info=info))
+
+        self.pages_fetched += 1
+        return content
+
+    async def _get_pages_async(self, urls):
+        return await asyncio.gather(*[self._get_page_async(url) for url in urls])
+
+    def _fetch_page(self, api_url):
+        """
+        Fetch a page from a worker thread, the caller checks the status.
+        """
+
+        return self.request(
+            api_url,
+            module=self.module,
+            method='GET',
+        )
+
+    def listing_token(self, api_url, listing):
+        """
+        Describe the remote state of a listing with a single request: the ETag of its first
+        page when the API sends one, otherwise a hash of the first page and the total size.
+        Returns None when the page can't be read, or when the listing has more than one
+        page: the token wouldn't cover the items of the other pages.
+        """
+
+        info, content = self._fetch_page(self.listing_url(api_url, listing))
+        self.pages_fetched += 1
+        if info['status'] != 200:
+            return None
+
+        size = content.get('size')
+        pagelen = content.get('pagelen')
+        if 'next' in content or (size is not None and pagelen and size > pagelen):
+            return None
+
+        if info.get('etag'):
+            return info['etag']
+
+        page = json.dumps([content.get('size'), content.get('values')], sort_keys=True)
+        return hashlib.sha256(page.encode('utf-8')).hexdigest()
+
+    def converged(self, api_url, listing, spec):
         """
-        Function to interact with Bitbucket API
+        Tell whether the listing at api_url was converged to spec by the last successful run
+        and hasn't changed since, in which case the full reconciliation can be skipped.
+        Always False when the state store (state_dir option) is disabled or when the
+        listing has more than one page.
         """
 
-        headers = headers or {}
+        if self.state_store is None:
+            return False
 
-        if module.params['username']:
-            headers.update({
-                'Authorization': basic_auth_header(module.params['username'], module.params['password'])
-            })
+        entry = self.state_store.get(api_url)
+        if not entry or entry.get('spec') != self.state_store.digest(spec):
+            return False
 
-        if isinstance(data, dict):
-            data = module.jsonify(data)
-            if 'Content-type' not in headers:
-                headers.update({
-                    'Content-type': 'application/json',
-                })
+        token = self.listing_token(api_url, listing)
+        return token is not None and entry.get('token') == token
 
-        retries = 1
-        while retries <= module.params['retries']:
-            response, info = fetch_url(
-                module=module,
-                url=api_url,
-                method=method,
-                headers=headers,
-                data=data,
-                force=True,
-                use_proxy=module.params['use_proxy']
-            )
-            if (info is not None) and (info['status'] != -1):
-                break
-            time.sleep(module.params['sleep'])
-            retries += 1
+    def mark_converged(self, api_url, listing, spec):
+        """
+        Record that the listing at api_url now matches spec, used by converged on the next run.
+        Nothing is recorded in check mode or when the state store is disabled.
+        """
 
-        content = {}
+        if self.state_store is None or self.module.check_mode:
+            return
 
-        if response is not None:
+        token = self.listing_token(api_url, listing)
+        if token is None:
+            self.state_store.delete(api_url)
+            return
 
-            body = to_text(response.read())
-            if body:
-                try:
-                    body_js = json.loads(body)
-                    if isinstance(body_js, dict):
-                        content = body_js
-                    else:
-                        content['json'] = body_js
-                except ValueError as exc:
-                    content['content'] = body
+        self.state_store.set(api_url, dict(
+            spec=self.state_store.digest(spec),
+            token=token,
+        ))
 
-        content['fetch_url_retries'] = retries
+    def _repository_cache_key(self):
+        return '{}/{}/{}'.format(self.module.params['url'], self.workspace, self.repository)
 
-        return info, content
+    def repository_url(self):
+        """
+        URL of the repository
+        """
+
+        return self.BITBUCKET_API_ENDPOINTS['repos'].format(
+            url=self.module.params['url'],
+            workspace=self.workspace,
+            repo_slug=self.repository
+        )
 
     def get_repository_info(self):
         """
         Get information of repository on Bitbucket
+        With the cache option, existing repositories are kept in the local cache for cache_ttl
+        seconds, so the existence check done by every module is only sent once per repository in a play.
         """
 
+        if self.repository_cache is not None:
+            content = self.repository_cache.get(self._repository_cache_key())
+            if content:
+                return content
+
         info, content = self.request(
-            api_url=self.BITBUCKET_API_ENDPOINTS['repos'].format(
-                url=self.BITBUCKET_API_URL,
-                workspace='i2b',
-                repo_slug=self.module.params['repository']
-            ),
+            api_url=self.with_fields(self.repository_url(), 'repository'),
             module=self.module,
             method='GET',
         )
 
+        return self._repository_info(info, content)
+
+    def _repository_info(self, info, content):
         if info['status'] == 200:
+            if self.repository_cache is not None:
+                self.repository_cache.set(self._repository_cache_key(), content)
             return content
 
         if info['status'] == 404:
             return False
 
         if info['status'] != 200:
-            self.module.fail_json(
+            self.fail_json(
                 msg=error_messages['unknown_error'].format(
                     info=info,
                 )
@@ -185,46 +1425,42 @@ class BitbucketHelper:
 
         return None
 
-    def create_repository(self):
+    def create_repository(self, project_key=None):
         """
         Create a bitbucket repository
+        project_key: defaults to the project_key option of the module
         """
 
+        mutation = self.repository_mutation(project_key)
         info, content = self.request(
-            api_url=self.BITBUCKET_API_ENDPOINTS['repos'].format(
-                url=self.BITBUCKET_API_URL,
-                workspace='i2b',
-                repo_slug=self.module.params['repository']
-            ),
+            api_url=mutation['url'],
             module=self.module,
-            method='POST',
-            data={
-                'project': ({
-                    'key': self.module.params['project_key'],
-                }),
-                'is_private': True
-            },
+            method=mutation['method'],
+            data=mutation['data'],
         )
 
+        if self.repository_cache is not None:
+            self.repository_cache.delete(self._repository_cache_key())
+
         if info['status'] == 200:
             return True
 
         if info['status'] == 400:
-            self.module.fail_json(
+            self.fail_json(
                 msg=error_messages['insufficient_permissions_to_create'].format(
-                    repositorySlug=self.module.params['repository'],
+                    repositorySlug=self.repository,
                 )
             )
 
         if info['status'] == 401:
-            self.module.fail_json(
+            self.fail_json(
                 msg=error_messages['validation_error'].format(
-                    repositorySlug=self.module.params['repository'],
+                    repositorySlug=self.repository,
                 )
             )
 
         if info['status'] != 200:
-            self.module.fail_json(
+            self.fail_json(
                 msg=error_messages['unknown_error'].format(
                     info=info,
                 )
@@ -232,6 +1468,27 @@ class BitbucketHelper:
 
         return None
 
+    def repository_mutation(self, project_key=None):
+        """
+        Build the mutation used by create_repository
+        """
+
+        return self.mutation(
+            label='create repository {}'.format(self.repository),
+            method='POST',
+            api_url=self.BITBUCKET_API_ENDPOINTS['repos'].format(
+                url=self.module.params['url'],
+                workspace=self.workspace,
+                repo_slug=self.repository
+            ),
+            data={
+                'project': ({
+                    'key': project_key or self.module.params['project_key'],
+                }),
+                'is_private': True
+            },
+        )
+
     def get_repository_permissions_info(
         self,
         scope=None):
@@ -240,61 +1497,50 @@ class BitbucketHelper:
         scope: either 'users' or 'groups'.
         """
 
-        permissions = []
-        is_last_page = False
-        api_url=None
+        return list(self.iter_permissions(scope))
+
+    def permissions_url(self, scope=None):
+        """
+        URL of the user (scope 'user') or group permissions of the repository
+        """
 
         if scope == "user":
-            api_url=self.BITBUCKET_API_ENDPOINTS['repos-permissions-users'].format(
+            return self.BITBUCKET_API_ENDPOINTS['repos-permissions-users'].format(
                         url=self.module.params['url'],
-                        workspace='i2b',
-                        repo_slug=self.module.params['repository'])
-        else:
-            api_url=self.BITBUCKET_API_ENDPOINTS['repos-permissions-groups'].format(
-                        url=self.module.params['url'],
-                        workspace='i2b',
-                        repo_slug=self.module.params['repository'])
+                        workspace=self.workspace,
+                        repo_slug=self.repository)
 
-        while not is_last_page:
-            info, content = self.request(
-                api_url,
-                module=self.module,
-                method='GET',
-            )
+        return self.BITBUCKET_API_ENDPOINTS['repos-permissions-groups'].format(
+                    url=self.module.params['url'],
+                    workspace=self.workspace,
+                    repo_slug=self.repository)
 
-            for value in content['values']:
-                perm = {}
-                if scope == "user":
-                    perm =	{
-                        "type": scope,
-                        "name": value['user']['nickname'],
-                        "perm": value['permission']
-                    }
-                else:
-                    perm =	{
-                        "type": scope,
-                        "name": value['group']['slug'],
-                        "perm": value['permission']
-                    }
-
-                permissions.extend([perm])
-
-            if 'next' in content:
-                api_url = content['next']
-            else:
-                is_last_page = True
+    def iter_permissions(
+        self,
+        scope=None):
+        """
+        Yield users or groups that have been granted at least one permission for the specified repository,
+        page by page.
+        scope: either 'users' or 'groups'.
+        """
 
-        if info['status'] == 200:
-            return permissions
+        for value in self.iter_paginated(self.permissions_url(scope), 'permissions'):
+            yield self._permission(scope, value)
 
-        if info['status'] != 200:
-            self.module.fail_json(
-                msg=error_messages['unknown_error'].format(
-                    info=info,
-                )
-            )
+    @staticmethod
+    def _permission(scope, value):
+        if scope == "user":
+            return {
+                "type": scope,
+                "name": value['user']['nickname'],
+                "perm": value['permission']
+            }
 
-        return None
+        return {
+            "type": scope,
+            "name": value['group']['slug'],
+            "perm": value['permission']
+        }
 
     def apply_repository_permissions(
         self,
@@ -307,11 +1553,24 @@ class BitbucketHelper:
         scope: either 'user' or 'group'.
         """
 
+        return self.execute_mutation(
+            self.repository_permission_mutation(action, scope, name, perm))
+
+    def repository_permission_mutation(
+        self,
+        action,
+        scope,
+        name,
+        perm=None):
+        """
+        Build the mutation used by apply_repository_permissions
+        """
+
         if scope == "group":
             api_url=self.BITBUCKET_API_ENDPOINTS['repos-permissions-groups'].format(
                         url=self.module.params['url'],
-                        workspace='i2b',
-                        repo_slug=self.module.params['repository'])
+                        workspace=self.workspace,
+                        repo_slug=self.repository)
 
         if action == "promote":
             api_verb = 'PUT'
@@ -322,58 +1581,92 @@ class BitbucketHelper:
             api_verb = 'DELETE'
             api_data = {}
 
+        return self.mutation(
+            label='{} {} {}'.format(action, scope, name),
+            method=api_verb,
+            api_url=api_url + '/' + name,
+            data=api_data,
+            expected=(200, 204),
+        )
+
+    def enable_repository_pipeline(
+        self,
+        ):
+        """
+        Enable pipeline on repository
+        """
+
+        return self.execute_mutation(self.repository_pipeline_mutation(True))
+
+    def get_repository_pipeline(self):
+        """
+        Get the pipeline configuration of the repository
+        """
+
         info, content = self.request(
-            api_url + '/' + name,
+            self.with_fields(self.BITBUCKET_API_ENDPOINTS['repos-pipeline'].format(
+                url=self.module.params['url'],
+                workspace=self.workspace,
+                repo_slug=self.repository), 'pipelines'),
             module=self.module,
-            method=api_verb,
-            data=api_data
+            method='GET',
         )
 
-        if info['status'] == 200 or info['status'] == 204:
+        return self._repository_pipeline(info, content)
+
+    def _repository_pipeline(self, info, content):
+        if info['status'] == 200:
             return content
 
-        if info['status'] != 200:
-            self.module.fail_json(
-                msg=error_messages['unknown_error'].format(
-                    info=info,
-                )
-            )
+        # pipelines were never configured on the repository
+        if info['status'] == 404:
+            return {'enabled': False}
+
+        self.fail_json(
+            msg=error_messages['unknown_error'].format(info=info)
+        )
 
         return None
 
-    def enable_repository_pipeline(
-        self,
-        ):
+    def repository_pipeline_mutation(self, enabled):
         """
-        Enable pipeline on repository
+        Build the mutation that enables or disables pipelines on the repository
         """
 
         api_url=self.BITBUCKET_API_ENDPOINTS['repos-pipeline'].format(
-            url=self.BITBUCKET_API_URL,
-            workspace='i2b',
-            repo_slug=self.module.params['repository']
+            url=self.module.params['url'],
+            workspace=self.workspace,
+            repo_slug=self.repository
         )
 
-        info, content = self.request(
-            api_url,
-            module=self.module,
+        return self.mutation(
+            label='{} pipelines'.format('enable' if enabled else 'disable'),
             method='PUT',
+            api_url=api_url,
             data={
-                'enabled': True
+                'enabled': enabled
             },
         )
 
-        if info['status'] == 200:
-            return content
+    def repository_variables_url(self):
+        """
+        URL of the pipeline variables of the repository
+        """
 
-        if info['status'] != 200:
-            self.module.fail_json(
-                msg=error_messages['unknown_error'].format(
-                    info=info,
-                )
-            )
+        return self.BITBUCKET_API_ENDPOINTS['repos-pipeline'].format(
+            url=self.module.params['url'],
+            workspace=self.workspace,
+            repo_slug=self.repository) + "/variables/"
 
-        return None
+    def environment_variables_url(self, env_uuid):
+        """
+        URL of the variables of a deployment environment of the repository
+        """
+
+        return self.BITBUCKET_API_ENDPOINTS['repos-deployments'].format(
+            url=self.module.params['url'],
+            workspace=self.workspace,
+            repo_slug=self.repository) + "/environments/" + env_uuid + "/variables"
 
     def get_variables(
         self,
@@ -382,49 +1675,19 @@ class BitbucketHelper:
         Retrieve all variables for the specified repository.
         """
 
-        variables = []
-        is_last_page = False
-        current_page = 1
-        current_size = 0
-        api_url_base = api_url
-        while not is_last_page:
-            info, content = self.request(
-                api_url,
-                module=self.module,
-                method='GET',
-            )
-
-            if 'values' in content:
-                variables.extend(content['values'])
-
-            # temporary logic to paginate over the response
-            if 'next' in content:
-                current_page = sum([current_page, 1])
-                api_url = api_url_base + "?page=" + str(current_page)
-
-            current_size = sum([current_size, content['pagelen']])
-            if current_size >= content['size']:
-                is_last_page = True
-
-            # this is the logic we need to use to paginate over the response
-            # but the URL included in the "next" option is currently not working
-            # https://jira.atlassian.com/browse/BCLOUD-13806
-            # if 'next' in content:
-            #     api_url = content['next']
-            # else:
-            #     is_last_page = True
-
-        if info['status'] == 200:
-            return variables
+        return list(self.iter_variables(api_url))
 
-        if info['status'] != 200:
-            self.module.fail_json(
-                msg=error_messages['unknown_error'].format(
-                    info=info,
-                )
-            )
+    def iter_variables(
+        self,
+        api_url):
+        """
+        Yield the variables of a repository or deployment environment, page by page.
+        """
 
-        return None
+        # the URL included in the "next" option is currently not working for variables
+        # https://jira.atlassian.com/browse/BCLOUD-13806
+        # iter_paginated builds the page URLs from "size" and "pagelen" instead
+        return self.iter_paginated(api_url, 'variables')
 
     def manage_repository_variables(
         self,
@@ -437,10 +1700,24 @@ class BitbucketHelper:
         CRUD variables on repository
         """
 
+        return self.execute_mutation(
+            self.repository_variable_mutation(action, name, value, uuid, secured))
+
+    def repository_variable_mutation(
+        self,
+        action,
+        name,
+        value,
+        uuid=None,
+        secured=False):
+        """
+        Build the mutation used by manage_repository_variables
+        """
+
         api_url=self.BITBUCKET_API_ENDPOINTS['repos-pipeline'].format(
                     url=self.module.params['url'],
-                    workspace='i2b',
-                    repo_slug=self.module.params['repository'])
+                    workspace=self.workspace,
+                    repo_slug=self.repository)
 
         if action == "create":
             api_verb = 'POST'
@@ -450,6 +1727,7 @@ class BitbucketHelper:
                 'secured': secured
             }
             api_path="/variables/"
+            expected = (200, 201)
         elif action == "update":
             api_verb = 'PUT'
             api_data={
@@ -459,37 +1737,34 @@ class BitbucketHelper:
                 'uuid': uuid
             }
             api_path="/variables/" + uuid
+            expected = (200,)
         elif action == "delete":
             api_verb = 'DELETE'
             api_data={}
             api_path="/variables/" + uuid
+            expected = (200, 204)
 
-        info, content = self.request(
-            api_url + api_path,
-            module=self.module,
+        # error 409: A variable with the provided key already exists.
+
+        mutation = self.mutation(
+            label='{} variable {}'.format(action, name or uuid),
             method=api_verb,
-            data=api_data
+            api_url=api_url + api_path,
+            data=api_data,
+            expected=expected,
         )
 
-        if info['status'] == 200:
-            return content
-
-        if info['status'] == 201 and action == "create":
-            return content
-
-        if info['status'] == 204 and action == "delete":
-            return content
-
-        if info['status'] != 200:
-            self.module.fail_json(
-                msg=error_messages['unknown_error'].format(
-                    info=info,
-                )
-            )
+        return self.track_secured_variable(mutation, action, value, uuid, secured)
 
-        # error 409: A variable with the provided key already exists.
+    def track_secured_variable(self, mutation, action, value, uuid, secured):
+        """
+        Add to a variable mutation what record_secured_digest needs once it has been sent.
+        """
 
-        return None
+        mutation['variable_uuid'] = uuid
+        if self.secured_store is not None and secured and action != 'delete':
+            mutation['digest'] = self.secured_store.digest([value, secured])
+        return mutation
 
     def get_repository_environments(
         self):
@@ -497,40 +1772,25 @@ class BitbucketHelper:
         Retrieve all environments for the specified repository.
         """
 
-        variables = []
-        is_last_page = False
-
-        api_url=self.BITBUCKET_API_ENDPOINTS['repos-environments'].format(
-                    url=self.module.params['url'],
-                    workspace='i2b',
-                    repo_slug=self.module.params['repository'])
-
-        while not is_last_page:
-            info, content = self.request(
-                api_url + "/",
-                module=self.module,
-                method='GET',
-            )
-
-            if 'values' in content:
-                variables.extend(content['values'])
+        return list(self.iter_environments())
 
-            if 'next' in content:
-                api_url = content['next']
-            else:
-                is_last_page = True
+    def environments_url(self):
+        """
+        URL of the deployment environments of the repository
+        """
 
-        if info['status'] == 200:
-            return variables
+        return self.BITBUCKET_API_ENDPOINTS['repos-environments'].format(
+                    url=self.module.params['url'],
+                    workspace=self.workspace,
+                    repo_slug=self.repository) + "/"
 
-        if info['status'] != 200:
-            self.module.fail_json(
-                msg=error_messages['unknown_error'].format(
-                    info=info,
-                )
-            )
+    def iter_environments(
+        self):
+        """
+        Yield the environments of the specified repository, page by page.
+        """
 
-        return None
+        return self.iter_paginated(self.environments_url(), 'environments')
 
     def manage_repository_environments(
         self,
@@ -542,10 +1802,23 @@ class BitbucketHelper:
         CRUD environments on repository
         """
 
+        return self.execute_mutation(
+            self.environment_mutation(action, name, category, uuid))
+
+    def environment_mutation(
+        self,
+        action,
+        name,
+        category=None,
+        uuid=None):
+        """
+        Build the mutation used by manage_repository_environments
+        """
+
         api_url=self.BITBUCKET_API_ENDPOINTS['repos-environments'].format(
                     url=self.module.params['url'],
-                    workspace='i2b',
-                    repo_slug=self.module.params['repository'])
+                    workspace=self.workspace,
+                    repo_slug=self.repository)
 
         if action == "create":
             api_verb = 'POST'
@@ -558,30 +1831,20 @@ class BitbucketHelper:
                 },
             }
             api_path="/"
+            expected = (201,)
         elif action == "delete":
-            api_verb = 'DELETE'
-            api_data={}
-            api_path="/" + uuid
-
-        info, content = self.request(
-            api_url + api_path,
-            module=self.module,
-            method=api_verb,
-            data=api_data
-        )
-
-        if info['status'] == 201 and action == "create":
-            return content
-        elif info['status'] == 204 and action == "delete":
-            return content
-        else:
-            self.module.fail_json(
-                msg=error_messages['unknown_error'].format(
-                    info=info,
-                )
-            )
+            api_verb = 'DELETE'
+            api_data={}
+            api_path="/" + uuid
+            expected = (204,)
 
-        return None
+        return self.mutation(
+            label='{} environment {}'.format(action, name or uuid),
+            method=api_verb,
+            api_url=api_url + api_path,
+            data=api_data,
+            expected=expected,
+        )
 
     def manage_environment_variables(
         self,
@@ -595,10 +1858,25 @@ class BitbucketHelper:
         CRUD variables on environment
         """
 
+        return self.execute_mutation(
+            self.environment_variable_mutation(action, name, value, env_uuid, var_uuid, secured))
+
+    def environment_variable_mutation(
+        self,
+        action,
+        name,
+        value,
+        env_uuid=None,
+        var_uuid=None,
+        secured=False):
+        """
+        Build the mutation used by manage_environment_variables
+        """
+
         api_url=self.BITBUCKET_API_ENDPOINTS['repos-deployments'].format(
                     url=self.module.params['url'],
-                    workspace='i2b',
-                    repo_slug=self.module.params['repository'])
+                    workspace=self.workspace,
+                    repo_slug=self.repository)
 
         if action == "create":
             api_verb = 'POST'
@@ -608,6 +1886,7 @@ class BitbucketHelper:
                 'secured': secured
             }
             api_path="/environments/" + env_uuid + "/variables"
+            expected = (200, 201)
         elif action == "update":
             api_verb = 'PUT'
             api_data={
@@ -617,72 +1896,48 @@ class BitbucketHelper:
                 'uuid': var_uuid
             }
             api_path="/environments/" + env_uuid + "/variables/" + var_uuid
+            expected = (200,)
         elif action == "delete":
             api_verb = 'DELETE'
             api_data={}
             api_path="/environments/" + env_uuid + "/variables/" + var_uuid
+            expected = (200, 204)
 
-        info, content = self.request(
-            api_url + api_path,
-            module=self.module,
+        # error 409: A variable with the provided key already exists.
+
+        mutation = self.mutation(
+            label='{} environment variable {}'.format(action, name or var_uuid),
             method=api_verb,
-            data=api_data
+            api_url=api_url + api_path,
+            data=api_data,
+            expected=expected,
         )
 
-        if info['status'] == 200:
-            return content
-
-        if info['status'] == 201 and action == "create":
-            return content
-
-        if info['status'] == 204 and action == "delete":
-            return content
-
-        if info['status'] != 200:
-            self.module.fail_json(
-                msg=error_messages['unknown_error'].format(
-                    info=info,
-                )
-            )
-
-        # error 409: A variable with the provided key already exists.
-
-        return None
+        return self.track_secured_variable(mutation, action, value, var_uuid, secured)
 
     def get_branch_restrictions(self):
         """
         Retrieve all branch restriction rules for the specified repository.
         """
 
-        restrictions = []
-        is_last_page = False
-
-        api_url = self.BITBUCKET_API_ENDPOINTS['repos-branch-restrictions'].format(
-            url=self.module.params['url'],
-            workspace='i2b',
-            repo_slug=self.module.params['repository'])
-
-        while not is_last_page:
-            info, content = self.request(
-                api_url,
-                module=self.module,
-                method='GET',
-            )
+        return list(self.iter_branch_restrictions())
 
-            if info['status'] != 200:
-                self.module.fail_json(
-                    msg=error_messages['unknown_error'].format(info=info)
-                )
+    def branch_restrictions_url(self):
+        """
+        URL of the branch restrictions of the repository
+        """
 
-            if 'values' in content:
-                restrictions.extend(content['values'])
+        return self.BITBUCKET_API_ENDPOINTS['repos-branch-restrictions'].format(
+            url=self.module.params['url'],
+            workspace=self.workspace,
+            repo_slug=self.repository)
 
-            if 'next' in content:
-                api_url = content['next']
-            else:
-                is_last_page = True
+    def iter_branch_restrictions(self):
+        """
+        Yield the branch restriction rules of the specified repository, page by page.
+        """
 
-        return restrictions
+        return self.iter_paginated(self.branch_restrictions_url(), 'branch-restrictions')
 
     def manage_branch_restriction(self, action, restriction_data=None, restriction_id=None):
         """
@@ -692,43 +1947,185 @@ class BitbucketHelper:
         restriction_id: int restriction ID (for update/delete)
         """
 
+        return self.execute_mutation(
+            self.branch_restriction_mutation(action, restriction_data, restriction_id))
+
+    def branch_restriction_mutation(self, action, restriction_data=None, restriction_id=None):
+        """
+        Build the mutation used by manage_branch_restriction
+        """
+
         api_url = self.BITBUCKET_API_ENDPOINTS['repos-branch-restrictions'].format(
             url=self.module.params['url'],
-            workspace='i2b',
-            repo_slug=self.module.params['repository'])
+            workspace=self.workspace,
+            repo_slug=self.repository)
 
         if action == 'create':
             api_verb = 'POST'
             api_path = ''
             api_data = restriction_data
+            expected = (201,)
+            label = 'create branch restriction {}'.format(restriction_data['kind'])
         elif action == 'update':
             api_verb = 'PUT'
             api_path = '/' + str(restriction_id)
             api_data = restriction_data
+            expected = (200,)
+            label = 'update branch restriction {}'.format(restriction_id)
         elif action == 'delete':
             api_verb = 'DELETE'
             api_path = '/' + str(restriction_id)
             api_data = {}
+            expected = (204,)
+            label = 'delete branch restriction {}'.format(restriction_id)
 
-        info, content = self.request(
-            api_url + api_path,
-            module=self.module,
+        return self.mutation(
+            label=label,
             method=api_verb,
+            api_url=api_url + api_path,
             data=api_data,
+            expected=expected,
         )
 
-        if action == 'create' and info['status'] == 201:
-            return content
-        if action == 'update' and info['status'] == 200:
-            return content
-        if action == 'delete' and info['status'] == 204:
-            return content
+    def plan_permissions(self, permissions, current=None):
+        """
+        Compute the mutations that make the group permissions of the repository match `permissions`.
+        current: current group permissions, read from the API when omitted.
+        """
 
-        self.module.fail_json(
+        if current is None:
+            current = self.iter_permissions(scope='group')
+
+        # only groups are managed
+        new_groups = [perm for perm in permissions or [] if perm['type'] == 'group']
+
+        mutations = []
+        for action, new, existing in reconcile(
+                new_groups,
+                current,
+                desired_key=lambda perm: perm['name'].casefold(),
+                current_key=lambda perm: perm['name'].casefold(),
+                differ=lambda new, existing: new['perm'].casefold() != existing['perm'].casefold()):
+            if action == 'delete':
+                # current group doesn't exists on new groups
+                mutations.append(self.repository_permission_mutation('demote', 'group', existing['name']))
+            else:
+                # group is missing or its permission is different
+                mutations.append(self.repository_permission_mutation('promote', 'group', new['name'], new['perm']))
+
+        return mutations
+
+    def plan_variables(self, variables, current=None):
+        """
+        Compute the mutations that make the pipeline variables of the repository match `variables`.
+        current: current variables, read from the API when omitted.
+        """
+
+        if current is None:
+            current = self.iter_variables(self.repository_variables_url())
+        return self._plan_variables(variables or [], current, self.repository_variable_mutation)
+
+    def plan_environment_variables(self, env_uuid, variables, current_variables):
+        """
+        Compute the mutations that make the variables of a deployment environment match `variables`.
+        """
+
+        def environment_mutation(action, name, value, var_uuid, secured):
+            return self.environment_variable_mutation(action, name, value, env_uuid, var_uuid, secured)
+
+        return self._plan_variables(variables or [], current_variables, environment_mutation)
+
+    def _variable_differs(self, new, current):
+        # the API never returns the value of a secured variable, compare the digest of the
+        # last value sent for it when the state store has one, otherwise always update it
+        if current['secured']:
+            if self.secured_store is None:
+                return True
+            entry = self.secured_store.get(current['uuid'])
+            return not entry or entry.get('digest') != self.secured_store.digest([new['value'], new['secured']])
+        # if not secured and value are different, update variable
+        return new['value'] != current['value']
+
+    def _plan_variables(self, new_variables, current_variables, build_mutation):
+        """
+        Diff desired against current variables, build_mutation(action, name, value, uuid, secured)
+        returns the mutation for a single variable.
+        """
+
+        mutations = []
+        for action, new, current in reconcile(
+                new_variables,
+                current_variables,
+                desired_key=lambda var: var['name'].casefold(),
+                current_key=lambda var: var['key'].casefold(),
+                differ=self._variable_differs):
+            if action == 'create':
+                mutations.append(build_mutation('create', new['name'], new['value'], None, new['secured']))
+            elif action == 'update':
+                mutations.append(build_mutation('update', new['name'], new['value'], current['uuid'], new['secured']))
+            else:
+                mutations.append(build_mutation('delete', None, None, current['uuid'], None))
+
+        return mutations
+
+    def find_environment(self, name, category):
+        """
+        Return the deployment environment with the given name and type, or None.
+        Stops reading pages as soon as the environment is found.
+        """
+
+        for x in self.iter_environments():
+            if name.lower() == x['name'].lower() and category.lower() == x['environment_type']['name'].lower():
+                return x
+
+        return None
+
+    def plan_restrictions(self, restrictions, current=None):
+        """
+        Compute the mutations that make the branch restrictions of the repository match `restrictions`.
+        current: current branch restrictions, read from the API when omitted.
+        """
+
+        if current is None:
+            current = self.iter_branch_restrictions()
+
+        mutations = []
+        for action, desired, existing in reconcile(
+                restrictions or [],
+                current,
+                desired_key=restriction_key,
+                current_key=restriction_key,
+                differ=restrictions_differ):
+            if action == 'create':
+                mutations.append(self.branch_restriction_mutation(
+                    action='create',
+                    restriction_data=restriction_payload(desired),
+                ))
+            elif action == 'update':
+                mutations.append(self.branch_restriction_mutation(
+                    action='update',
+                    restriction_data=restriction_payload(desired),
+                    restriction_id=existing['id'],
+                ))
+            else:
+                # Delete restrictions no longer in the desired list
+                mutations.append(self.branch_restriction_mutation(
+                    action='delete',
+                    restriction_id=existing['id'],
+                ))
+
+        return mutations
+
+    def _v1_listing(self, info, content):
+        if info['status'] == 200:
+            return content.get('json', [])
+
+        self.fail_json(
             msg=error_messages['unknown_error'].format(info=info)
         )
 
-        return None
+        return []
+
     def get_group_repo_privileges(self, workspace, group_owner, group_slug):
         """
         Get all repository privileges for a group using Bitbucket API v1.
@@ -738,7 +2135,7 @@ class BitbucketHelper:
         """
 
         api_url = '{}/group-privileges/{}/{}/{}'.format(
-            self.BITBUCKET_API_V1_URL, workspace, group_owner, group_slug
+            self.v1_url, workspace, group_owner, group_slug
         )
         info, content = self.request(
             api_url,
@@ -746,14 +2143,7 @@ class BitbucketHelper:
             method='GET',
         )
 
-        if info['status'] == 200:
-            return content.get('json', [])
-
-        self.module.fail_json(
-            msg=error_messages['unknown_error'].format(info=info)
-        )
-
-        return []
+        return self._v1_listing(info, content)
 
     def set_group_repo_privilege(self, workspace, repo_slug, group_owner, group_slug, privilege):
         """
@@ -763,70 +2153,190 @@ class BitbucketHelper:
         Returns the response content on success.
         """
 
+        return self.execute_mutation(self.group_privilege_mutation(
+            workspace, repo_slug, group_owner, group_slug, privilege))
+
+    def delete_group_repo_privilege(self, workspace, repo_slug, group_owner, group_slug):
+        """
+        Delete group privilege from a specific repository using Bitbucket API v1.
+        Returns True on success.
+        """
+
+        self.execute_mutation(self.group_privilege_mutation(
+            workspace, repo_slug, group_owner, group_slug))
+        return True
+
+    def group_privilege_mutation(self, workspace, repo_slug, group_owner, group_slug, privilege=None):
+        """
+        Build the mutation used by set_group_repo_privilege, or by
+        delete_group_repo_privilege when privilege is None.
+        """
+
         api_url = '{}/group-privileges/{}/{}/{}/{}'.format(
-            self.BITBUCKET_API_V1_URL, workspace, repo_slug, group_owner, group_slug
+            self.v1_url, workspace, repo_slug, group_owner, group_slug
         )
-        info, content = self.request(
-            api_url,
-            module=self.module,
+
+        if privilege is None:
+            return self.mutation(
+                label='delete privilege of group {} on {}'.format(group_slug, repo_slug),
+                method='DELETE',
+                api_url=api_url,
+                expected=(200, 204),
+            )
+
+        return self.mutation(
+            label='set {} privilege of group {} on {}'.format(privilege, group_slug, repo_slug),
             method='PUT',
+            api_url=api_url,
             data=privilege,
             headers={'Content-type': 'application/x-www-form-urlencoded'},
+            expected=(200, 201, 204),
         )
 
-        if info['status'] in (200, 201, 204):
-            return content
-
-        self.module.fail_json(
-            msg=error_messages['unknown_error'].format(info=info)
-        )
-
-        return None
+    def plan_group_repo_privileges(self, workspace, group_owner, group_slug, privileges, current):
+        """
+        Compute the mutations that make the repository privileges of a group match privileges,
+        a dict of privilege by repository slug. Repositories missing from it are revoked.
+        current: privileges returned by get_group_repo_privileges.
+        Returns a list of (repo_slug, privilege, mutation), privilege is None for a revoke.
+        """
 
-    def delete_group_repo_privilege(self, workspace, repo_slug, group_owner, group_slug):
+        # the 'repo' field from the API is in 'owner/repo-slug' format
+        current_map = {
+            entry['repo'].split('/')[-1]: entry['privilege']
+            for entry in current
+            if 'repo' in entry and 'privilege' in entry
+        }
+
+        changes = [
+            (repo_slug, privilege)
+            for repo_slug, privilege in privileges.items()
+            if current_map.get(repo_slug) != privilege
+        ] + [
+            (repo_slug, None)
+            for repo_slug in current_map
+            if repo_slug not in privileges
+        ]
+
+        return [
+            (repo_slug, privilege, self.group_privilege_mutation(
+                workspace, repo_slug, group_owner, group_slug, privilege))
+            for repo_slug, privilege in changes
+        ]
+
+    def apply_group_repo_privileges(self, result, workspace, group_owner, group_slug, privileges, current):
         """
-        Delete group privilege from a specific repository using Bitbucket API v1.
-        Returns True on success.
+        Reconcile the repository privileges of a group, the PUT and DELETE calls are sent
+        concurrently and the outcome of each one is recorded under result['mutations'].
+        result['repo_permissions'] is computed from current and the successful responses,
+        the privileges are only read again from the API when some call failed.
+        In check mode nothing is sent, the calls are recorded under result['plan'].
         """
 
-        api_url = '{}/group-privileges/{}/{}/{}/{}'.format(
-            self.BITBUCKET_API_V1_URL, workspace, repo_slug, group_owner, group_slug
-        )
-        info, content = self.request(
-            api_url,
-            module=self.module,
-            method='DELETE',
-        )
+        changes = self.plan_group_repo_privileges(workspace, group_owner, group_slug, privileges, current)
 
-        if info['status'] in (200, 204):
-            return True
+        if self.module.check_mode:
+            self.plan(result, [mutation for dummy, dummy, mutation in changes])
+            result['repo_permissions'] = current
+            return []
 
-        self.module.fail_json(
-            msg=error_messages['unknown_error'].format(info=info)
-        )
+        outcomes = self.run_mutations([mutation for dummy, dummy, mutation in changes])
+        self.record_outcomes(result, outcomes)
+
+        if all(outcome['ok'] for outcome in outcomes):
+            entries = dict(
+                (entry['repo'].split('/')[-1], entry)
+                for entry in current
+                if 'repo' in entry
+            )
+            for (repo_slug, privilege, dummy), outcome in zip(changes, outcomes):
+                if privilege is None:
+                    entries.pop(repo_slug, None)
+                    continue
+                # the API answers with the privileges set on the repository
+                entry = next((
+                    e for e in outcome['content'].get('json', [])
+                    if isinstance(e, dict) and e.get('repo', '').split('/')[-1] == repo_slug
+                ), None)
+                if entry is None:
+                    entry = dict(entries.get(repo_slug, {}))
+                    entry.update({
+                        'repo': '{}/{}'.format(workspace, repo_slug),
+                        'privilege': privilege,
+                    })
+                entries[repo_slug] = entry
+            result['repo_permissions'] = list(entries.values())
+        else:
+            result['repo_permissions'] = self.get_group_repo_privileges(workspace, group_owner, group_slug)
+
+        self.fail_on_outcomes(result, outcomes)
+
+        return outcomes
 
-        return False
     def get_groups(self, workspace):
         """
         Get all groups for a workspace using Bitbucket API v1.
         Returns a list of group dicts.
         """
 
-        api_url = '{}/groups/{}/'.format(self.BITBUCKET_API_V1_URL, workspace)
+        api_url = '{}/groups/{}/'.format(self.v1_url, workspace)
         info, content = self.request(
             api_url,
             module=self.module,
             method='GET',
         )
 
-        if info['status'] == 200:
-            return content.get('json', [])
+        return self._v1_listing(info, content)
 
-        self.module.fail_json(
-            msg=error_messages['unknown_error'].format(info=info)
-        )
+    def _group_inventory_key(self, workspace):
+        return '{}\n{}/{}'.format(self.module.params['username'], self.v1_url, workspace)
 
-        return []
+    def get_group_inventory(self, workspace):
+        """
+        Get the groups of a workspace indexed by slug.
+        The inventory is read once per process and, with the cache option, kept in the local
+        cache for cache_ttl seconds, it is dropped by create_group, update_group and delete_group.
+        """
+
+        key = self._group_inventory_key(workspace)
+        with self._group_inventories_lock:
+            inventory = self._group_inventories.get(key)
+        if inventory is not None:
+            return inventory
+
+        if self.group_cache is not None:
+            inventory = self.group_cache.get(key)
+
+        if inventory is None:
+            inventory = dict(
+                (group['slug'], group)
+                for group in self.get_groups(workspace)
+                if 'slug' in group
+            )
+            if self.group_cache is not None:
+                self.group_cache.set(key, inventory)
+
+        with self._group_inventories_lock:
+            self._group_inventories[key] = inventory
+        return inventory
+
+    def get_group(self, workspace, group_slug):
+        """
+        Get a group of a workspace from the group inventory, None when it doesn't exist.
+        """
+
+        return self.get_group_inventory(workspace).get(group_slug)
+
+    def invalidate_group_inventory(self, workspace):
+        """
+        Drop the group inventory of a workspace, the next lookup reads it from the API.
+        """
+
+        key = self._group_inventory_key(workspace)
+        with self._group_inventories_lock:
+            self._group_inventories.pop(key, None)
+        if self.group_cache is not None:
+            self.group_cache.delete(key)
 
     def create_group(self, workspace, name):
         """
@@ -835,24 +2345,9 @@ class BitbucketHelper:
         Returns the created group dict on success.
         """
 
-        api_url = '{}/groups/{}'.format(self.BITBUCKET_API_V1_URL, workspace)
-        form_data = urlencode({'name': name})
-        info, content = self.request(
-            api_url,
-            module=self.module,
-            method='POST',
-            data=form_data,
-            headers={'Content-type': 'application/x-www-form-urlencoded'},
-        )
-
-        if info['status'] in (200, 201):
-            return content
-
-        self.module.fail_json(
-            msg=error_messages['unknown_error'].format(info=info)
-        )
-
-        return None
+        content = self.execute_mutation(self.group_mutation('create', workspace, name=name))
+        self.invalidate_group_inventory(workspace)
+        return content
 
     def update_group(self, workspace, group_slug, name=None, permission=None):
         """
@@ -861,30 +2356,10 @@ class BitbucketHelper:
         Returns the updated group dict on success.
         """
 
-        api_url = '{}/groups/{}/{}/'.format(
-            self.BITBUCKET_API_V1_URL, workspace, group_slug
-        )
-        data = {}
-        if name is not None:
-            data['name'] = name
-        if permission is not None:
-            data['permission'] = permission
-
-        info, content = self.request(
-            api_url,
-            module=self.module,
-            method='PUT',
-            data=data,
-        )
-
-        if info['status'] == 200:
-            return content
-
-        self.module.fail_json(
-            msg=error_messages['unknown_error'].format(info=info)
-        )
-
-        return None
+        content = self.execute_mutation(self.group_mutation(
+            'update', workspace, group_slug, name=name, permission=permission))
+        self.invalidate_group_inventory(workspace)
+        return content
 
     def delete_group(self, workspace, group_slug):
         """
@@ -892,24 +2367,50 @@ class BitbucketHelper:
         Returns True on success.
         """
 
+        self.execute_mutation(self.group_mutation('delete', workspace, group_slug))
+        self.invalidate_group_inventory(workspace)
+        return True
+
+    def group_mutation(self, action, workspace, group_slug=None, name=None, permission=None):
+        """
+        Build the mutation used by create_group, update_group and delete_group
+        action: create|update|delete
+        """
+
+        if action == 'create':
+            return self.mutation(
+                label='create group {}'.format(name),
+                method='POST',
+                api_url='{}/groups/{}'.format(self.v1_url, workspace),
+                data=urlencode({'name': name}),
+                headers={'Content-type': 'application/x-www-form-urlencoded'},
+                expected=(200, 201),
+            )
+
         api_url = '{}/groups/{}/{}/'.format(
-            self.BITBUCKET_API_V1_URL, workspace, group_slug
-        )
-        info, content = self.request(
-            api_url,
-            module=self.module,
-            method='DELETE',
+            self.v1_url, workspace, group_slug
         )
 
-        if info['status'] in (200, 204):
-            return True
+        if action == 'update':
+            data = {}
+            if name is not None:
+                data['name'] = name
+            if permission is not None:
+                data['permission'] = permission
+            return self.mutation(
+                label='update group {}'.format(group_slug),
+                method='PUT',
+                api_url=api_url,
+                data=data,
+            )
 
-        self.module.fail_json(
-            msg=error_messages['unknown_error'].format(info=info)
+        return self.mutation(
+            label='delete group {}'.format(group_slug),
+            method='DELETE',
+            api_url=api_url,
+            expected=(200, 204),
         )
 
-        return False
-
     def get_group_members(self, workspace, group_slug):
         """
         Get all members of a group using Bitbucket API v1.
@@ -917,7 +2418,7 @@ class BitbucketHelper:
         """
 
         api_url = '{}/groups/{}/{}/members'.format(
-            self.BITBUCKET_API_V1_URL, workspace, group_slug
+            self.v1_url, workspace, group_slug
         )
         info, content = self.request(
             api_url,
@@ -925,14 +2426,48 @@ class BitbucketHelper:
             method='GET',
         )
 
-        if info['status'] == 200:
-            return content.get('json', [])
+        return self._v1_listing(info, content)
 
-        self.module.fail_json(
-            msg=error_messages['unknown_error'].format(info=info)
-        )
+    def apply_group_members(self, result, workspace, group_slug, members, current):
+        """
+        Reconcile the members of a group with members, a list of account UUIDs.
+        current: members returned by get_group_members.
+        The additions and removals are sent concurrently (up to the parallelism option) and
+        the outcome for each member is recorded under result['member_changes'], a failed
+        member doesn't stop the others, the module fails once every change has been sent.
+        In check mode nothing is sent, the changes are recorded under result['plan'].
+        """
 
-        return []
+        current_uuids = set(m['uuid'] for m in current if 'uuid' in m)
+        desired_uuids = set(members)
+
+        changes = [('add', uuid) for uuid in sorted(desired_uuids - current_uuids)]
+        changes += [('remove', uuid) for uuid in sorted(current_uuids - desired_uuids)]
+        mutations = [
+            self.group_member_mutation(action, workspace, group_slug, uuid)
+            for action, uuid in changes
+        ]
+
+        if self.module.check_mode:
+            self.plan(result, mutations)
+            return []
+
+        outcomes = self.run_mutations(mutations)
+        result.setdefault('member_changes', [])
+        for (action, uuid), outcome in zip(changes, outcomes):
+            result['member_changes'].append(dict(
+                uuid=uuid,
+                action=action,
+                status=outcome['status'],
+                ok=outcome['ok'],
+                msg=outcome['msg'],
+            ))
+            if outcome['ok']:
+                result['changed'] = True
+
+        self.fail_on_outcomes(result, outcomes)
+
+        return outcomes
 
     def add_group_member(self, workspace, group_slug, member_uuid):
         """
@@ -941,25 +2476,7 @@ class BitbucketHelper:
         Returns the member profile dict on success.
         """
 
-        encoded_uuid = member_uuid.replace('{', '%7B').replace('}', '%7D')
-        api_url = '{}/groups/{}/{}/members/{}/'.format(
-            self.BITBUCKET_API_V1_URL, workspace, group_slug, encoded_uuid
-        )
-        info, content = self.request(
-            api_url,
-            module=self.module,
-            method='PUT',
-            data={},
-        )
-
-        if info['status'] in (200, 201):
-            return content
-
-        self.module.fail_json(
-            msg=error_messages['unknown_error'].format(info=info)
-        )
-
-        return None
+        return self.execute_mutation(self.group_member_mutation('add', workspace, group_slug, member_uuid))
 
     def remove_group_member(self, workspace, group_slug, member_uuid):
         """
@@ -968,21 +2485,33 @@ class BitbucketHelper:
         Returns True on success.
         """
 
+        self.execute_mutation(self.group_member_mutation('remove', workspace, group_slug, member_uuid))
+        return True
+
+    def group_member_mutation(self, action, workspace, group_slug, member_uuid):
+        """
+        Build the mutation used by add_group_member and remove_group_member
+        action: add|remove
+        """
+
         encoded_uuid = member_uuid.replace('{', '%7B').replace('}', '%7D')
-        api_url = '{}/groups/{}/{}/members/{}'.format(
-            self.BITBUCKET_API_V1_URL, workspace, group_slug, encoded_uuid
-        )
-        info, content = self.request(
-            api_url,
-            module=self.module,
-            method='DELETE',
-        )
 
-        if info['status'] in (200, 204):
-            return True
+        if action == 'add':
+            return self.mutation(
+                label='add member {} to group {}'.format(member_uuid, group_slug),
+                method='PUT',
+                api_url='{}/groups/{}/{}/members/{}/'.format(
+                    self.v1_url, workspace, group_slug, encoded_uuid
+                ),
+                data={},
+                expected=(200, 201),
+            )
 
-        self.module.fail_json(
-            msg=error_messages['unknown_error'].format(info=info)
+        return self.mutation(
+            label='remove member {} from group {}'.format(member_uuid, group_slug),
+            method='DELETE',
+            api_url='{}/groups/{}/{}/members/{}'.format(
+                self.v1_url, workspace, group_slug, encoded_uuid
+            ),
+            expected=(200, 204),
         )
-
-        return False
@@ -0,0 +1,206 @@
+"""
+Util class for the local cache of bitbucket modules
+"""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+def _write_json(path, value):
+    """
+    Write value to path as JSON, the file is replaced atomically and only readable by the owner.
+    """
+
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as json_file:
+        json.dump(value, json_file)
+    os.replace(tmp_path, path)
+
+#
+# class: BitbucketCache
+#
+
+class BitbucketCache:
+    """
+    JSON documents stored on disk, one file per key, shared by every module call of a play
+    (and by later plays) running on the same host.
+    Entries older than ttl seconds are ignored, and removed from the directory the first
+    time this instance writes, so the cache doesn't grow beyond what was stored in the
+    last ttl seconds.
+    Errors reading or writing the cache are ignored, the caller just goes to the API.
+    """
+
+    def __init__(self, directory, namespace, ttl=None):
+        self.directory = os.path.join(os.path.expanduser(directory), namespace)
+        self.ttl = ttl
+        self._evicted = False
+
+    def _path(self, key):
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest + '.json')
+
+    def get(self, key, ttl=None):
+        """
+        Return the value stored for key, or None when it is missing or older than ttl seconds,
+        the ttl of the cache when omitted.
+        """
+
+        if ttl is None:
+            ttl = self.ttl
+
+        try:
+            with open(self._path(key), 'r') as cache_file:
+                entry = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if ttl is not None and time.time() - entry.get('stored', 0) > ttl:
+            return None
+
+        return entry.get('value')
+
+    def set(self, key, value):
+        """
+        Store value for key, the file is replaced atomically and only readable by the owner.
+        """
+
+        try:
+            _write_json(self._path(key), {'key': key, 'stored': time.time(), 'value': value})
+        except (IOError, OSError, TypeError, ValueError):
+            pass
+
+        if not self._evicted:
+            self._evicted = True
+            self.evict()
+
+    def evict(self):
+        """
+        Remove the entries older than the ttl of the cache, and temporary files left behind.
+        """
+
+        if self.ttl is None:
+            return
+
+        expired = time.time() - self.ttl
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                # entries are replaced atomically, their mtime is the time they were stored
+                if os.path.getmtime(path) < expired:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def delete(self, key):
+        """
+        Remove the value stored for key.
+        """
+
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+#
+# class: BitbucketStateStore
+#
+
+class BitbucketStateStore:
+    """
+    State of the resources at the end of the last successful run, one JSON file per
+    workspace. Each entry holds a digest of the desired spec and a token describing the
+    remote state, digests are salted with a random value kept in the same file.
+    Errors reading or writing the file are ignored, the caller does a full reconciliation.
+    """
+
+    def __init__(self, directory, workspace):
+        self.path = os.path.join(os.path.expanduser(directory), workspace + '.json')
+        self.lock = threading.Lock()
+        self.state = None
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as state_file:
+                state = json.load(state_file)
+        except (IOError, OSError, ValueError):
+            state = {}
+        if not isinstance(state, dict):
+            state = {}
+        state.setdefault('entries', {})
+        return state
+
+    def _read(self):
+        with self.lock:
+            if self.state is None:
+                self.state = self._load()
+            return self.state
+
+    def _update(self, update):
+        # the file is read again so entries written by other runs meanwhile are kept
+        with self.lock:
+            state = self._load()
+            if self.state is not None and 'salt' in self.state:
+                state.setdefault('salt', self.state['salt'])
+            update(state)
+            try:
+                _write_json(self.path, state)
+            except (IOError, OSError, TypeError, ValueError):
+                pass
+            self.state = state
+
+    def salt(self):
+        """
+        Return the salt of the store, created the first time it is needed.
+        """
+
+        state = self._read()
+        if 'salt' not in state:
+            self._update(lambda s: s.setdefault('salt', os.urandom(16).hex()))
+            state = self._read()
+        return state['salt']
+
+    def digest(self, value):
+        """
+        Salted hash of value, any JSON serializable object.
+        """
+
+        payload = json.dumps(value, sort_keys=True, default=str)
+        return hashlib.sha256((self.salt() + payload).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        Return the entry stored for key, or None.
+        """
+
+        return self._read()['entries'].get(key)
+
+    def set(self, key, entry):
+        """
+        Store entry for key.
+        """
+
+        def update(state):
+            state['entries'][key] = dict(entry, stored=time.time())
+        self._update(update)
+
+    def delete(self, key):
+        """
+        Remove the entry stored for key.
+        """
+
+        self._update(lambda state: state['entries'].pop(key, None))
@@ -0,0 +1,149 @@
+"""
+Util class for the request metrics of bitbucket modules
+"""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import json
+import os
+import re
+import threading
+import time
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+# position of the path parameters of each API, by first segment of the path
+ENDPOINT_PARAMETERS = {
+    'repositories': ['{workspace}', '{repo_slug}'],
+    'workspaces': ['{workspace}'],
+    'groups': ['{workspace}', '{group_slug}', None, '{member_uuid}'],
+    'group-privileges': ['{workspace}', '{repo_slug}', '{group_owner}', '{group_slug}'],
+}
+
+UUID_SEGMENT = re.compile(r'^(\{[^/]*\}|%7B.*%7D)$', re.IGNORECASE)
+
+#
+# class: BitbucketMetrics
+#
+
+class BitbucketMetrics:
+    """
+    Record every request sent by a BitbucketHelper (method, endpoint template, status,
+    bytes received, retries and latency) and summarize them per endpoint.
+    """
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def endpoint(api_url):
+        """
+        Return the path of api_url with the workspace, slugs, uuids and ids replaced by
+        placeholders, e.g. /2.0/repositories/{workspace}/{repo_slug}/pipelines_config/variables/{uuid}
+        """
+
+        segments = urlsplit(api_url).path.split('/')
+        # skip the API version, /2.0/... or /1.0/...
+        start = 2 if len(segments) > 1 and re.match(r'^\d+\.\d+$', segments[1]) else 1
+        parameters = ENDPOINT_PARAMETERS.get(segments[start] if len(segments) > start else None, [])
+        if segments[start:start + 1] == ['group-privileges'] and len(segments) - start - 1 == 3:
+            # the privileges of a group on every repository have no repository slug
+            parameters = ['{workspace}', '{group_owner}', '{group_slug}']
+
+        template = []
+        for index, segment in enumerate(segments):
+            position = index - start - 1
+            if 0 <= position < len(parameters) and parameters[position] and segment:
+                template.append(parameters[position])
+            elif UUID_SEGMENT.match(segment):
+                template.append('{uuid}')
+            elif segment.isdigit():
+                template.append('{id}')
+            else:
+                template.append(segment)
+        return '/'.join(template)
+
+    def record(self, method, api_url, status, size, retries, latency):
+        """
+        Record a request, latency in seconds including every retry.
+        """
+
+        with self._lock:
+            self.records.append(dict(
+                time=time.time(),
+                method=method,
+                endpoint=self.endpoint(api_url),
+                status=status,
+                bytes=size,
+                retries=retries - 1,
+                latency=round(latency, 4),
+            ))
+
+    @staticmethod
+    def _percentile(values, percent):
+        # nearest rank on sorted values
+        rank = max(1, -(-len(values) * percent // 100))
+        return values[int(rank) - 1]
+
+    def summary(self):
+        """
+        Aggregate the requests per method and endpoint: count, errors, 304 answers
+        (not_modified), bytes, retries and p50/p95/max latency in seconds.
+        """
+
+        with self._lock:
+            records = list(self.records)
+
+        groups = {}
+        for record in records:
+            groups.setdefault((record['method'], record['endpoint']), []).append(record)
+
+        endpoints = []
+        for (method, endpoint), items in sorted(groups.items()):
+            latencies = sorted(item['latency'] for item in items)
+            endpoints.append(dict(
+                method=method,
+                endpoint=endpoint,
+                count=len(items),
+                errors=len([item for item in items if item['status'] is None or not 200 <= item['status'] < 400]),
+                not_modified=len([item for item in items if item['status'] == 304]),
+                bytes=sum(item['bytes'] for item in items),
+                retries=sum(item['retries'] for item in items),
+                p50=self._percentile(latencies, 50),
+                p95=self._percentile(latencies, 95),
+                max=latencies[-1],
+            ))
+
+        return dict(
+            requests=len(records),
+            retries=sum(record['retries'] for record in records),
+            not_modified=len([record for record in records if record['status'] == 304]),
+            bytes=sum(record['bytes'] for record in records),
+            latency=round(sum(record['latency'] for record in records), 4),
+            endpoints=endpoints,
+        )
+
+    def write(self, path, **fields):
+        """
+        Append every request recorded as a JSON line to path, with fields added to each line.
+        Errors writing the file are ignored.
+        """
+
+        with self._lock:
+            records = list(self.records)
+
+        try:
+            path = os.path.expanduser(path)
+            directory = os.path.dirname(path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(path, 'a') as metrics_file:
+                for record in records:
+                    metrics_file.write(json.dumps(dict(record, **fields), sort_keys=True) + '\n')
+        except (IOError, OSError, TypeError, ValueError):
+            pass
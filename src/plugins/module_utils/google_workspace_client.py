@@ -0,0 +1,77 @@
+"""
+Util class for the clients of the google workspace APIs
+"""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from google.oauth2 import service_account
+import json
+import threading
+
+#
+# class: GoogleWorkspaceClientFactory
+#
+
+class GoogleWorkspaceClientFactory:
+    """
+    Build the API clients used by the google workspace helpers.
+    The service account file is read once, the discovery document of each API is taken
+    from the ones shipped with googleapiclient (static discovery) and parsed once, and
+    each client is built once per (api, version, scopes, subject).
+    """
+
+    def __init__(self, credential_file):
+        self.credential_file = credential_file
+        self._service_account = None
+        self._credentials = {}
+        self._documents = {}
+        self._services = {}
+        self._lock = threading.Lock()
+
+
+    def credentials(self, scopes, subject=None):
+        # credentials of the service account for scopes, delegated to subject when given
+        key = (tuple(scopes), subject)
+        with self._lock:
+            if self._service_account is None:
+                self._service_account = service_account.Credentials.from_service_account_file(
+                    self.credential_file)
+            if key not in self._credentials:
+                credentials = self._service_account.with_scopes(list(scopes))
+                if subject is not None:
+                    credentials = credentials.with_subject(subject)
+                self._credentials[key] = credentials
+            return self._credentials[key]
+
+
+    def document(self, api, version):
+        # discovery document shipped with googleapiclient, None when it has none for the API
+        key = (api, version)
+        with self._lock:
+            if key not in self._documents:
+                content = get_static_doc(api, version)
+                self._documents[key] = json.loads(content) if content else None
+            return self._documents[key]
+
+
+    def service(self, api, version, scopes, subject=None):
+        key = (api, version, tuple(scopes), subject)
+        with self._lock:
+            service = self._services.get(key)
+        if service is not None:
+            return service
+
+        credentials = self.credentials(scopes, subject)
+        document = self.document(api, version)
+        if document is not None:
+            service = build_from_document(document, credentials=credentials)
+        else:
+            # API not shipped with googleapiclient, fetch its discovery document
+            service = build(api, version, credentials=credentials,
+                            static_discovery=False, cache_discovery=False)
+
+        with self._lock:
+            return self._services.setdefault(key, service)
@@ -5,11 +5,13 @@ Util class for google_workspace_groups
 from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
-from googleapiclient.discovery import build
-from google.oauth2 import service_account
 from googleapiclient import errors
+from ansible_collections.i2btech.ops.plugins.module_utils.google_workspace_client import GoogleWorkspaceClientFactory
 import time
 
+# largest number of calls accepted in a batch request by the API
+BATCH_LIMIT = 1000
+
 #
 # class: GoogleWorkspaceGroupHelper
 #
@@ -21,6 +23,7 @@ class GoogleWorkspaceGroupHelper:
 
     def __init__(self, module):
         self.module = module
+        self.clients = GoogleWorkspaceClientFactory(module.params['credential_file'])
 
 
     def get_members(self, group, service):
@@ -52,10 +55,7 @@ class GoogleWorkspaceGroupHelper:
             "https://www.googleapis.com/auth/admin.directory.group.readonly",
             "https://www.googleapis.com/auth/apps.groups.settings",
         ]
-        credentials = service_account.Credentials.from_service_account_file(
-            self.module.params['credential_file'],
-            scopes=target_scopes)
-        service = build("groupssettings", "v1", credentials=credentials)
+        service = self.clients.service("groupssettings", "v1", target_scopes)
 
         # check if special keyword exists
         # in this case we check all the groups
@@ -135,21 +135,15 @@ class GoogleWorkspaceGroupHelper:
             "https://www.googleapis.com/auth/admin.directory.group",
             "https://www.googleapis.com/auth/admin.directory.group.member"
         ]
-        credentials = service_account.Credentials.from_service_account_file(
-            self.module.params['credential_file'],
-            scopes=target_scopes,
-            subject=self.module.params['used_by'])
-        service_directory = build("admin", "directory_v1", credentials=credentials)
+        service_directory = self.clients.service(
+            "admin", "directory_v1", target_scopes, self.module.params['used_by'])
 
         # auth google
         target_scopes = [
             "https://www.googleapis.com/auth/admin.directory.group",
             "https://www.googleapis.com/auth/apps.groups.settings",
         ]
-        credentials = service_account.Credentials.from_service_account_file(
-            self.module.params['credential_file'],
-            scopes=target_scopes)
-        service_grp_settings = build("groupssettings", "v1", credentials=credentials)
+        service_grp_settings = self.clients.service("groupssettings", "v1", target_scopes)
 
         # get list of group that need to be created/updated
         action_groups = self.module.params['groups'] if "groups" in self.module.params else []
@@ -220,11 +214,9 @@ class GoogleWorkspaceGroupHelper:
 
                 # add users
                 definition_members = group["members"] if "members" in group else []
-                for user in definition_members:
-                    res = self.member_insert_delete("insert", service_directory, group["mail"], user)
-                    if res != "OK":
-                        result["failed"] = True
-                        result["message"].append(user + ": " + res)
+                self.members_batch(service_directory, [
+                    ("insert", group["mail"], user, user) for user in definition_members
+                ], result)
             else:
                 result['failed'] = True
                 result["message"].append(group["mail"] + ": group created but was not activated")
@@ -269,23 +261,15 @@ class GoogleWorkspaceGroupHelper:
                 for member in results["members"]:
                     current_members.append(member["email"])
 
-            # add members
-            for deleted in set(current_members).difference(definition_members):
-                res = self.member_insert_delete("delete", service_directory, group["mail"], deleted)
-                if res != "OK":
-                    result["failed"] = True
-                    result["message"].append(deleted + ": " + res)
-                else:
-                    result["changed"] = True
-
-            # delete members
-            for added in set(definition_members).difference(current_members):
-                res = self.member_insert_delete("insert", service_directory, group["mail"], added)
-                if res != "OK":
-                    result["failed"] = True
-                    result["message"].append(added + ": " + res)
-                else:
-                    result["changed"] = True
+            # delete and add members, in batch requests
+            changes = [
+                ("delete", group["mail"], deleted, deleted)
+                for deleted in set(current_members).difference(definition_members)
+            ] + [
+                ("insert", group["mail"], added, added)
+                for added in set(definition_members).difference(current_members)
+            ]
+            self.members_batch(service_directory, changes, result)
 
         except Exception as error:
             result["failed"] = True
@@ -314,27 +298,43 @@ class GoogleWorkspaceGroupHelper:
         return result
 
 
-    def member_insert_delete(self, action, service, group, member):
-        result = "ERROR"
-        try:
-            if action == "insert":
-                # TODO: insert method don't fail if the user don't exists
-                body_member = {
-                    "email": member
-                }
-                service.members().insert(
-                    groupKey=group,
-                    body=body_member
-                ).execute()
-                result = "OK"
-            if action == "delete":
-                service.members().delete(
-                        groupKey=group,
-                        memberKey=member
-                    ).execute()
-                result = "OK"
+    @staticmethod
+    def member_request(action, service, group, member):
+        # request that inserts or deletes a member of a group, not executed
+        if action == "insert":
+            # TODO: insert method don't fail if the user don't exists
+            body_member = {
+                "email": member
+            }
+            return service.members().insert(
+                groupKey=group,
+                body=body_member
+            )
 
-        except Exception as error:
-            result = str(error)
+        return service.members().delete(
+            groupKey=group,
+            memberKey=member
+        )
 
-        return result
+
+    @staticmethod
+    def members_batch(service, changes, result):
+        # changes: list of (action, group, member, label), sent in batch requests of up to
+        # BATCH_LIMIT calls instead of one request per member.
+        # the outcome of each call is written to result: "changed" when it succeeds,
+        # "failed" and "<label>: <error>" in "message" when it doesn't
+        def callback(request_id, response, exception):
+            if exception is not None:
+                result["failed"] = True
+                result["message"].append(changes[int(request_id)][3] + ": " + str(exception))
+            else:
+                result["changed"] = True
+
+        for start in range(0, len(changes), BATCH_LIMIT):
+            batch = service.new_batch_http_request(callback=callback)
+            for index in range(start, min(start + BATCH_LIMIT, len(changes))):
+                action, group, member, dummy = changes[index]
+                batch.add(
+                    GoogleWorkspaceGroupHelper.member_request(action, service, group, member),
+                    request_id=str(index))
+            batch.execute()
@@ -5,13 +5,85 @@ Util class for google_workspace_user
 from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
-from googleapiclient.discovery import build
-from google.oauth2 import service_account
+from concurrent.futures import ThreadPoolExecutor
 from jinja2 import Environment, FileSystemLoader
 from googleapiclient import errors
+from ansible_collections.i2btech.ops.plugins.module_utils.google_workspace_client import GoogleWorkspaceClientFactory
 from ansible_collections.i2btech.ops.plugins.module_utils.google_workspace_group import GoogleWorkspaceGroupHelper
+import hashlib
+import html
+import json
+import os
+import random
+import re
+import tempfile
+import threading
 import time
 
+# signatures patched per batch request, gmail throttles larger batches
+SIGNATURE_BATCH_SIZE = 50
+# answers of gmail worth sending the request again
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# compiled signature templates, by template folder and name, shared by every user
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def get_template(template_folder, name):
+    # the environment of a folder is created once and each template is parsed once
+    with _templates_lock:
+        template = _templates.get((template_folder, name))
+        if template is None:
+            environment = _templates.get(template_folder)
+            if environment is None:
+                environment = Environment(loader=FileSystemLoader(template_folder))
+                _templates[template_folder] = environment
+            template = environment.get_template(name)
+            _templates[(template_folder, name)] = template
+        return template
+
+
+def load_signature_state(path):
+    # digests of the signatures pushed by previous runs, by user
+    try:
+        with open(path, 'r') as state_file:
+            return json.load(state_file)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_signature_state(path, state):
+    # the file is replaced atomically
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as state_file:
+        json.dump(state, state_file, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def signature_digest(signature):
+    return hashlib.sha256(signature.encode('utf-8')).hexdigest()
+
+
+def normalize_signature(signature):
+    # gmail may rewrite the html of a signature when it stores it: entities, self closing
+    # tags, case of the tag names, quotes of the attributes and whitespace between tags
+    text = html.unescape(signature or '')
+    text = re.sub(r'\s*/?>', '>', text)
+    text = re.sub(r'(</?)([A-Za-z][A-Za-z0-9]*)', lambda match: match.group(1) + match.group(2).lower(), text)
+    text = text.replace("'", '"')
+    text = re.sub(r'>\s+<', '><', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def rendered_digest(entry):
+    # digest of the rendered signature in an entry of the state, a digest alone or, with
+    # signature_compare, a dict with the digest of the signature as gmail stored it too
+    return entry.get('rendered') if isinstance(entry, dict) else entry
+
 #
 # class: GoogleWorkspaceUserHelper
 #
@@ -23,6 +95,7 @@ class GoogleWorkspaceUserHelper:
 
     def __init__(self, module):
         self.module = module
+        self.clients = GoogleWorkspaceClientFactory(module.params['credential_file'])
 
 
     def signout(self):
@@ -35,21 +108,15 @@ class GoogleWorkspaceUserHelper:
 
         users_from_groups = []
         target_scopes = ["https://www.googleapis.com/auth/admin.directory.group.readonly"]
-        credentials = service_account.Credentials.from_service_account_file(
-            self.module.params['credential_file'],
-            scopes=target_scopes)
-        service_members = build("admin", "directory_v1", credentials=credentials)
+        service_members = self.clients.service("admin", "directory_v1", target_scopes)
 
         if self.module.params['groups'] is not None:
             for group in self.module.params['groups']:
                 users_from_groups = GoogleWorkspaceGroupHelper.get_members(self, group, service_members)
 
         target_scopes_security = ["https://www.googleapis.com/auth/admin.directory.user.security"]
-        credentials_security = service_account.Credentials.from_service_account_file(
-            self.module.params['credential_file'],
-            scopes=target_scopes_security,
-            subject=self.module.params['used_by'])
-        service_signout = build("admin", "directory_v1", credentials=credentials_security)
+        service_signout = self.clients.service(
+            "admin", "directory_v1", target_scopes_security, self.module.params['used_by'])
 
         if (len(self.module.params['users']) == 0) and len(users_from_groups) == 0:
             result_signout['failed'] = True
@@ -78,9 +145,8 @@ class GoogleWorkspaceUserHelper:
 
 
     def render_signature(self, user_info, template_folder):
-        # create signature from template
-        env = Environment(loader=FileSystemLoader(template_folder))
-        rendered_string = env.get_template(user_info['signature'] + ".j2").render(
+        # create signature from template, compiled once for every user
+        rendered_string = get_template(template_folder, user_info['signature'] + ".j2").render(
             full_name=user_info['full_name'],
             title=user_info['title'],
             phone=user_info['phone'] if "phone" in user_info else None,
@@ -108,52 +174,188 @@ class GoogleWorkspaceUserHelper:
             result_signature['failed'] = True
             result_signature['message'].append("Need users or groups")
         else:
-            # iterate over list of all users that need to be updated
-            for user in self.module.params['users'] + users_from_groups:
-                try:
-                    # iterate over list of all current users if use that need to be updated
-                    # exist, apply change
-                    for current_user in self.module.params['users_definition']:
-                        if current_user['mail'] == user:
-
-                            # auth google
-                            target_scopes = ["https://www.googleapis.com/auth/gmail.settings.basic"]
-                            credentials = service_account.Credentials.from_service_account_file(
-                                self.module.params['credential_file'],
-                                scopes=target_scopes,
-                                subject=current_user['mail'])
-                            service_user = build("gmail", "v1", credentials=credentials)
-
-                            send_as_configuration = {
-                                "signature": self.render_signature(current_user, self.module.params['signature_folder']),
-                            }
-                            # pylint: disable=E1101
-                            result = (
-                                service_user.users()
-                                .settings()
-                                .sendAs()
-                                .patch(
-                                    userId=current_user['mail'],
-                                    sendAsEmail=current_user['mail'],
-                                    body=send_as_configuration,
-                                )
-                                .execute()
-                            )
-                            result_signature['changed'] = True
-
-                except Exception as error:
+            # list of all users that need to be updated, without duplicates, updated concurrently
+            users = list(dict.fromkeys(self.module.params['users'] + users_from_groups))
+            state_file = self.module.params['state_file']
+            state = load_signature_state(state_file) if state_file else None
+            workers = max(1, min(self.module.params['parallelism'], len(users)))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                result_signature['users'] = list(executor.map(
+                    lambda user: self.update_signature(user, state), users))
+
+            # with signature_compare the signatures that differ are patched afterwards, in batches
+            self.patch_signatures(result_signature['users'])
+
+            for record in result_signature['users']:
+                digest = record.pop('digest', None)
+                if state is not None and digest is not None:
+                    state[record['user']] = digest
+                if record['changed']:
+                    result_signature['changed'] = True
+                if record['failed']:
                     result_signature['failed'] = True
                     current_user = {
-                        "user": user,
-                        "message": error
+                        "user": record['user'],
+                        "message": record['message']
                     }
                     result_signature['message'].append(current_user)
 
+            if state is not None:
+                try:
+                    save_signature_state(state_file, state)
+                except (IOError, OSError) as error:
+                    result_signature['failed'] = True
+                    result_signature['message'].append("Can't write " + state_file + ": " + str(error))
+
         if not result_signature['failed']:
             result_signature['message'].append("Signatures updated")
 
         return result_signature
 
+    def update_signature(self, user, state=None):
+        # render and patch the signature of a single user, returns the record of the user
+        # 429 and 5xx answers of gmail are retried with backoff, up to the retries option
+        # state: digests of the signatures pushed before by user, the user is skipped when
+        # the rendered signature has the same digest, the record gets the digest pushed
+        # with signature_compare the current signature is read first and the user is skipped
+        # when it's the same once normalized, or when it's the one gmail stored for the same
+        # rendered signature in the last run (state), otherwise the patch is left in the
+        # record for patch_signatures
+        record = {
+            "user": user,
+            "changed": False,
+            "failed": False,
+            "message": "User definition don't exist"
+        }
+        try:
+            # iterate over list of all current users if use that need to be updated
+            # exist, apply change
+            for current_user in self.module.params['users_definition']:
+                if current_user['mail'] == user:
+
+                    signature = self.render_signature(current_user, self.module.params['signature_folder'])
+                    digest = signature_digest(signature)
+                    entry = state.get(current_user['mail']) if state is not None else None
+                    compare = self.module.params['signature_compare']
+                    if not compare and entry is not None and rendered_digest(entry) == digest:
+                        record['message'] = "Signature unchanged"
+                        continue
+
+                    # auth google, the key file and the discovery document are only read once
+                    target_scopes = ["https://www.googleapis.com/auth/gmail.settings.basic"]
+                    service_user = self.clients.service("gmail", "v1", target_scopes, current_user['mail'])
+
+                    send_as_configuration = {
+                        "signature": signature,
+                    }
+                    # pylint: disable=E1101
+                    request = (
+                        service_user.users()
+                        .settings()
+                        .sendAs()
+                        .patch(
+                            userId=current_user['mail'],
+                            sendAsEmail=current_user['mail'],
+                            body=send_as_configuration,
+                        )
+                    )
+
+                    if compare:
+                        current = (
+                            service_user.users()
+                            .settings()
+                            .sendAs()
+                            .get(
+                                userId=current_user['mail'],
+                                sendAsEmail=current_user['mail'],
+                                fields="signature",
+                            )
+                            .execute(num_retries=self.module.params['retries'])
+                        )
+                        current_signature = current.get('signature', '')
+                        stored = signature_digest(current_signature)
+                        # gmail may store the signature rewritten, compare with what it stored last time
+                        if (normalize_signature(current_signature) == normalize_signature(signature)
+                                or (isinstance(entry, dict) and entry.get('rendered') == digest
+                                    and entry.get('stored') == stored)):
+                            record['message'] = "Signature unchanged"
+                            record['digest'] = {"rendered": digest, "stored": stored}
+                        else:
+                            record['request'] = request
+                            record['service'] = service_user
+                            record['digest'] = {"rendered": digest, "stored": signature_digest(signature)}
+                        continue
+
+                    request.execute(num_retries=self.module.params['retries'])
+                    record['changed'] = True
+                    record['message'] = "Signature updated"
+                    record['digest'] = digest
+
+        except Exception as error:
+            record['failed'] = True
+            record['message'] = str(error)
+
+        return record
+
+
+    def patch_signatures(self, records):
+        # send the patches left in the records by update_signature in batch requests of
+        # SIGNATURE_BATCH_SIZE users, each request keeps the credentials of its user.
+        # the patches that get a 429 or 5xx answer are sent again in the next batches,
+        # with backoff, up to the retries option
+        pending = [record for record in records if 'request' in record]
+
+        def callback(request_id, response, exception):
+            record = pending[int(request_id)]
+            if exception is None:
+                record['changed'] = True
+                record['message'] = "Signature updated"
+                record.pop('request')
+                # the signature as gmail stored it, compared with the current one next run
+                if response and 'signature' in response:
+                    record['digest']['stored'] = signature_digest(response['signature'])
+            elif (getattr(exception, 'resp', None) is not None and exception.resp.status in RETRY_STATUSES
+                  and record['attempts'] < self.module.params['retries']):
+                record['attempts'] += 1
+            else:
+                record['failed'] = True
+                record['message'] = str(exception)
+                record.pop('request')
+                record.pop('digest', None)
+
+        for record in pending:
+            record['attempts'] = 0
+
+        attempt = 0
+        while True:
+            indexes = [index for index, record in enumerate(pending) if 'request' in record]
+            if not indexes:
+                break
+            if attempt > 0:
+                time.sleep(min(2 ** attempt + random.random(), 60))
+            attempt += 1
+
+            for start in range(0, len(indexes), SIGNATURE_BATCH_SIZE):
+                chunk = indexes[start:start + SIGNATURE_BATCH_SIZE]
+                batch = pending[chunk[0]]['service'].new_batch_http_request(callback=callback)
+                for index in chunk:
+                    batch.add(pending[index]['request'], request_id=str(index))
+                try:
+                    batch.execute()
+                except Exception as error:
+                    for index in chunk:
+                        record = pending[index]
+                        if 'request' in record:
+                            record['failed'] = True
+                            record['message'] = str(error)
+                            record.pop('request')
+                            record.pop('digest', None)
+
+        for record in pending:
+            record.pop('service', None)
+            record.pop('attempts', None)
+
+
     def create_update(self):
         result = {
             "changed": False,
@@ -167,11 +369,8 @@ class GoogleWorkspaceUserHelper:
             "https://www.googleapis.com/auth/admin.directory.group.member",
             "https://www.googleapis.com/auth/admin.directory.group"
         ]
-        credentials = service_account.Credentials.from_service_account_file(
-            self.module.params['credential_file'],
-            scopes=target_scopes,
-            subject=self.module.params['used_by'])
-        service_directory = build("admin", "directory_v1", credentials=credentials)
+        service_directory = self.clients.service(
+            "admin", "directory_v1", target_scopes, self.module.params['used_by'])
 
         # get list of users that need to be created/updated
         action_users = self.module.params['users'] if "users" in self.module.params else []
@@ -248,14 +447,10 @@ class GoogleWorkspaceUserHelper:
             # será igual q el grupo?, se crea en modo archived y hay q esperar la activación?
             time.sleep(5)
 
-            # add to groups
-            for group in groups:
-                res = GoogleWorkspaceGroupHelper.member_insert_delete(self, "insert", service_directory, group, user["mail"])
-                if res != "OK":
-                    result["failed"] = True
-                    result["message"].append(user["mail"] + ": " + res)
-                else:
-                    result["changed"] = True
+            # add to groups, in batch requests
+            GoogleWorkspaceGroupHelper.members_batch(service_directory, [
+                ("insert", group, user["mail"], user["mail"]) for group in groups
+            ], result)
 
         except Exception as error:
             result['failed'] = True
@@ -299,23 +494,15 @@ class GoogleWorkspaceUserHelper:
                 for group in results["groups"]:
                     current_memberships.append(group["email"])
 
-            # delete memberships
-            for deleted in set(current_memberships).difference(groups_to_be_added):
-                res = GoogleWorkspaceGroupHelper.member_insert_delete(self, "delete", service_directory, deleted, user["mail"])
-                if res != "OK":
-                    result["failed"] = True
-                    result["message"].append(deleted + ": " + res)
-                else:
-                    result["changed"] = True
-
-            # add memberships
-            for added in set(groups_to_be_added).difference(current_memberships):
-                res = GoogleWorkspaceGroupHelper.member_insert_delete(self, "insert", service_directory, added, user["mail"])
-                if res != "OK":
-                    result["failed"] = True
-                    result["message"].append(added + ": " + res)
-                else:
-                    result["changed"] = True
+            # delete and add memberships, in batch requests
+            changes = [
+                ("delete", deleted, user["mail"], deleted)
+                for deleted in set(current_memberships).difference(groups_to_be_added)
+            ] + [
+                ("insert", added, user["mail"], added)
+                for added in set(groups_to_be_added).difference(current_memberships)
+            ]
+            GoogleWorkspaceGroupHelper.members_batch(service_directory, changes, result)
 
         except Exception as error:
             result["failed"] = True
@@ -150,6 +150,35 @@ message:
     type: dict
     returned: always
     sample: []
+mutations:
+    description: Outcome of each write sent to the API, in the order they were computed.
+    type: list
+    elements: dict
+    returned: success
+    sample: [{"label": "create branch restriction push", "status": 201, "ok": true, "msg": ""}]
+pages_fetched:
+    description: Number of pages read from the Bitbucket API to get the current state.
+    type: int
+    returned: success
+    sample: 1
+unchanged:
+    description:
+        - True when the desired state and the remote state are the same as at the end of the last
+          successful run recorded under C(state_dir), the comparison was skipped.
+    type: bool
+    returned: success
+    sample: false
+plan:
+    description: Writes that would be sent to the API, returned instead of sending them in check mode.
+    type: list
+    elements: dict
+    returned: check mode
+    sample: [{"label": "create branch restriction push", "method": "POST", "url": "https://api.bitbucket.org/2.0/repositories/i2b/example/branch-restrictions"}]
+metrics:
+    description: Requests sent to the API aggregated per method and endpoint template, with count, errors, 304 answers (not_modified), bytes, retries and p50/p95/max latency in seconds.
+    type: dict
+    returned: always
+    sample: {"requests": 1, "retries": 0, "not_modified": 0, "bytes": 412, "latency": 0.2011, "endpoints": [{"method": "GET", "endpoint": "/2.0/repositories/{workspace}/{repo_slug}", "count": 1, "errors": 0, "not_modified": 0, "bytes": 412, "retries": 0, "p50": 0.2011, "p95": 0.2011, "max": 0.2011}]}
 '''
 
 #pylint: disable=wrong-import-position
@@ -158,116 +187,17 @@ from ansible.module_utils.basic import AnsibleModule
 #pylint: disable=wrong-import-position
 
 
-def _restriction_key(restriction):
-    """
-    Return a tuple that uniquely identifies a branch restriction rule.
-    The combination of kind + branch_match_kind + (pattern or branch_type) must be unique per repo.
-    """
-    kind = restriction.get('kind', '')
-    branch_match_kind = restriction.get('branch_match_kind', '')
-    if branch_match_kind == 'glob':
-        return (kind, branch_match_kind, restriction.get('pattern', ''))
-    return (kind, branch_match_kind, restriction.get('branch_type', ''))
-
-
-def _restriction_payload(restriction):
-    """
-    Build the API payload dict from an Ansible task restriction dict.
-    """
-    payload = {
-        'type': 'branchrestriction',
-        'kind': restriction['kind'],
-        'branch_match_kind': restriction['branch_match_kind'],
-    }
-    if restriction['branch_match_kind'] == 'glob':
-        payload['pattern'] = restriction.get('pattern', '')
-    else:
-        payload['branch_type'] = restriction.get('branch_type', '')
-
-    if restriction.get('value') is not None:
-        payload['value'] = restriction['value']
-
-    users = restriction.get('users') or []
-    payload['users'] = [{'type': 'account', 'uuid': uid} for uid in users]
-
-    groups = restriction.get('groups') or []
-    payload['groups'] = [{'type': 'group', 'slug': slug} for slug in groups]
-
-    return payload
-
-
-def _restrictions_differ(desired, current):
-    """
-    Return True if the desired restriction differs from the current one
-    and therefore needs to be updated via PUT.
-    """
-    # Compare value
-    desired_value = desired.get('value')
-    current_value = current.get('value')
-    if desired_value != current_value:
-        return True
-
-    # Compare users by UUID
-    desired_users = sorted(desired.get('users') or [])
-    current_users = sorted(
-        u.get('uuid', u.get('account_id', ''))
-        for u in (current.get('users') or [])
-    )
-    if desired_users != current_users:
-        return True
-
-    # Compare groups by slug
-    desired_groups = sorted(desired.get('groups') or [])
-    current_groups = sorted(
-        g.get('slug', '')
-        for g in (current.get('groups') or [])
-    )
-    if desired_groups != current_groups:
-        return True
-
-    return False
-
-
 def manage_restrictions(result, bitbucket, module):
     """ CRUD branch restrictions """
 
-    current_restrictions = bitbucket.get_branch_restrictions()
-    # Build a lookup map: key -> current restriction object
-    current_map = {_restriction_key(r): r for r in current_restrictions}
-
-    desired_restrictions = module.params['restrictions'] or []
-    desired_keys = set()
-
-    for desired in desired_restrictions:
-        key = _restriction_key(desired)
-        desired_keys.add(key)
-
-        payload = _restriction_payload(desired)
-
-        if key in current_map:
-            current = current_map[key]
-            if _restrictions_differ(desired, current):
-                bitbucket.manage_branch_restriction(
-                    action='update',
-                    restriction_data=payload,
-                    restriction_id=current['id'],
-                )
-                result['changed'] = True
-        else:
-            bitbucket.manage_branch_restriction(
-                action='create',
-                restriction_data=payload,
-            )
-            result['changed'] = True
+    api_url = bitbucket.branch_restrictions_url()
+    if bitbucket.converged(api_url, 'branch-restrictions', module.params['restrictions']):
+        result['unchanged'] = True
+        return
 
-    # Delete restrictions no longer in the desired list
-    for key, current in current_map.items():
-        if key not in desired_keys:
-            bitbucket.manage_branch_restriction(
-                action='delete',
-                restriction_id=current['id'],
-            )
-            result['changed'] = True
+    mutations = bitbucket.plan_restrictions(module.params['restrictions'])
+    bitbucket.apply_mutations(result, mutations)
+    bitbucket.mark_converged(api_url, 'branch-restrictions', module.params['restrictions'])
 
 
 def run_module():
@@ -358,8 +288,7 @@ def run_module():
         supports_check_mode=True,
     )
 
-    if module.check_mode:
-        module.exit_json(**result)
+    # in check mode the changes are returned under 'plan' instead of being applied
 
     bitbucket = BitbucketHelper(module)
 
@@ -367,9 +296,11 @@ def run_module():
 
     if existing_repository:
         manage_restrictions(result, bitbucket, module)
+        result['pages_fetched'] = bitbucket.pages_fetched
     else:
         module.fail_json(msg="Repository doesn't exist")
 
+    bitbucket.report_metrics(result)
     module.exit_json(**result)
 
 
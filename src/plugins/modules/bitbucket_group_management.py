@@ -22,6 +22,11 @@ notes:
       converting spaces to dashes and lowercasing all characters.
       For example, C(My Group) becomes C(my-group).
     - Authentication requires an app password with Account and Group admin scopes.
+    - The list of groups of the workspace is read once per task. With C(cache=true) it is
+      kept in the local cache (C(cache_dir) option) for C(cache_ttl) seconds so the next
+      tasks of the play don't read it again, a group changed outside Ansible within that
+      window isn't seen until the entry expires. It is dropped when a group is created,
+      updated or deleted.
 options:
     username:
         description:
@@ -93,10 +98,13 @@ options:
             - The module reconciles membership to exactly match this list —
               missing members are added and extra members are removed.
             - When omitted, existing membership is left unchanged.
+            - Members are added and removed concurrently, up to C(parallelism) at a time.
+              A member that can't be added or removed doesn't stop the others, the module
+              fails once every change has been sent and reports each one in C(member_changes).
         type: list
         elements: str
         required: false
-        default: []
+        default: null
     state:
         description:
             - C(present) ensures the group exists and is configured as specified.
@@ -105,6 +113,20 @@ options:
         choices: [ present, absent ]
         default: present
         required: false
+    groups:
+        description:
+            - Manage many groups of the workspace in one task, every group is looked up in
+              the same list of groups read once from the API.
+            - Each item accepts the C(name), C(slug), C(permission), C(repo_permissions),
+              C(members) and C(state) options described above.
+            - As for the options above, an item without C(members) or C(repo_permissions)
+              leaves the membership or the repository privileges of its group unchanged.
+            - A failure on one group doesn't stop the others, the module fails at the end and
+              reports which groups failed.
+            - Mutually exclusive with C(name) and C(slug).
+        type: list
+        elements: dict
+        required: false
 author:
     - IT I2B (it@i2btech.com)
 '''
@@ -163,6 +185,21 @@ EXAMPLES = r'''
     workspace: "my-workspace"
     slug: "developers"
     state: absent
+
+- name: "Manage every group of the workspace in one task"
+  i2btech.ops.bitbucket_group_management:
+    username: "alice"
+    password: "app_password"
+    workspace: "my-workspace"
+    groups:
+      - name: "Developers"
+        permission: "write"
+        members:
+          - "{c423e13e-b541-3e77-b363-3e0b458u8226}"
+      - name: "QA"
+        permission: "read"
+      - slug: "old-team"
+        state: absent
 '''
 
 RETURN = r'''
@@ -180,16 +217,60 @@ group:
         permission: "write"
         members: []
 repo_permissions:
-    description: List of repository privilege objects that are currently set for the group.
+    description:
+        - List of repository privilege objects that are currently set for the group.
+        - Computed from the privileges read before the changes and the answers to the changes,
+          they are only read again from the API when some change failed.
     type: list
     returned: when state is present and repo_permissions is provided
     sample:
         - repo: "my-workspace/backend-api"
           privilege: "write"
+member_changes:
+    description: Outcome of each member added to or removed from the group.
+    type: list
+    elements: dict
+    returned: when members are added or removed
+    sample: [{"uuid": "{c423e13e-b541-3e77-b363-3e0b458u8226}", "action": "add", "status": 200, "ok": true, "msg": ""}]
+mutations:
+    description: Outcome of each change of repository privileges sent to the API.
+    type: list
+    elements: dict
+    returned: when repo_permissions is provided
+    sample: [{"label": "set write privilege of group developers on backend-api", "status": 200, "ok": true, "msg": ""}]
+groups:
+    description:
+        - Outcome of each group of the C(groups) option, in the order they were given.
+        - Each item has the C(group), C(repo_permissions), C(member_changes), C(mutations)
+          and C(plan) keys described here, plus C(name), C(slug), C(changed), C(failed) and C(msg).
+    type: list
+    elements: dict
+    returned: when groups is provided
+    sample:
+        - name: "Developers"
+          slug: "developers"
+          changed: true
+          failed: false
+          msg: ""
+plan:
+    description: Changes that would be made, returned instead of applying them in check mode.
+    type: list
+    elements: dict
+    returned: check mode
+    sample:
+        - label: "add member {c423e13e-b541-3e77-b363-3e0b458u8226} to group developers"
+          method: "PUT"
+          url: "https://api.bitbucket.org/1.0/groups/my-workspace/developers/members/%7Bc423e13e-b541-3e77-b363-3e0b458u8226%7D/"
+metrics:
+    description: Requests sent to the API aggregated per method and endpoint template, with count, errors, 304 answers (not_modified), bytes, retries and p50/p95/max latency in seconds.
+    type: dict
+    returned: always
+    sample: {"requests": 1, "retries": 0, "not_modified": 0, "bytes": 412, "latency": 0.2011, "endpoints": [{"method": "GET", "endpoint": "/1.0/groups/{workspace}/", "count": 1, "errors": 0, "not_modified": 0, "bytes": 412, "retries": 0, "p50": 0.2011, "p95": 0.2011, "max": 0.2011}]}
 '''
 
 # pylint: disable=wrong-import-position
-from ansible_collections.i2btech.ops.plugins.module_utils.bitbucket import BitbucketHelper
+from concurrent.futures import ThreadPoolExecutor
+from ansible_collections.i2btech.ops.plugins.module_utils.bitbucket import BitbucketHelper, BitbucketError
 from ansible.module_utils.basic import AnsibleModule
 # pylint: enable=wrong-import-position
 
@@ -199,9 +280,199 @@ def _slugify(name):
     return name.lower().replace(' ', '-')
 
 
+def read_group_state(bitbucket, workspace, group_slug, read_members, read_privileges):
+    """
+    Read the members and the repository privileges of a group concurrently.
+    Returns two lists, empty for a group that doesn't exist or when not requested.
+    """
+
+    if group_slug is None:
+        return [], []
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        members = executor.submit(
+            bitbucket.get_group_members, workspace, group_slug) if read_members else None
+        # group_owner is always the workspace in Bitbucket Cloud
+        privileges = executor.submit(
+            bitbucket.get_group_repo_privileges, workspace, workspace, group_slug) if read_privileges else None
+
+        return (
+            members.result() if members else [],
+            privileges.result() if privileges else [],
+        )
+
+
+def manage_group(result, bitbucket, module, workspace, spec, inventory=None):
+    """
+    Reconcile a group of the workspace with spec, a dict with the name, slug, permission,
+    members, repo_permissions and state options.
+    inventory: groups of the workspace by slug, read from the API (or the cache) when omitted.
+    """
+
+    name = spec['name']
+    slug = spec['slug'] or (_slugify(name) if name else None)
+    permission = spec['permission']
+    members = spec['members']
+    repo_permissions = spec['repo_permissions']
+    state = spec['state']
+
+    if not slug:
+        bitbucket.fail_json(msg="Either 'name' or 'slug' must be provided.")
+
+    if inventory is None:
+        inventory = bitbucket.get_group_inventory(workspace)
+    current_group = inventory.get(slug)
+
+    if state == 'present':
+        if not name:
+            bitbucket.fail_json(msg="'name' is required when state is present.")
+
+        # members and repository privileges of an existing group are read concurrently
+        current_members, current_privs = read_group_state(
+            bitbucket, workspace, current_group['slug'] if current_group else None,
+            members is not None, repo_permissions is not None)
+
+        if current_group is None:
+            # Group does not exist — create it
+            if module.check_mode:
+                bitbucket.plan(result, [bitbucket.group_mutation('create', workspace, name=name)])
+                if permission:
+                    bitbucket.plan(result, [bitbucket.group_mutation(
+                        'update', workspace, slug, permission=permission)])
+                current_group = dict(name=name, slug=slug, permission=permission)
+            else:
+                current_group = bitbucket.create_group(workspace, name)
+
+                # Apply permission immediately after creation if requested
+                if permission and current_group:
+                    current_group = bitbucket.update_group(
+                        workspace,
+                        current_group['slug'],
+                        permission=permission,
+                    )
+            result['changed'] = True
+        else:
+            # Group already exists — update name and/or permission if needed
+            needs_update = False
+            if name and current_group.get('name') != name:
+                needs_update = True
+            if permission and current_group.get('permission') != permission:
+                needs_update = True
+
+            if needs_update:
+                update_kwargs = {}
+                if name:
+                    update_kwargs['name'] = name
+                if permission:
+                    update_kwargs['permission'] = permission
+                if module.check_mode:
+                    bitbucket.plan(result, [bitbucket.group_mutation(
+                        'update', workspace, current_group['slug'], **update_kwargs)])
+                    current_group = dict(current_group, **update_kwargs)
+                else:
+                    current_group = bitbucket.update_group(
+                        workspace,
+                        current_group['slug'],
+                        **update_kwargs
+                    )
+                result['changed'] = True
+
+        # Reconcile membership when the members list is explicitly provided
+        if members is not None and current_group:
+            bitbucket.apply_group_members(
+                result, workspace, current_group['slug'], members, current_members
+            )
+
+        # Reconcile repository permissions when repo_permissions is explicitly set
+        if repo_permissions is not None and current_group:
+            desired_map = {
+                rp['repository']: rp['privilege']
+                for rp in repo_permissions
+            }
+            # group_owner is always the workspace in Bitbucket Cloud
+            bitbucket.apply_group_repo_privileges(
+                result, workspace, workspace, current_group['slug'], desired_map, current_privs
+            )
+
+        result['group'] = current_group or {}
+
+    elif state == 'absent':
+        if current_group is not None:
+            if module.check_mode:
+                bitbucket.plan(result, [bitbucket.group_mutation('delete', workspace, current_group['slug'])])
+            else:
+                bitbucket.delete_group(workspace, current_group['slug'])
+            result['changed'] = True
+
+
+def manage_groups(result, bitbucket, module, workspace):
+    """
+    Reconcile every group of the groups option, all of them are looked up in the
+    same group inventory. A failure on one group doesn't stop the others.
+    """
+
+    # read the inventory once before any change drops it
+    inventory = bitbucket.get_group_inventory(workspace)
+
+    for spec in module.params['groups']:
+        report = dict(
+            name=spec['name'],
+            slug=spec['slug'] or (_slugify(spec['name']) if spec['name'] else None),
+            changed=False,
+            failed=False,
+            msg='',
+            group={},
+            repo_permissions=[],
+        )
+        try:
+            manage_group(report, bitbucket.raising(), module, workspace, spec, inventory)
+        except BitbucketError as exc:
+            report['failed'] = True
+            report['msg'] = str(exc)
+        result['groups'].append(report)
+
+    result['changed'] = any(report['changed'] for report in result['groups'])
+
+
 def run_module():
     """ main module """
 
+    group_spec = dict(
+        name=dict(
+            type='str',
+            required=False,
+            no_log=False),
+        slug=dict(
+            type='str',
+            required=False,
+            no_log=False),
+        permission=dict(
+            type='str',
+            required=False,
+            choices=['read', 'write', 'admin']),
+        repo_permissions=dict(
+            type='list',
+            elements='dict',
+            required=False,
+            default=None,
+            options=dict(
+                repository=dict(type='str', required=True),
+                privilege=dict(
+                    type='str',
+                    required=True,
+                    choices=['read', 'write', 'admin']),
+            )),
+        members=dict(
+            type='list',
+            elements='str',
+            required=False,
+            default=None),
+        state=dict(
+            type='str',
+            choices=['present', 'absent'],
+            default='present'),
+    )
+
     module_args = BitbucketHelper.bitbucket_argument_spec()
     module_args.update(
         workspace=dict(
@@ -236,11 +507,18 @@ def run_module():
             type='list',
             elements='str',
             required=False,
-            default=[]),
+            default=None),
         state=dict(
             type='str',
             choices=['present', 'absent'],
             default='present'),
+        groups=dict(
+            type='list',
+            elements='dict',
+            required=False,
+            default=None,
+            no_log=False,
+            options=group_spec),
     )
 
     result = dict(
@@ -253,126 +531,32 @@ def run_module():
         argument_spec=module_args,
         supports_check_mode=True,
         required_if=[
-            ('state', 'present', ['name']),
+            ('state', 'present', ['name', 'groups'], True),
+        ],
+        mutually_exclusive=[
+            ('groups', 'name'),
+            ('groups', 'slug'),
         ],
     )
 
-    if module.check_mode:
-        module.exit_json(**result)
-
-    workspace = module.params['workspace']
-    name = module.params['name']
-    slug = module.params['slug'] or (_slugify(name) if name else None)
-    permission = module.params['permission']
-    members = module.params['members']
-    repo_permissions = module.params['repo_permissions']
-    state = module.params['state']
-
-    if not slug:
-        module.fail_json(msg="Either 'name' or 'slug' must be provided.")
+    # in check mode the current state is read and the changes are computed
+    # as usual, they are returned under 'plan' instead of being applied
 
     bitbucket = BitbucketHelper(module)
 
-    existing_groups = bitbucket.get_groups(workspace)
-    current_group = next(
-        (g for g in existing_groups if g.get('slug') == slug),
-        None
-    )
-
-    if state == 'present':
-        if current_group is None:
-            # Group does not exist — create it
-            current_group = bitbucket.create_group(workspace, name)
-            result['changed'] = True
-
-            # Apply permission immediately after creation if requested
-            if permission and current_group:
-                current_group = bitbucket.update_group(
-                    workspace,
-                    current_group['slug'],
-                    permission=permission,
-                )
-        else:
-            # Group already exists — update name and/or permission if needed
-            needs_update = False
-            if name and current_group.get('name') != name:
-                needs_update = True
-            if permission and current_group.get('permission') != permission:
-                needs_update = True
-
-            if needs_update:
-                update_kwargs = {}
-                if name:
-                    update_kwargs['name'] = name
-                if permission:
-                    update_kwargs['permission'] = permission
-                current_group = bitbucket.update_group(
-                    workspace,
-                    current_group['slug'],
-                    **update_kwargs
-                )
-                result['changed'] = True
-
-        # Reconcile membership when the members list is explicitly provided
-        if members is not None and current_group:
-            actual_slug = current_group['slug']
-            current_members = bitbucket.get_group_members(workspace, actual_slug)
-            current_uuids = {m['uuid'] for m in current_members if 'uuid' in m}
-            desired_uuids = set(members)
-
-            for uuid in desired_uuids - current_uuids:
-                bitbucket.add_group_member(workspace, actual_slug, uuid)
-                result['changed'] = True
-
-            for uuid in current_uuids - desired_uuids:
-                bitbucket.remove_group_member(workspace, actual_slug, uuid)
-                result['changed'] = True
-
-        # Reconcile repository permissions when repo_permissions is explicitly set
-        if repo_permissions is not None and current_group:
-            actual_slug = current_group['slug']
-            # group_owner is always the workspace in Bitbucket Cloud
-            current_privs = bitbucket.get_group_repo_privileges(
-                workspace, workspace, actual_slug
-            )
-            # Build a dict keyed by repo slug for quick lookup.
-            # The 'repo' field from the API is in 'owner/repo-slug' format.
-            current_map = {
-                entry['repo'].split('/')[-1]: entry['privilege']
-                for entry in current_privs
-                if 'repo' in entry and 'privilege' in entry
-            }
-            desired_map = {
-                rp['repository']: rp['privilege']
-                for rp in repo_permissions
-            }
-
-            # Add or update
-            for repo_slug, privilege in desired_map.items():
-                if current_map.get(repo_slug) != privilege:
-                    bitbucket.set_group_repo_privilege(
-                        workspace, repo_slug, workspace, actual_slug, privilege
-                    )
-                    result['changed'] = True
-
-            # Remove repos not in the desired list
-            for repo_slug in current_map:
-                if repo_slug not in desired_map:
-                    bitbucket.delete_group_repo_privilege(
-                        workspace, repo_slug, workspace, actual_slug
-                    )
-                    result['changed'] = True
-
-            result['repo_permissions'] = bitbucket.get_group_repo_privileges(
-                workspace, workspace, actual_slug
-            )
-
-        result['group'] = current_group or {}
-
-    elif state == 'absent':
-        if current_group is not None:
-            bitbucket.delete_group(workspace, current_group['slug'])
-            result['changed'] = True
+    if module.params['groups'] is not None:
+        result['groups'] = []
+        manage_groups(result, bitbucket, module, module.params['workspace'])
+    else:
+        manage_group(result, bitbucket, module, module.params['workspace'], module.params)
+
+    bitbucket.report_metrics(result)
+    failed = [str(report['slug']) for report in result.get('groups', []) if report['failed']]
+    if failed:
+        module.fail_json(
+            msg='{} of {} groups failed: {}'.format(len(failed), len(result['groups']), ', '.join(failed)),
+            **result
+        )
 
     module.exit_json(**result)
 
@@ -62,6 +62,17 @@ message:
     type: dict
     returned: always
     sample: []
+plan:
+    description: Writes that would be sent to the API, returned instead of sending them in check mode.
+    type: list
+    elements: dict
+    returned: check mode
+    sample: [{"label": "create repository example", "method": "POST", "url": "https://api.bitbucket.org/2.0/repositories/i2b/example"}]
+metrics:
+    description: Requests sent to the API aggregated per method and endpoint template, with count, errors, 304 answers (not_modified), bytes, retries and p50/p95/max latency in seconds.
+    type: dict
+    returned: always
+    sample: {"requests": 1, "retries": 0, "not_modified": 0, "bytes": 412, "latency": 0.2011, "endpoints": [{"method": "GET", "endpoint": "/2.0/repositories/{workspace}/{repo_slug}", "count": 1, "errors": 0, "not_modified": 0, "bytes": 412, "retries": 0, "p50": 0.2011, "p95": 0.2011, "max": 0.2011}]}
 '''
 
 #pylint: disable=wrong-import-position
@@ -111,11 +122,8 @@ def run_module():
         supports_check_mode=True
     )
 
-    # if the user is working with this module in only check mode we do not
-    # want to make any changes to the environment, just return the current
-    # state with no modifications
-    if module.check_mode:
-        module.exit_json(**result)
+    # in check mode the current state is read and the changes are computed
+    # as usual, they are returned under 'plan' instead of being applied
 
     bitbucket = BitbucketHelper(module)
 
@@ -123,12 +131,19 @@ def run_module():
 
     # Create new repository in case it doesn't exist
     if not existing_repository and (module.params['state'] == 'present'):
-        if not module.check_mode:
+        if module.check_mode:
+            bitbucket.plan(result, [
+                bitbucket.repository_mutation(),
+                bitbucket.repository_pipeline_mutation(True),
+            ])
+        else:
             result['changed'] = bitbucket.create_repository()
             # TODO: maybe we can check if the pipeline is enabled already, if not, enable
             # Get configuration of pipeline: GET /2.0/repositories/{workspace}/{repo_slug}/pipelines_config
             bitbucket.enable_repository_pipeline()
 
+    bitbucket.report_metrics(result)
+
     if result is not None:
         module.exit_json(**result)
     else:
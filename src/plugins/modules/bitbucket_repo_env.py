@@ -91,6 +91,35 @@ message:
     type: dict
     returned: always
     sample: []
+mutations:
+    description: Outcome of each write sent to the API, in the order they were computed.
+    type: list
+    elements: dict
+    returned: success
+    sample: [{"label": "create environment variable user", "status": 201, "ok": true, "msg": ""}]
+pages_fetched:
+    description: Number of pages read from the Bitbucket API to get the current state.
+    type: int
+    returned: success
+    sample: 1
+unchanged:
+    description:
+        - True when the desired state and the remote state are the same as at the end of the last
+          successful run recorded under C(state_dir), the comparison was skipped.
+    type: bool
+    returned: success
+    sample: false
+plan:
+    description: Writes that would be sent to the API, returned instead of sending them in check mode.
+    type: list
+    elements: dict
+    returned: check mode
+    sample: [{"label": "create environment variable user", "method": "POST", "url": "https://api.bitbucket.org/2.0/repositories/i2b/example/deployments_config/environments/{7e2c1a4b-9d3f-4f5e-8a6b-0c1d2e3f4a5b}/variables"}]
+metrics:
+    description: Requests sent to the API aggregated per method and endpoint template, with count, errors, 304 answers (not_modified), bytes, retries and p50/p95/max latency in seconds.
+    type: dict
+    returned: always
+    sample: {"requests": 1, "retries": 0, "not_modified": 0, "bytes": 412, "latency": 0.2011, "endpoints": [{"method": "GET", "endpoint": "/2.0/repositories/{workspace}/{repo_slug}", "count": 1, "errors": 0, "not_modified": 0, "bytes": 412, "retries": 0, "p50": 0.2011, "p95": 0.2011, "max": 0.2011}]}
 '''
 
 #pylint: disable=wrong-import-position
@@ -101,29 +130,27 @@ from ansible.module_utils.basic import AnsibleModule
 def manage_environments(result, bitbucket, module):
     """ CRUD environments """
 
-    current_environments = bitbucket.get_repository_environments()
-    env_exists = False
-    env_uuid = None
-    for x in current_environments:
-        if module.params['name'].lower() == x['name'].lower() and module.params['type'].lower() == x['environment_type']['name'].lower():
-            env_exists = True
-            env_uuid = x['uuid']
-            break
+    environment = bitbucket.find_environment(module.params['name'], module.params['type'])
 
-    if env_exists:
+    if environment:
         # environment exists, manage variables associated with it if they exists
         if module.params['variables'] is not None:
-            api_url=bitbucket.BITBUCKET_API_ENDPOINTS['repos-deployments'].format(
-                        url=module.params['url'],
-                        workspace='i2b',
-                        repo_slug=module.params['repository'])
-            current_variables = bitbucket.get_variables(api_url + "/environments/" + env_uuid + "/variables")
+            env_uuid = environment['uuid']
+            api_url = bitbucket.environment_variables_url(env_uuid)
+            if bitbucket.converged(api_url, 'variables', module.params['variables']):
+                result['unchanged'] = True
+                return
+            current_variables = bitbucket.iter_variables(api_url)
             manage_environment_variables(result, bitbucket, env_uuid, current_variables, module.params['variables'])
 
     else:
         # environment doesn't exist on current environments, add it
-        new_env = bitbucket.manage_repository_environments('create', module.params['name'], module.params['type'])
-        env_uuid = new_env['uuid']
+        if module.check_mode:
+            bitbucket.plan(result, [bitbucket.environment_mutation('create', module.params['name'], module.params['type'])])
+            env_uuid = bitbucket.NEW_ENVIRONMENT_UUID
+        else:
+            new_env = bitbucket.manage_repository_environments('create', module.params['name'], module.params['type'])
+            env_uuid = new_env['uuid']
         # manage variables associated with it
         if module.params['variables'] is not None:
             manage_environment_variables(result, bitbucket, env_uuid, [], module.params['variables'])
@@ -132,44 +159,9 @@ def manage_environments(result, bitbucket, module):
 def manage_environment_variables(result, bitbucket, env_uuid, current_variables, new_variables):
     """ CRUD variables of environment """
 
-    # actions for new variables
-    for i in new_variables:
-        var_exists = False
-        var_value = None
-        var_uuid = None
-        for x in current_variables:
-            if i['name'].lower() == x['key'].lower():
-                var_exists = True
-                var_uuid = x['uuid']
-                if not x['secured']:
-                    var_value = x['value']
-                break
-
-        if var_exists:
-            # always update secured variable
-            if var_value is None:
-                bitbucket.manage_environment_variables('update', i['name'], i['value'], env_uuid, var_uuid, i['secured'])
-                result['changed'] = True
-            # if not secured and value are different, update variable
-            else:
-                if i['value'] != var_value:
-                    bitbucket.manage_environment_variables('update', i['name'], i['value'], env_uuid, var_uuid, i['secured'])
-                    result['changed'] = True
-
-        else:
-            # variable doesn't exist on current variables, add
-            bitbucket.manage_environment_variables('create', i['name'], i['value'], env_uuid, None, i['secured'])
-            result['changed'] = True
-
-    # action for current variables
-    for i in current_variables:
-        if not any(
-            i['key'].lower() == x['name'].lower()
-                for x in new_variables
-        ):
-            # current variable doesn't exists on new variables, delete
-            bitbucket.manage_environment_variables('delete', None, None, env_uuid, i['uuid'], None)
-            result['changed'] = True
+    mutations = bitbucket.plan_environment_variables(env_uuid, new_variables, current_variables)
+    bitbucket.apply_mutations(result, mutations)
+    bitbucket.mark_converged(bitbucket.environment_variables_url(env_uuid), 'variables', new_variables)
 
 def run_module():
     """ main module """
@@ -232,11 +224,8 @@ def run_module():
         supports_check_mode=True
     )
 
-    # if the user is working with this module in only check mode we do not
-    # want to make any changes to the environment, just return the current
-    # state with no modifications
-    if module.check_mode:
-        module.exit_json(**result)
+    # in check mode the current state is read and the changes are computed
+    # as usual, they are returned under 'plan' instead of being applied
 
     bitbucket = BitbucketHelper(module)
 
@@ -244,9 +233,12 @@ def run_module():
 
     if existing_repository:
         manage_environments(result, bitbucket, module)
+        result['pages_fetched'] = bitbucket.pages_fetched
     else:
         module.fail_json(msg="Repository doesn't exists")
 
+    bitbucket.report_metrics(result)
+
     if result is not None:
         module.exit_json(**result)
     else:
@@ -79,6 +79,28 @@ message:
     type: dict
     returned: always
     sample: []
+mutations:
+    description: Outcome of each write sent to the API, in the order they were computed.
+    type: list
+    elements: dict
+    returned: success
+    sample: [{"label": "promote group developers", "status": 200, "ok": true, "msg": ""}]
+pages_fetched:
+    description: Number of pages read from the Bitbucket API to get the current state.
+    type: int
+    returned: success
+    sample: 1
+plan:
+    description: Writes that would be sent to the API, returned instead of sending them in check mode.
+    type: list
+    elements: dict
+    returned: check mode
+    sample: [{"label": "promote group developers", "method": "PUT", "url": "https://api.bitbucket.org/2.0/repositories/i2b/example/permissions-config/groups/developers"}]
+metrics:
+    description: Requests sent to the API aggregated per method and endpoint template, with count, errors, 304 answers (not_modified), bytes, retries and p50/p95/max latency in seconds.
+    type: dict
+    returned: always
+    sample: {"requests": 1, "retries": 0, "not_modified": 0, "bytes": 412, "latency": 0.2011, "endpoints": [{"method": "GET", "endpoint": "/2.0/repositories/{workspace}/{repo_slug}", "count": 1, "errors": 0, "not_modified": 0, "bytes": 412, "retries": 0, "p50": 0.2011, "p95": 0.2011, "max": 0.2011}]}
 '''
 
 #pylint: disable=wrong-import-position
@@ -89,43 +111,8 @@ from ansible.module_utils.basic import AnsibleModule
 def manage_permissions(result, bitbucket, module):
     """ CRUD repo permissions """
 
-    # get current groups assigned to the repo
-    current_groups = bitbucket.get_repository_permissions_info(scope='group')
-    # get new groups assigned to the repo
-    new_groups = []
-    for perm in module.params['permissions']:
-        if perm['type'] == 'group':
-            new_groups.extend([perm])
-
-    # actions for new groups
-    for i in new_groups:
-        group_exists = False
-        group_perm = None
-        for x in current_groups:
-            if i['name'].lower() == x['name'].lower():
-                group_exists = True
-                group_perm = x['perm'].lower()
-                break
-
-        if group_exists:
-            # group exists on current groups, update permissions if they are different
-            if not i['perm'].lower() == group_perm:
-                bitbucket.apply_repository_permissions('promote', 'group', i['name'], i['perm'])
-                result['changed'] = True
-        else:
-            # group doesn't exist on current groups, add
-            bitbucket.apply_repository_permissions('promote', 'group', i['name'], i['perm'])
-            result['changed'] = True
-
-    # action for current groups
-    for i in current_groups:
-        if not any(
-            i['name'].lower() == x['name'].lower()
-                for x in new_groups
-        ):
-            # current group doesn't exists on new groups, delete
-            bitbucket.apply_repository_permissions('demote', 'group', i['name'])
-            result['changed'] = True
+    mutations = bitbucket.plan_permissions(module.params['permissions'])
+    bitbucket.apply_mutations(result, mutations)
 
 def run_module():
     """ main module """
@@ -180,11 +167,8 @@ def run_module():
         supports_check_mode=True
     )
 
-    # if the user is working with this module in only check mode we do not
-    # want to make any changes to the environment, just return the current
-    # state with no modifications
-    if module.check_mode:
-        module.exit_json(**result)
+    # in check mode the current state is read and the changes are computed
+    # as usual, they are returned under 'plan' instead of being applied
 
     bitbucket = BitbucketHelper(module)
 
@@ -192,9 +176,12 @@ def run_module():
 
     if existing_repository:
         manage_permissions(result, bitbucket, module)
+        result['pages_fetched'] = bitbucket.pages_fetched
     else:
         module.fail_json(msg="Repository doesn't exists")
 
+    bitbucket.report_metrics(result)
+
     if result is not None:
         module.exit_json(**result)
     else:
@@ -78,6 +78,35 @@ message:
     type: dict
     returned: always
     sample: []
+mutations:
+    description: Outcome of each write sent to the API, in the order they were computed.
+    type: list
+    elements: dict
+    returned: success
+    sample: [{"label": "create variable user", "status": 201, "ok": true, "msg": ""}]
+pages_fetched:
+    description: Number of pages read from the Bitbucket API to get the current state.
+    type: int
+    returned: success
+    sample: 1
+unchanged:
+    description:
+        - True when the desired state and the remote state are the same as at the end of the last
+          successful run recorded under C(state_dir), the comparison was skipped.
+    type: bool
+    returned: success
+    sample: false
+plan:
+    description: Writes that would be sent to the API, returned instead of sending them in check mode.
+    type: list
+    elements: dict
+    returned: check mode
+    sample: [{"label": "create variable user", "method": "POST", "url": "https://api.bitbucket.org/2.0/repositories/i2b/example/pipelines_config/variables/"}]
+metrics:
+    description: Requests sent to the API aggregated per method and endpoint template, with count, errors, 304 answers (not_modified), bytes, retries and p50/p95/max latency in seconds.
+    type: dict
+    returned: always
+    sample: {"requests": 1, "retries": 0, "not_modified": 0, "bytes": 412, "latency": 0.2011, "endpoints": [{"method": "GET", "endpoint": "/2.0/repositories/{workspace}/{repo_slug}", "count": 1, "errors": 0, "not_modified": 0, "bytes": 412, "retries": 0, "p50": 0.2011, "p95": 0.2011, "max": 0.2011}]}
 '''
 
 #pylint: disable=wrong-import-position
@@ -88,54 +117,14 @@ from ansible.module_utils.basic import AnsibleModule
 def manage_variables(result, bitbucket, module):
     """ CRUD variables """
 
-    api_url=bitbucket.BITBUCKET_API_ENDPOINTS['repos-pipeline'].format(
-                url=module.params['url'],
-                workspace='i2b',
-                repo_slug=module.params['repository'])
-
-    current_variables = bitbucket.get_variables(api_url + "/variables/")
-    new_variables = []
-    for var in module.params['variables']:
-        new_variables.extend([var])
-
-    # actions for new variables
-    for i in new_variables:
-        var_exists = False
-        var_value = None
-        var_uuid = None
-        for x in current_variables:
-            if i['name'].lower() == x['key'].lower():
-                var_exists = True
-                var_uuid = x['uuid']
-                if not x['secured']:
-                    var_value = x['value']
-                break
-
-        if var_exists:
-            # always update secured variable
-            if var_value is None:
-                bitbucket.manage_repository_variables('update', i['name'], i['value'], var_uuid, i['secured'])
-                result['changed'] = True
-            # if not secured and value are different, update variable
-            else:
-                if i['value'] != var_value:
-                    bitbucket.manage_repository_variables('update', i['name'], i['value'], var_uuid, i['secured'])
-                    result['changed'] = True
-
-        else:
-            # variable doesn't exist on current variables, add
-            bitbucket.manage_repository_variables('create', i['name'], i['value'], None, i['secured'])
-            result['changed'] = True
-
-    # action for current variables
-    for i in current_variables:
-        if not any(
-            i['key'].lower() == x['name'].lower()
-                for x in new_variables
-        ):
-            # current variable doesn't exists on new variables, delete
-            bitbucket.manage_repository_variables('delete', None, None, i['uuid'], None)
-            result['changed'] = True
+    api_url = bitbucket.repository_variables_url()
+    if bitbucket.converged(api_url, 'variables', module.params['variables']):
+        result['unchanged'] = True
+        return
+
+    mutations = bitbucket.plan_variables(module.params['variables'])
+    bitbucket.apply_mutations(result, mutations)
+    bitbucket.mark_converged(api_url, 'variables', module.params['variables'])
 
 def run_module():
     """ main module """
@@ -191,11 +180,8 @@ def run_module():
         supports_check_mode=True
     )
 
-    # if the user is working with this module in only check mode we do not
-    # want to make any changes to the environment, just return the current
-    # state with no modifications
-    if module.check_mode:
-        module.exit_json(**result)
+    # in check mode the current state is read and the changes are computed
+    # as usual, they are returned under 'plan' instead of being applied
 
     bitbucket = BitbucketHelper(module)
 
@@ -203,9 +189,12 @@ def run_module():
 
     if existing_repository:
         manage_variables(result, bitbucket, module)
+        result['pages_fetched'] = bitbucket.pages_fetched
     else:
         module.fail_json(msg="Repository doesn't exists")
 
+    bitbucket.report_metrics(result)
+
     if result is not None:
         module.exit_json(**result)
     else:
@@ -0,0 +1,505 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+""" bitbucket_workspace module """
+
+# Copyright: (c) 2018, Terry Jones <terry.jones@example.org>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = r'''
+---
+module: bitbucket_workspace
+short_description: Reconcile many repositories of a Bitbucket Cloud workspace at once
+version_added: "2.13.0"
+description:
+    - Reconcile existence, pipelines, permissions, variables, deployment environments and
+      branch restrictions of a list of repositories in a single task.
+    - Every repository is handled in the same process, sharing the connection pool and the
+      rate limiter, instead of running one task per repository and per resource.
+    - The current state of the repositories is read concurrently (up to C(parallelism)
+      repositories at a time), then every write computed for all of them is sent through
+      the same worker pool.
+    - A failure on one repository doesn't stop the others, the module fails at the end
+      and reports which repositories failed.
+    - In check mode the current state is read the same way and the writes that would be
+      sent are returned under C(plan) for each repository, nothing is created or changed.
+options:
+    username:
+        description:
+            - Username used for authentication.
+        type: str
+        required: true
+    password:
+        description:
+            - Password used for authentication.
+        type: str
+        required: true
+    workspace:
+        description:
+            - Workspace ID (slug) that owns the repositories.
+        type: str
+        default: i2b
+        required: false
+    repositories:
+        description:
+            - List of repositories to reconcile.
+            - Resources omitted from a repository (C(null)) are left unchanged, an empty list
+              removes every existing item of that resource, like the single repository modules.
+        type: list
+        elements: dict
+        required: true
+        suboptions:
+            name:
+                type: str
+                description:
+                    - Repository slug.
+                required: true
+            project_key:
+                type: str
+                description:
+                    - Bitbucket project key, required to create the repository when it doesn't exist.
+                required: false
+            pipelines:
+                type: bool
+                description:
+                    - Whether pipelines must be enabled on the repository.
+                    - When omitted the pipeline configuration is left unchanged, except for new
+                      repositories where pipelines are enabled as M(i2btech.ops.bitbucket_repo) does.
+                required: false
+            permissions:
+                type: list
+                elements: dict
+                description:
+                    - Same as the C(permissions) option of M(i2btech.ops.bitbucket_repo_perm).
+                required: false
+            variables:
+                type: list
+                elements: dict
+                description:
+                    - Same as the C(variables) option of M(i2btech.ops.bitbucket_repo_var).
+                required: false
+            environments:
+                type: list
+                elements: dict
+                description:
+                    - Deployment environments, same options as M(i2btech.ops.bitbucket_repo_env).
+                    - Environments not in the list are left unchanged.
+                required: false
+                suboptions:
+                    name:
+                        type: str
+                        description:
+                            - Name of environment
+                        required: true
+                    type:
+                        type: str
+                        description:
+                            - Type of deployment environment
+                        choices: [ Test, Staging, Production ]
+                        required: true
+                    variables:
+                        type: list
+                        elements: dict
+                        description:
+                            - List of variables that will be managed
+                        required: false
+            restrictions:
+                type: list
+                elements: dict
+                description:
+                    - Same as the C(restrictions) option of M(i2btech.ops.bitbucket_branch_restriction).
+                required: false
+author:
+    - IT I2B (it@i2btech.com)
+'''
+
+EXAMPLES = r'''
+- name: "Reconcile every repository of the workspace"
+  i2btech.ops.bitbucket_workspace:
+    username: "alice"
+    password: "app_password"
+    parallelism: 10
+    repositories:
+      - name: "example-X"
+        project_key: "POC"
+        pipelines: true
+        permissions:
+          - type: group
+            name: developers
+            perm: write
+        variables:
+          - name: user
+            value: xxx
+          - name: pass
+            value: yyy
+            secured: true
+        environments:
+          - name: Integration
+            type: Test
+            variables:
+              - name: db_user
+                value: user_db
+        restrictions:
+          - kind: force
+            branch_match_kind: glob
+            pattern: "main"
+      - name: "example-Y"
+        variables: []
+'''
+
+RETURN = r'''
+repositories:
+    description: Outcome of the reconciliation of each repository, in the order they were given.
+    type: list
+    elements: dict
+    returned: always
+    sample:
+        - name: "example-X"
+          changed: true
+          created: false
+          failed: false
+          msg: ""
+          pages_fetched: 4
+          mutations:
+            - label: "create variable user"
+              status: 201
+              ok: true
+              msg: ""
+          plan:
+            - label: "create variable user"
+              method: "POST"
+              url: "https://api.bitbucket.org/2.0/repositories/i2b/example-X/pipelines_config/variables/"
+metrics:
+    description: Requests sent to the API aggregated per method and endpoint template, with count, errors, 304 answers (not_modified), bytes, retries and p50/p95/max latency in seconds.
+    type: dict
+    returned: always
+    sample: {"requests": 1, "retries": 0, "not_modified": 0, "bytes": 412, "latency": 0.2011, "endpoints": [{"method": "GET", "endpoint": "/2.0/repositories/{workspace}/{repo_slug}", "count": 1, "errors": 0, "not_modified": 0, "bytes": 412, "retries": 0, "p50": 0.2011, "p95": 0.2011, "max": 0.2011}]}
+'''
+
+#pylint: disable=wrong-import-position
+from concurrent.futures import ThreadPoolExecutor
+from ansible_collections.i2btech.ops.plugins.module_utils.bitbucket import BitbucketHelper, BitbucketError
+from ansible.module_utils.basic import AnsibleModule
+#pylint: disable=wrong-import-position
+
+
+def prepare_repository(bitbucket, spec, check_mode=False):
+    """
+    Create what the other resources depend on (the repository itself and missing
+    deployment environments), read the current state and compute every write needed.
+    In check mode nothing is created, the creations are returned with the other
+    mutations and the resources of a missing repository are planned as empty.
+    Returns the report of the repository and the list of mutations.
+    """
+
+    report = dict(
+        name=spec['name'],
+        changed=False,
+        created=False,
+        failed=False,
+        msg='',
+        pages_fetched=0,
+        mutations=[],
+    )
+    mutations = []
+
+    try:
+        pipelines = spec['pipelines']
+        exists = bool(bitbucket.get_repository_info())
+        if not exists:
+            if not spec['project_key']:
+                raise BitbucketError("Repository doesn't exist and no project_key was given to create it")
+            if check_mode:
+                mutations.append(bitbucket.repository_mutation(spec['project_key']))
+            else:
+                bitbucket.create_repository(spec['project_key'])
+                exists = True
+            report['created'] = True
+            report['changed'] = True
+            if pipelines is None:
+                pipelines = True
+
+        # resources of a repository that doesn't exist yet (check mode) are empty
+        empty = None if exists else []
+
+        if pipelines is not None:
+            enabled = bool(bitbucket.get_repository_pipeline().get('enabled')) if exists else False
+            if enabled != pipelines:
+                mutations.append(bitbucket.repository_pipeline_mutation(pipelines))
+
+        if spec['permissions'] is not None:
+            mutations.extend(bitbucket.plan_permissions(spec['permissions'], empty))
+
+        if spec['variables'] is not None:
+            mutations.extend(bitbucket.plan_variables(spec['variables'], empty))
+
+        for env in spec['environments'] or []:
+            environment = bitbucket.find_environment(env['name'], env['type']) if exists else None
+            current_variables = []
+            if environment is None:
+                if check_mode:
+                    mutations.append(bitbucket.environment_mutation('create', env['name'], env['type']))
+                    environment = dict(uuid=bitbucket.NEW_ENVIRONMENT_UUID)
+                else:
+                    environment = bitbucket.manage_repository_environments('create', env['name'], env['type'])
+                report['changed'] = True
+            elif env['variables'] is not None:
+                current_variables = bitbucket.iter_variables(bitbucket.environment_variables_url(environment['uuid']))
+            if env['variables'] is not None:
+                mutations.extend(bitbucket.plan_environment_variables(
+                    environment['uuid'], env['variables'], current_variables))
+
+        if spec['restrictions'] is not None:
+            mutations.extend(bitbucket.plan_restrictions(spec['restrictions'], empty))
+
+    except BitbucketError as exc:
+        report['failed'] = True
+        report['msg'] = str(exc)
+        mutations = []
+
+    report['pages_fetched'] = bitbucket.pages_fetched
+    return report, mutations
+
+
+def reconcile_repositories(result, bitbucket, module):
+    """ Reconcile every repository of the list """
+
+    specs = module.params['repositories']
+    workers = max(1, min(module.params['parallelism'], len(specs)))
+
+    # read phase, one repository per worker
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        prepared = list(executor.map(
+            lambda spec: prepare_repository(bitbucket.for_repository(spec['name']), spec, module.check_mode),
+            specs))
+
+    result['repositories'] = [report for report, dummy in prepared]
+
+    # check mode, report the writes of each repository without sending them
+    if module.check_mode:
+        for report, repo_mutations in prepared:
+            report['plan'] = []
+            bitbucket.plan(report, repo_mutations)
+        result['changed'] = any(report['changed'] for report in result['repositories'])
+        return
+
+    # write phase, every mutation of every repository through the same worker pool
+    owners = []
+    mutations = []
+    for report, repo_mutations in prepared:
+        owners.extend([report] * len(repo_mutations))
+        mutations.extend(repo_mutations)
+
+    for report, outcome in zip(owners, bitbucket.run_mutations(mutations)):
+        report['mutations'].append(dict(
+            label=outcome['label'],
+            status=outcome['status'],
+            ok=outcome['ok'],
+            msg=outcome['msg'],
+        ))
+        if outcome['ok']:
+            report['changed'] = True
+        else:
+            report['failed'] = True
+            report['msg'] = 'Some changes failed'
+
+    result['changed'] = any(report['changed'] for report in result['repositories'])
+
+
+def run_module():
+    """ main module """
+
+    # define available arguments/parameters a user can pass to the module
+
+    perm_spec = dict(
+        type=dict(
+            required=True,
+            type='str',
+            choices=['user', 'group']),
+        name=dict(
+            required=True,
+            type='str'),
+        perm=dict(
+            required=False,
+            type='str',
+            choices=['admin', 'write', 'read'])
+    )
+
+    variable_spec = dict(
+        name=dict(
+            required=True,
+            type='str',
+            no_log=False,),
+        value=dict(
+            required=True,
+            no_log=True,
+            type='str'),
+        secured=dict(
+            required=False,
+            type='bool',
+            default=False)
+    )
+
+    environment_spec = dict(
+        name=dict(
+            required=True,
+            type='str',
+            no_log=False,),
+        type=dict(
+            required=True,
+            type='str',
+            no_log=False,
+            choices=['Staging', 'Test', 'Production']),
+        variables=dict(
+            required=False,
+            no_log=False,
+            type='list',
+            elements='dict',
+            options=variable_spec),
+    )
+
+    restriction_spec = dict(
+        kind=dict(
+            required=True,
+            type='str',
+            choices=[
+                'push',
+                'force',
+                'delete',
+                'restrict_merges',
+                'require_tasks_to_be_completed',
+                'require_approvals_to_merge',
+                'require_default_reviewer_approvals_to_merge',
+                'require_no_changes_requested',
+                'require_passing_builds_to_merge',
+                'require_commits_behind',
+                'reset_pullrequest_approvals_on_change',
+                'smart_reset_pullrequest_approvals',
+                'reset_pullrequest_changes_requested_on_change',
+                'require_all_dependencies_merged',
+                'enforce_merge_checks',
+                'allow_auto_merge_when_builds_pass',
+            ],
+        ),
+        branch_match_kind=dict(
+            required=True,
+            type='str',
+            choices=['glob', 'branching_model'],
+        ),
+        pattern=dict(
+            required=False,
+            type='str',
+            default=None,
+        ),
+        branch_type=dict(
+            required=False,
+            type='str',
+            choices=['production', 'development', 'bugfix', 'release', 'feature', 'hotfix'],
+            default=None,
+        ),
+        value=dict(
+            required=False,
+            type='int',
+            default=None,
+        ),
+        users=dict(
+            required=False,
+            type='list',
+            elements='str',
+            default=[],
+        ),
+        groups=dict(
+            required=False,
+            type='list',
+            elements='str',
+            default=[],
+        ),
+    )
+
+    repository_spec = dict(
+        name=dict(
+            required=True,
+            type='str',
+            no_log=False),
+        project_key=dict(
+            required=False,
+            type='str',
+            no_log=False),
+        pipelines=dict(
+            required=False,
+            type='bool'),
+        permissions=dict(
+            required=False,
+            type='list',
+            elements='dict',
+            no_log=False,
+            options=perm_spec),
+        variables=dict(
+            required=False,
+            type='list',
+            elements='dict',
+            no_log=False,
+            options=variable_spec),
+        environments=dict(
+            required=False,
+            type='list',
+            elements='dict',
+            no_log=False,
+            options=environment_spec),
+        restrictions=dict(
+            required=False,
+            type='list',
+            elements='dict',
+            no_log=False,
+            options=restriction_spec),
+    )
+
+    module_args = BitbucketHelper.bitbucket_argument_spec()
+    module_args.update(
+        workspace=dict(
+            type='str',
+            required=False,
+            no_log=False,
+            default=BitbucketHelper.BITBUCKET_WORKSPACE),
+        repositories=dict(
+            type='list',
+            elements='dict',
+            required=True,
+            no_log=False,
+            options=repository_spec),
+    )
+
+    result = dict(
+        changed=False,
+        repositories=[],
+    )
+
+    module = AnsibleModule(
+        argument_spec=module_args,
+        supports_check_mode=True,
+    )
+
+    bitbucket = BitbucketHelper(module)
+
+    reconcile_repositories(result, bitbucket, module)
+
+    failed = [report['name'] for report in result['repositories'] if report['failed']]
+    bitbucket.report_metrics(result)
+    if failed:
+        module.fail_json(
+            msg='{} of {} repositories failed: {}'.format(len(failed), len(result['repositories']), ', '.join(failed)),
+            **result
+        )
+
+    module.exit_json(**result)
+
+
+def main():
+    """ main function """
+
+    run_module()
+
+
+if __name__ == '__main__':
+    main()
@@ -67,6 +67,37 @@ options:
         type: list
         elements: str
         required: false
+    parallelism:
+        description:
+          - Number of users whose signature is updated at the same time.
+        type: int
+        required: false
+        default: 5
+    state_file:
+        description:
+          - File where the digest of the signature pushed to each user is kept, on the host running the module.
+          - When set, users whose rendered signature didn't change since the last run are skipped.
+          - Remove the file, or the user from it, to push a signature changed outside Ansible.
+        type: path
+        required: false
+    signature_compare:
+        description:
+          - Read the current signature of every user first, in parallel, and only update the ones that are different.
+          - Gmail may rewrite the HTML of a signature when it stores it, both signatures are compared once normalized
+            (HTML entities, self closing tags, case of the tag names, quotes and whitespace).
+          - With C(state_file), the digest of the signature as Gmail stored it is kept too, and a current signature
+            equal to it counts as unchanged while the rendered signature doesn't change, whatever Gmail rewrote.
+            Users aren't skipped from the file alone, the current signature is always read.
+          - The updates are sent in batch requests of 50 users and C(changed) is only true when a signature was updated.
+        type: bool
+        required: false
+        default: false
+    retries:
+        description:
+          - Number of times a Gmail request is sent again, with backoff, when it gets a 429 or 5xx answer.
+        type: int
+        required: false
+        default: 3
 
 author:
     - IT I2B
@@ -111,6 +142,12 @@ message:
     type: str
     returned: always
     sample: 'Signatures updated'
+users:
+    description: Outcome of the signature update of each user.
+    type: list
+    elements: dict
+    returned: when action is signature
+    sample: [{"user": "user.name@i2btech.com", "changed": true, "failed": false, "message": "Signature updated"}]
 '''
 
 from ansible.module_utils.basic import AnsibleModule
@@ -126,7 +163,11 @@ def run_module():
         users_definition=dict(type="list", required=False, elements="dict"),
         groups_definition=dict(type="list", required=False, elements="dict"),
         users=dict(type="list", elements="str", required=False, default=[]),
-        groups=dict(type="list", elements="str", required=False, default=[])
+        groups=dict(type="list", elements="str", required=False, default=[]),
+        parallelism=dict(type="int", required=False, default=5),
+        retries=dict(type="int", required=False, default=3),
+        state_file=dict(type="path", required=False),
+        signature_compare=dict(type="bool", required=False, default=False)
     )
 
     # seed the result dict in the object
@@ -172,6 +213,8 @@ def run_module():
     result['message'] = result_action["message"]
     result['changed'] = result_action["changed"]
     result['failed'] = result_action["failed"]
+    if "users" in result_action:
+        result['users'] = result_action["users"]
 
 
     # during the execution of the module, if there is an exception or a
@@ -0,0 +1,245 @@
+"""
+Benchmark of the bitbucket modules against the local stand-in of the API
+(bitbucket_fake_server.py), no credentials needed.
+
+For every module and size, the fake API is seeded with `size` resources (variables,
+permissions, branch restrictions, group members and privileges or repositories) and
+the module is run once with a desired state that differs by 10%: some resources are
+updated, some created and some deleted. The requests received by the server and the
+wall time of the module are reported.
+
+    python bitbucket_benchmark.py
+    python bitbucket_benchmark.py --sizes 10 100 --modules bitbucket_repo_var --latency 0.02
+    python bitbucket_benchmark.py --json >> bench.jsonl
+"""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import sys
+import time
+
+# the collection as laid out for ansible.cfg of this folder
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'collections'))
+
+# pylint: disable=wrong-import-position
+from ansible.module_utils import basic
+from ansible.module_utils.common.text.converters import to_bytes
+from bitbucket_fake_server import FakeBitbucket, FakeBitbucketServer, new_uuid
+# pylint: enable=wrong-import-position
+
+# the workspace of the modules without a workspace option
+WORKSPACE = 'i2b'
+
+
+def _drift(size):
+    return max(1, size // 10)
+
+
+def _variables(size):
+    drift = _drift(size)
+    return [
+        dict(name='var_{}'.format(i), value='changed-{}'.format(i) if i < drift else 'value-{}'.format(i))
+        for i in range(size - drift)
+    ] + [dict(name='var_{}'.format(i), value='value-{}'.format(i)) for i in range(size, size + drift)]
+
+
+def repo_var(api, size):
+    """ size variables, 10% updated, created and deleted """
+
+    api.seed(repositories=1, variables=size)
+    return dict(repository='repo-0', variables=_variables(size))
+
+
+def repo_perm(api, size):
+    """ size group permissions, 10% updated, created and deleted """
+
+    api.seed(repositories=1, permissions=size)
+    drift = _drift(size)
+    permissions = [
+        dict(type='group', name='group-{}'.format(i), perm='write' if i < drift else 'read')
+        for i in range(size - drift)
+    ] + [dict(type='group', name='group-{}'.format(i), perm='read') for i in range(size, size + drift)]
+    return dict(repository='repo-0', permissions=permissions)
+
+
+def repo_env(api, size):
+    """ an environment with size variables, 10% updated, created and deleted """
+
+    api.seed(repositories=1, environments=1, variables=size)
+    return dict(repository='repo-0', name='env-0', type='Test', variables=_variables(size))
+
+
+def branch_restriction(api, size):
+    """ size branch restrictions, 10% updated, created and deleted """
+
+    api.seed(repositories=1, restrictions=size)
+    drift = _drift(size)
+    restrictions = [
+        dict(kind='push', branch_match_kind='glob', pattern='release/{}'.format(i),
+             groups=['developers'] if i < drift else [])
+        for i in range(size - drift)
+    ] + [dict(kind='push', branch_match_kind='glob', pattern='release/{}'.format(i)) for i in range(size, size + drift)]
+    return dict(repository='repo-0', restrictions=restrictions)
+
+
+def group_management(api, size):
+    """ a group with size members and privileges on size repositories, 10% changed """
+
+    drift = _drift(size)
+    api.seed(repositories=size + drift, groups=1, members=size)
+    group = api.groups['group-0']
+    group['privileges'] = dict(('repo-{}'.format(i), 'read') for i in range(size))
+    members = group['members'][:size - drift] + [new_uuid() for dummy in range(drift)]
+    repo_permissions = [
+        dict(repository='repo-{}'.format(i), privilege='write' if i < drift else 'read')
+        for i in range(size - drift)
+    ] + [dict(repository='repo-{}'.format(i), privilege='read') for i in range(size, size + drift)]
+    return dict(workspace=WORKSPACE, name='group-0', permission='read', members=members,
+                repo_permissions=repo_permissions)
+
+
+def workspace(api, size):
+    """ size repositories with two variables, 10% of the repositories are created """
+
+    drift = _drift(size)
+    api.seed(repositories=size - drift, variables=2)
+    repositories = [
+        dict(
+            name='repo-{}'.format(i),
+            project_key='POC',
+            pipelines=True,
+            variables=[
+                dict(name='var_0', value='changed-0'),
+                dict(name='var_1', value='value-1'),
+            ],
+        )
+        for i in range(size)
+    ]
+    return dict(workspace=WORKSPACE, repositories=repositories)
+
+
+SCENARIOS = {
+    'bitbucket_repo_var': repo_var,
+    'bitbucket_repo_perm': repo_perm,
+    'bitbucket_repo_env': repo_env,
+    'bitbucket_branch_restriction': branch_restriction,
+    'bitbucket_group_management': group_management,
+    'bitbucket_workspace': workspace,
+}
+
+
+def run_module(name, args):
+    """
+    Run a module in this process with args, returns its result.
+    """
+
+    module = importlib.import_module('ansible_collections.i2btech.ops.plugins.modules.' + name)
+    basic._ANSIBLE_ARGS = to_bytes(json.dumps({'ANSIBLE_MODULE_ARGS': args}))
+    # ansible-core >= 2.19 needs the serialization profile of the arguments
+    basic._ANSIBLE_PROFILE = 'legacy'
+
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        try:
+            module.main()
+        except SystemExit:
+            pass
+    return json.loads(output.getvalue())
+
+
+def benchmark(name, size, options):
+    """
+    Run a module against a fresh fake API seeded for size resources, returns the measures.
+    """
+
+    api = FakeBitbucket(
+        workspace=WORKSPACE,
+        latency=options.latency,
+        max_pagelen=options.max_pagelen,
+        throttle_every=options.throttle_every,
+    )
+    args = SCENARIOS[name](api, size)
+
+    with FakeBitbucketServer(api) as server:
+        args.update(
+            url=server.url,
+            username='benchmark',
+            password='benchmark-app-password',
+            cache=False,
+            rate_limit=options.rate_limit,
+            parallelism=options.parallelism,
+            pool_size=options.pool_size,
+            transport=options.transport,
+            partial_response=options.partial_response,
+        )
+        started = time.monotonic()
+        result = run_module(name, args)
+        wall = time.monotonic() - started
+
+    stats = api.stats()
+    return dict(
+        module=name,
+        size=size,
+        transport=options.transport,
+        latency=options.latency,
+        requests=stats['requests'],
+        bytes=stats['bytes'],
+        throttled=stats['throttled'],
+        retries=result.get('metrics', {}).get('retries', 0),
+        changed=result.get('changed'),
+        failed=bool(result.get('failed')),
+        msg=result.get('msg', ''),
+        wall=round(wall, 3),
+        endpoints=stats['endpoints'],
+    )
+
+
+def main():
+    """ Run the benchmark and print a table, or JSON lines with --json """
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n', 1)[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--modules', nargs='+', choices=sorted(SCENARIOS), default=sorted(SCENARIOS))
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds waited by the server before each answer')
+    parser.add_argument('--max-pagelen', type=int, default=100, help='largest page size of the listings')
+    parser.add_argument('--throttle-every', type=int, default=0, help='answer 429 to every Nth request')
+    parser.add_argument('--rate-limit', type=float, default=0, help='rate_limit option of the modules')
+    parser.add_argument('--parallelism', type=int, default=5, help='parallelism option of the modules')
+    parser.add_argument('--pool-size', type=int, default=10, help='pool_size option of the modules')
+    parser.add_argument('--transport', choices=['sync', 'async'], default='sync')
+    parser.add_argument('--no-partial-response', dest='partial_response', action='store_false',
+                        help='disable the partial_response option of the modules')
+    parser.add_argument('--json', action='store_true', help='print one JSON object per run')
+    options = parser.parse_args()
+
+    if not options.json:
+        print('{:<30} {:>6} {:>9} {:>6} {:>9} {:>8} {:>9}  {}'.format(
+            'module', 'size', 'requests', '429', 'KiB', 'wall (s)', 'req/s', 'result'))
+
+    for name in options.modules:
+        for size in options.sizes:
+            measure = benchmark(name, size, options)
+            if options.json:
+                print(json.dumps(measure, sort_keys=True))
+                continue
+            print('{:<30} {:>6} {:>9} {:>6} {:>9.1f} {:>8.3f} {:>9.1f}  {}'.format(
+                name,
+                size,
+                measure['requests'],
+                measure['throttled'],
+                measure['bytes'] / 1024.0,
+                measure['wall'],
+                measure['requests'] / measure['wall'] if measure['wall'] else 0,
+                'failed: ' + measure['msg'] if measure['failed'] else ('changed' if measure['changed'] else 'ok'),
+            ))
+
+
+if __name__ == '__main__':
+    main()
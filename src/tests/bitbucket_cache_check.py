@@ -0,0 +1,98 @@
+"""
+Check of the conditional GETs of the bitbucket modules against the local stand-in of the
+API (bitbucket_fake_server.py) answering with ETags, no credentials needed.
+
+bitbucket_repo_var is run three times with the local cache enabled:
+
+1. the variables are listed, the answer and its ETag are stored in the cache;
+2. nothing changed: the listing is revalidated with If-None-Match, the API answers
+   304 Not Modified and the module uses the cached body, no write is sent;
+3. a variable is changed on the API: the revalidation gets a 200 with the new listing
+   instead of the stale cached one, and the module updates the variable.
+
+    python bitbucket_cache_check.py
+
+Exits with status 1 and the failed check when the modules don't behave that way.
+"""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import shutil
+import sys
+import tempfile
+
+# pylint: disable=wrong-import-position
+from bitbucket_benchmark import WORKSPACE, run_module
+from bitbucket_fake_server import FakeBitbucket, FakeBitbucketServer
+# pylint: enable=wrong-import-position
+
+VARIABLES = 20
+
+
+def listing_requests(api):
+    """ Status of the GET requests of the variables listing received by the API """
+    return [
+        status for method, endpoint, status in api.requests
+        if method == 'GET' and endpoint.endswith('/pipelines_config/variables')
+    ]
+
+
+def writes(api):
+    """ Number of writes received by the API """
+    return len([method for method, dummy, dummy in api.requests if method != 'GET'])
+
+
+def check(condition, message):
+    """ Print the outcome of a check, exit when it failed """
+    print('{} {}'.format('ok  ' if condition else 'FAIL', message))
+    if not condition:
+        sys.exit(1)
+
+
+def main():
+    """ Run the three runs and check the requests received by the API """
+
+    api = FakeBitbucket(workspace=WORKSPACE, etags=True)
+    api.seed(repositories=1, variables=VARIABLES)
+    cache_dir = tempfile.mkdtemp()
+
+    try:
+        with FakeBitbucketServer(api) as server:
+            args = dict(
+                url=server.url,
+                username='check',
+                password='check-app-password',
+                cache=True,
+                cache_dir=cache_dir,
+                repository='repo-0',
+                variables=[dict(name='var_{}'.format(i), value='value-{}'.format(i)) for i in range(VARIABLES)],
+            )
+
+            result = run_module('bitbucket_repo_var', args)
+            check(not result.get('failed') and not result['changed'], 'first run converged')
+            check(listing_requests(api) == [200], 'first run downloaded the listing')
+
+            api.reset_stats()
+            result = run_module('bitbucket_repo_var', args)
+            check(not result.get('failed') and not result['changed'], 'second run unchanged')
+            check(listing_requests(api) == [304], 'second run revalidated the listing and got 304')
+            check(api.stats()['bytes'] == 0, 'second run downloaded nothing')
+            check(result['metrics']['not_modified'] == 1, 'second run reported the 304 under metrics.not_modified')
+            check(writes(api) == 0, 'second run sent no write')
+
+            for variable in api.repositories['repo-0']['variables']:
+                if variable['key'] == 'var_0':
+                    variable['value'] = 'changed outside Ansible'
+
+            api.reset_stats()
+            result = run_module('bitbucket_repo_var', args)
+            check(not result.get('failed') and result['changed'], 'third run changed')
+            check(listing_requests(api) == [200], 'third run got the new listing instead of the cached one')
+            check(writes(api) == 1, 'third run updated the variable changed on the API')
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
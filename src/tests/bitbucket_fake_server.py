@@ -0,0 +1,697 @@
+"""
+Local stand-in for the Bitbucket API, to run the bitbucket modules and measure them
+without credentials nor api.bitbucket.org.
+
+It serves the endpoints of BitbucketHelper.BITBUCKET_API_ENDPOINTS under /2.0 and the
+groups, group members and group privileges endpoints of the API v1 under /1.0, from
+an in-memory dataset. Point the `url` option of the modules to http://<host>:<port>/2.0,
+the API v1 URL is derived from it.
+
+Run it standalone:
+
+    python bitbucket_fake_server.py --port 8080 --latency 0.05 --max-pagelen 50 --throttle-every 20
+
+or from Python with FakeBitbucketServer (see bitbucket_benchmark.py).
+"""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import argparse
+import hashlib
+import json
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+
+def new_uuid():
+    """ uuid in the format used by Bitbucket, between braces """
+    return '{' + str(uuid.uuid4()) + '}'
+
+
+def _decode_uuid(value):
+    return value.replace('%7B', '{').replace('%7b', '{').replace('%7D', '}').replace('%7d', '}')
+
+
+def select_fields(value, fields):
+    """
+    Keep only the keys of value listed in fields, a partial response `fields` parameter
+    such as 'values.uuid,values.user.nickname,size'.
+    """
+
+    tree = {}
+    for field in fields.split(','):
+        node = tree
+        for key in field.strip().split('.'):
+            node = node.setdefault(key, {})
+    return _select(value, tree)
+
+
+def _select(value, tree):
+    if not tree:
+        return value
+    if isinstance(value, list):
+        return [_select(item, tree) for item in value]
+    if isinstance(value, dict):
+        return dict((key, _select(value[key], subtree)) for key, subtree in tree.items() if key in value)
+    return value
+
+#
+# class: FakeBitbucket
+#
+
+class FakeBitbucket:
+    """
+    In-memory dataset of a workspace, with the knobs of the server:
+    latency: seconds waited before answering each request.
+    max_pagelen: largest page size returned by the paginated listings.
+    throttle_every: answer 429 to every Nth request, 0 disables it.
+    retry_after: value of the Retry-After header sent with a 429.
+    etags: send an ETag with every successful GET and answer 304 Not Modified, without
+    body, when the If-None-Match header of the request matches it.
+    """
+
+    def __init__(self, workspace='i2b', latency=0.0, max_pagelen=100, throttle_every=0, retry_after=0.1,
+                 etags=False):
+        self.workspace = workspace
+        self.latency = latency
+        self.max_pagelen = max_pagelen
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.etags = etags
+        self.repositories = {}
+        self.groups = {}
+        self.requests = []
+        self.bytes_sent = 0
+        self._lock = threading.RLock()
+        self._restriction_id = 0
+        self._base = ''
+
+    #
+    # dataset
+    #
+
+    def add_repository(self, slug, project_key='POC', pipelines=False):
+        """
+        Add a repository, returns its entry.
+        """
+
+        with self._lock:
+            repository = dict(
+                slug=slug,
+                project_key=project_key,
+                uuid=new_uuid(),
+                pipelines=pipelines,
+                users={},
+                groups={},
+                variables=[],
+                environments=[],
+                restrictions=[],
+            )
+            self.repositories[slug] = repository
+            return repository
+
+    def add_variable(self, repo_slug, key, value, secured=False, env_uuid=None):
+        """
+        Add a pipeline variable to a repository, or to one of its environments.
+        """
+
+        with self._lock:
+            variable = dict(type='pipeline_variable', uuid=new_uuid(), key=key, value=value, secured=secured)
+            self._variables(self.repositories[repo_slug], env_uuid).append(variable)
+            return variable
+
+    def add_environment(self, repo_slug, name, category='Test'):
+        """
+        Add a deployment environment to a repository.
+        """
+
+        with self._lock:
+            environment = dict(
+                type='deployment_environment',
+                uuid=new_uuid(),
+                name=name,
+                environment_type=dict(type='deployment_environment_type', name=category),
+                variables=[],
+            )
+            self.repositories[repo_slug]['environments'].append(environment)
+            return environment
+
+    def add_restriction(self, repo_slug, kind, pattern=None, branch_type=None, value=None):
+        """
+        Add a branch restriction to a repository.
+        """
+
+        with self._lock:
+            self._restriction_id += 1
+            restriction = dict(
+                type='branchrestriction',
+                id=self._restriction_id,
+                kind=kind,
+                branch_match_kind='glob' if pattern is not None else 'branching_model',
+                users=[],
+                groups=[],
+            )
+            if pattern is not None:
+                restriction['pattern'] = pattern
+            else:
+                restriction['branch_type'] = branch_type
+            if value is not None:
+                restriction['value'] = value
+            self.repositories[repo_slug]['restrictions'].append(restriction)
+            return restriction
+
+    def add_group(self, name, permission=None, members=None, privileges=None):
+        """
+        Add a group to the workspace.
+        members: list of account uuids.
+        privileges: dict of privilege by repository slug.
+        """
+
+        with self._lock:
+            slug = self.slugify(name)
+            group = dict(
+                name=name,
+                slug=slug,
+                permission=permission,
+                members=list(members or []),
+                privileges=dict(privileges or {}),
+            )
+            self.groups[slug] = group
+            return group
+
+    @staticmethod
+    def slugify(name):
+        """ slug of a group, same as the API """
+        return re.sub(r'[^a-z0-9_-]+', '-', name.lower()).strip('-')
+
+    def seed(self, repositories=1, variables=0, environments=0, restrictions=0, permissions=0,
+             groups=0, members=0):
+        """
+        Fill the dataset: `repositories` repositories named repo-<n>, each one with the given
+        number of variables, environments (with `variables` variables each), branch restrictions
+        and group permissions; `groups` groups named group-<n> with `members` members each and
+        a privilege on every repository.
+        """
+
+        for index in range(repositories):
+            slug = 'repo-{}'.format(index)
+            self.add_repository(slug, pipelines=True)
+            for var_index in range(variables):
+                self.add_variable(slug, 'var_{}'.format(var_index), 'value-{}'.format(var_index))
+            for env_index in range(environments):
+                environment = self.add_environment(slug, 'env-{}'.format(env_index))
+                for var_index in range(variables):
+                    self.add_variable(slug, 'var_{}'.format(var_index), 'value-{}'.format(var_index),
+                                      env_uuid=environment['uuid'])
+            for restriction_index in range(restrictions):
+                self.add_restriction(slug, 'push', pattern='release/{}'.format(restriction_index))
+            for perm_index in range(permissions):
+                self.repositories[slug]['groups']['group-{}'.format(perm_index)] = 'read'
+
+        for index in range(groups):
+            self.add_group(
+                'group-{}'.format(index),
+                permission='read',
+                members=[new_uuid() for dummy in range(members)],
+                privileges=dict(('repo-{}'.format(repo), 'read') for repo in range(repositories)),
+            )
+
+    #
+    # requests
+    #
+
+    def stats(self):
+        """
+        Number of requests received, in total and by method and endpoint, and 429 and 304 sent.
+        """
+
+        with self._lock:
+            requests = list(self.requests)
+
+        endpoints = {}
+        for method, endpoint, status in requests:
+            key = '{} {}'.format(method, endpoint)
+            endpoints[key] = endpoints.get(key, 0) + 1
+        return dict(
+            requests=len(requests),
+            bytes=self.bytes_sent,
+            throttled=len([status for dummy, dummy, status in requests if status == 429]),
+            not_modified=len([status for dummy, dummy, status in requests if status == 304]),
+            endpoints=endpoints,
+        )
+
+    def reset_stats(self):
+        """ Forget the requests received so far """
+        with self._lock:
+            self.requests = []
+            self.bytes_sent = 0
+
+    def sent(self, size):
+        """ Count the bytes of a response body """
+        with self._lock:
+            self.bytes_sent += size
+
+    def handle(self, method, path, body, content_type, host=None, if_none_match=None):
+        """
+        Answer a request, returns (status, headers, body as JSON serializable value or None).
+        host: Host header of the request, used to build the `next` links.
+        if_none_match: If-None-Match header of the request, see the etags knob.
+        """
+
+        parts = urlsplit(path)
+        query = dict(parse_qsl(parts.query))
+        segments = [_decode_uuid(segment) for segment in parts.path.strip('/').split('/')]
+
+        with self._lock:
+            self._base = 'http://' + host if host else ''
+            endpoint = self._endpoint(segments)
+            throttled = self.throttle_every and (len(self.requests) + 1) % self.throttle_every == 0
+            self.requests.append((method, endpoint, 429 if throttled else None))
+            position = len(self.requests) - 1
+            if throttled:
+                return 429, {'Retry-After': str(self.retry_after)}, dict(error=dict(message='Rate limit exceeded'))
+
+            try:
+                data = self._parse_body(body, content_type)
+                if segments[:1] == ['2.0'] and segments[1:2] == ['repositories'] and len(segments) >= 4:
+                    status, content = self._repository(method, segments[2], segments[3], segments[4:], data, parts.path, query)
+                elif segments[:1] == ['1.0'] and segments[1:2] == ['groups'] and len(segments) >= 3:
+                    status, content = self._groups(method, segments[3:], data)
+                elif segments[:1] == ['1.0'] and segments[1:2] == ['group-privileges'] and len(segments) >= 5:
+                    status, content = self._group_privileges(method, segments[3:], data)
+                else:
+                    status, content = 404, None
+            except (KeyError, IndexError, ValueError):
+                status, content = 400, dict(error=dict(message='bad request'))
+
+            self.requests[position] = (method, endpoint, status)
+
+        if status == 404 and content is None:
+            content = dict(type='error', error=dict(message='Not found'))
+        elif status == 200 and method == 'GET' and query.get('fields'):
+            content = select_fields(content, query['fields'])
+
+        headers = {}
+        if self.etags and status == 200 and method == 'GET':
+            headers['ETag'] = self.etag(content)
+            if if_none_match == headers['ETag']:
+                with self._lock:
+                    self.requests[position] = (method, endpoint, 304)
+                return 304, headers, None
+        return status, headers, content
+
+    @staticmethod
+    def etag(content):
+        """ Strong validator of a response body """
+        return '"{}"'.format(hashlib.sha1(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest())
+
+    @staticmethod
+    def _endpoint(segments):
+        # path parameters after the version and the resource, e.g. /1.0/group-privileges/{workspace}/...
+        parameters = 4 if segments[1:2] == ['group-privileges'] else 2
+        template = []
+        for index, segment in enumerate(segments):
+            if 2 <= index < 2 + parameters:
+                template.append('{param}')
+            elif segment.startswith('{') or segment.isdigit():
+                template.append('{id}')
+            else:
+                template.append(segment)
+        return '/' + '/'.join(template)
+
+    @staticmethod
+    def _parse_body(body, content_type):
+        if not body:
+            return {}
+        text = body.decode('utf-8')
+        if 'x-www-form-urlencoded' in (content_type or ''):
+            fields = parse_qsl(text, keep_blank_values=True)
+            # the privilege is sent as a bare value
+            if len(fields) == 1 and fields[0][1] == '':
+                return dict(value=fields[0][0])
+            return dict(fields)
+        return json.loads(text)
+
+    def _page(self, path, query, values):
+        pagelen = min(int(query.get('pagelen', 10)), self.max_pagelen)
+        page = int(query.get('page', 1))
+        start = (page - 1) * pagelen
+        content = dict(
+            values=values[start:start + pagelen],
+            size=len(values),
+            page=page,
+            pagelen=pagelen,
+        )
+        if start + pagelen < len(values):
+            next_query = dict(query, page=page + 1)
+            content['next'] = '{}{}?{}'.format(self._base, path, '&'.join('{}={}'.format(k, v) for k, v in sorted(next_query.items())))
+        return 200, content
+
+    def _variables(self, repository, env_uuid=None):
+        if env_uuid is None:
+            return repository['variables']
+        environment = next(env for env in repository['environments'] if env['uuid'] == env_uuid)
+        return environment['variables']
+
+    @staticmethod
+    def _public_variable(variable):
+        variable = dict(variable)
+        if variable['secured']:
+            variable.pop('value', None)
+        return variable
+
+    def _manage_variables(self, method, variables, rest, data, path, query):
+        if not rest:
+            if method == 'GET':
+                return self._page(path, query, [self._public_variable(var) for var in variables])
+            if method == 'POST':
+                if any(var['key'] == data['key'] for var in variables):
+                    return 409, dict(error=dict(message='A variable with the provided key already exists.'))
+                variable = dict(type='pipeline_variable', uuid=new_uuid(), key=data['key'],
+                                value=data.get('value'), secured=bool(data.get('secured')))
+                variables.append(variable)
+                return 201, self._public_variable(variable)
+            return 405, None
+
+        variable = next((var for var in variables if var['uuid'] == rest[0]), None)
+        if variable is None:
+            return 404, None
+        if method == 'PUT':
+            variable.update(key=data.get('key', variable['key']), value=data.get('value'),
+                            secured=bool(data.get('secured', variable['secured'])))
+            return 200, self._public_variable(variable)
+        if method == 'DELETE':
+            variables.remove(variable)
+            return 204, None
+        return 200, self._public_variable(variable)
+
+    def _repository(self, method, workspace, repo_slug, rest, data, path, query):
+        repository = self.repositories.get(repo_slug)
+
+        if not rest:
+            if method == 'POST':
+                if repository is not None:
+                    return 400, dict(error=dict(message='Repository with this Slug and Owner already exists.'))
+                repository = self.add_repository(repo_slug, (data.get('project') or {}).get('key', 'POC'))
+            if repository is None:
+                return 404, None
+            return 200, dict(
+                type='repository',
+                slug=repo_slug,
+                full_name='{}/{}'.format(workspace, repo_slug),
+                uuid=repository['uuid'],
+                is_private=True,
+                project=dict(key=repository['project_key']),
+            )
+
+        if repository is None:
+            return 404, None
+
+        resource = rest[0]
+        if resource == 'pipelines_config':
+            if len(rest) == 1:
+                if method == 'PUT':
+                    repository['pipelines'] = bool(data.get('enabled'))
+                return 200, dict(type='repository_pipelines_configuration', enabled=repository['pipelines'])
+            return self._manage_variables(method, repository['variables'], rest[2:], data, path, query)
+
+        if resource == 'permissions-config':
+            scope = rest[1]
+            if len(rest) == 2:
+                entries = repository[scope]
+                if scope == 'users':
+                    values = [dict(type='repository_user_permission', permission=perm,
+                                   user=dict(nickname=name)) for name, perm in sorted(entries.items())]
+                else:
+                    values = [dict(type='repository_group_permission', permission=perm,
+                                   group=dict(slug=name, name=name)) for name, perm in sorted(entries.items())]
+                return self._page(path, query, values)
+            name = rest[2]
+            if method == 'PUT':
+                repository[scope][name] = data['permission']
+                return 200, dict(permission=data['permission'])
+            if method == 'DELETE':
+                if repository[scope].pop(name, None) is None:
+                    return 404, None
+                return 204, None
+            return 405, None
+
+        if resource == 'environments':
+            environments = repository['environments']
+            if len(rest) == 1:
+                if method == 'GET':
+                    values = [dict((k, v) for k, v in env.items() if k != 'variables') for env in environments]
+                    return self._page(path, query, values)
+                if method == 'POST':
+                    environment = self.add_environment(
+                        repo_slug, data['name'], data['environment_type']['name'])
+                    return 201, dict((k, v) for k, v in environment.items() if k != 'variables')
+                return 405, None
+            environment = next((env for env in environments if env['uuid'] == rest[1]), None)
+            if environment is None:
+                return 404, None
+            if method == 'DELETE':
+                environments.remove(environment)
+                return 204, None
+            return 200, dict((k, v) for k, v in environment.items() if k != 'variables')
+
+        if resource == 'deployments_config':
+            # /deployments_config/environments/{uuid}/variables[/{uuid}]
+            environment = next((env for env in repository['environments'] if env['uuid'] == rest[2]), None)
+            if environment is None:
+                return 404, None
+            return self._manage_variables(method, environment['variables'], rest[4:], data, path, query)
+
+        if resource == 'branch-restrictions':
+            restrictions = repository['restrictions']
+            if len(rest) == 1:
+                if method == 'GET':
+                    return self._page(path, query, restrictions)
+                if method == 'POST':
+                    self._restriction_id += 1
+                    restriction = dict(data, id=self._restriction_id)
+                    restrictions.append(restriction)
+                    return 201, restriction
+                return 405, None
+            restriction = next((r for r in restrictions if str(r['id']) == rest[1]), None)
+            if restriction is None:
+                return 404, None
+            if method == 'PUT':
+                restriction.update(data)
+                restriction['id'] = int(rest[1])
+                return 200, restriction
+            if method == 'DELETE':
+                restrictions.remove(restriction)
+                return 204, None
+            return 200, restriction
+
+        return 404, None
+
+    def _group(self, group):
+        return dict(
+            name=group['name'],
+            slug=group['slug'],
+            permission=group['permission'],
+            owner=dict(username=self.workspace),
+        )
+
+    def _groups(self, method, rest, data):
+        if not rest:
+            if method == 'GET':
+                return 200, [self._group(group) for group in self.groups.values()]
+            if method == 'POST':
+                if self.slugify(data['name']) in self.groups:
+                    return 400, dict(error=dict(message='A group with this name already exists'))
+                return 200, self._group(self.add_group(data['name']))
+            return 405, None
+
+        group = self.groups.get(rest[0])
+        if group is None:
+            return 404, None
+
+        if len(rest) == 1:
+            if method == 'PUT':
+                if data.get('name'):
+                    group['name'] = data['name']
+                if data.get('permission'):
+                    group['permission'] = data['permission']
+                return 200, self._group(group)
+            if method == 'DELETE':
+                del self.groups[rest[0]]
+                return 204, None
+            return 200, self._group(group)
+
+        # /members[/{uuid}]
+        if len(rest) == 2:
+            return 200, [dict(uuid=member, display_name=member) for member in group['members']]
+        member = rest[2]
+        if method == 'PUT':
+            if member in group['members']:
+                return 409, dict(error=dict(message='already a member'))
+            group['members'].append(member)
+            return 200, dict(uuid=member, display_name=member)
+        if method == 'DELETE':
+            if member not in group['members']:
+                return 404, None
+            group['members'].remove(member)
+            return 204, None
+        return 405, None
+
+    def _privilege(self, group, repo_slug, privilege):
+        return dict(
+            repo='{}/{}'.format(self.workspace, repo_slug),
+            privilege=privilege,
+            group=self._group(group),
+        )
+
+    def _group_privileges(self, method, rest, data):
+        if len(rest) == 2:
+            # /group-privileges/{workspace}/{owner}/{slug}
+            group = self.groups.get(rest[1])
+            if group is None:
+                return 404, None
+            return 200, [self._privilege(group, repo_slug, privilege)
+                         for repo_slug, privilege in sorted(group['privileges'].items())]
+
+        # /group-privileges/{workspace}/{repo_slug}/{owner}/{slug}
+        repo_slug, group = rest[0], self.groups.get(rest[2])
+        if group is None or repo_slug not in self.repositories:
+            return 404, None
+        if method == 'PUT':
+            group['privileges'][repo_slug] = data['value']
+            return 200, [self._privilege(group, repo_slug, data['value'])]
+        if method == 'DELETE':
+            group['privileges'].pop(repo_slug, None)
+            return 204, None
+        return 405, None
+
+#
+# class: FakeBitbucketServer
+#
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # the headers and the body are written separately
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def _answer(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        api = self.server.api
+        if api.latency:
+            time.sleep(api.latency)
+
+        status, headers, content = api.handle(
+            self.command, self.path, body, self.headers.get('Content-Type'), self.headers.get('Host'),
+            self.headers.get('If-None-Match'))
+        payload = json.dumps(content).encode('utf-8') if content is not None else b''
+        api.sent(len(payload))
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if payload:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _answer
+
+
+class FakeBitbucketServer:
+    """
+    HTTP server answering with a FakeBitbucket, on a background thread.
+
+        with FakeBitbucketServer(FakeBitbucket(latency=0.02)) as server:
+            ... url=server.url ...
+    """
+
+    def __init__(self, api=None, host='127.0.0.1', port=0):
+        self.api = api or FakeBitbucket()
+        self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.api = self.api
+        self._thread = None
+
+    @property
+    def url(self):
+        """ value for the url option of the modules """
+        host, port = self.httpd.server_address[:2]
+        return 'http://{}:{}/2.0'.format(host, port)
+
+    def start(self):
+        """ Serve requests on a background thread """
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """ Stop serving and close the socket """
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main():
+    """ Run the server in the foreground """
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n', 1)[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workspace', default='i2b')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds waited before each answer')
+    parser.add_argument('--max-pagelen', type=int, default=100, help='largest page size of the listings')
+    parser.add_argument('--throttle-every', type=int, default=0, help='answer 429 to every Nth request')
+    parser.add_argument('--retry-after', type=float, default=0.1, help='Retry-After sent with a 429')
+    parser.add_argument('--etags', action='store_true', help='send ETags and answer 304 to conditional GETs')
+    parser.add_argument('--repositories', type=int, default=1, help='repositories repo-<n> to create')
+    parser.add_argument('--resources', type=int, default=0,
+                        help='variables, environments, branch restrictions and group permissions of each repository')
+    parser.add_argument('--groups', type=int, default=0, help='groups group-<n> to create')
+    parser.add_argument('--members', type=int, default=0, help='members of each group')
+    args = parser.parse_args()
+
+    api = FakeBitbucket(
+        workspace=args.workspace,
+        latency=args.latency,
+        max_pagelen=args.max_pagelen,
+        throttle_every=args.throttle_every,
+        retry_after=args.retry_after,
+        etags=args.etags,
+    )
+    api.seed(
+        repositories=args.repositories,
+        variables=args.resources,
+        environments=min(args.resources, 1),
+        restrictions=args.resources,
+        permissions=args.resources,
+        groups=args.groups,
+        members=args.members,
+    )
+
+    server = FakeBitbucketServer(api, args.host, args.port)
+    print('Serving {} on {}'.format(args.workspace, server.url))
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == '__main__':
+    main()